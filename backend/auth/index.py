@@ -1,23 +1,396 @@
+import functools
 import json
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import sys
+import threading
+import time
 import hashlib
 import hmac
 import base64
-from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
+from collections import OrderedDict
+from datetime import date, datetime, time as dt_time, timedelta
+from decimal import Decimal
+from typing import Dict, Any, List, Tuple, Optional
 
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def verify_password(password: str, password_hash: str) -> bool:
-    return hash_password(password) == password_hash
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+DATABASE_URL = os.environ.get('DATABASE_URL')
 
-def create_jwt(user_id: int, email: str, role: str) -> str:
-    secret = os.environ.get('JWT_SECRET', '')
-    header = base64.urlsafe_b64encode(json.dumps({'alg': 'HS256', 'typ': 'JWT'}).encode()).decode().rstrip('=')
+# Module-level state survives between warm invocations of the function
+_pool: List[Tuple[Any, float]] = []
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+pool_stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'discarded': 0}
+
+def _conn_alive(conn, idle_for: float) -> bool:
+    if conn.closed:
+        return False
+    if idle_for < DB_POOL_PING_AFTER:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _discard_conn(conn) -> None:
+    with _pool_lock:
+        pool_stats['discarded'] += 1
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+def get_conn():
+    started = time.perf_counter()
+    try:
+        if psycopg2 is None:
+            _load_driver()
+        return _checkout_conn()
+    finally:
+        _add_timing('connect', time.perf_counter() - started)
+
+def _checkout_conn():
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise psycopg2.OperationalError('Database connection pool exhausted')
+    try:
+        while True:
+            with _pool_lock:
+                if not _pool:
+                    pool_stats['misses'] += 1
+                    break
+                conn, last_used = _pool.pop()
+            if _conn_alive(conn, time.monotonic() - last_used):
+                with _pool_lock:
+                    pool_stats['hits'] += 1
+                return conn
+            _discard_conn(conn)
+        return psycopg2.connect(DATABASE_URL, connection_factory=TimedConnection)
+    except Exception:
+        _pool_slots.release()
+        raise
+
+def put_conn(conn) -> None:
+    try:
+        if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        pass
+    try:
+        if conn.closed:
+            _discard_conn(conn)
+        else:
+            with _pool_lock:
+                _pool.append((conn, time.monotonic()))
+    finally:
+        _pool_slots.release()
+
+def pool_metrics() -> Dict[str, int]:
+    with _pool_lock:
+        return dict(pool_stats, idle=len(_pool), max=DB_POOL_MAX)
+
+FUNCTION_NAME = 'auth'
+REQUEST_LOG = os.environ.get('REQUEST_LOG', '1') != '0'
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+
+# Timings of the request being handled by the current thread
+_request_metrics = threading.local()
+
+def _metrics() -> Optional[Dict[str, Any]]:
+    return getattr(_request_metrics, 'current', None)
+
+def _add_timing(phase: str, elapsed: float) -> None:
+    metrics = _metrics()
+    if metrics is not None:
+        metrics[phase] += elapsed
+
+# psycopg2 is about half of this module's import time and token checks never
+# touch the database, so the driver and the classes built on it are loaded
+# by the first get_conn() rather than on every cold start
+psycopg2 = None
+TimedConnection = TimedCursor = UniqueViolation = None
+_driver_lock = threading.Lock()
+
+def _load_driver() -> None:
+    global psycopg2, TimedConnection, TimedCursor, UniqueViolation
+    with _driver_lock:
+        if psycopg2 is not None:
+            return
+        import psycopg2 as driver
+        from psycopg2.errors import UniqueViolation
+        from psycopg2.extensions import connection
+        from psycopg2.extras import RealDictCursor
+        
+        class TimedConnection(connection):
+            def commit(self):
+                started = time.perf_counter()
+                try:
+                    return super().commit()
+                finally:
+                    _add_timing('query', time.perf_counter() - started)
+            
+            def rollback(self):
+                started = time.perf_counter()
+                try:
+                    return super().rollback()
+                finally:
+                    _add_timing('query', time.perf_counter() - started)
+        
+        class TimedCursor(RealDictCursor):
+            def execute(self, query, vars=None):
+                started = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    self._record(time.perf_counter() - started)
+            
+            def executemany(self, query, vars_list):
+                started = time.perf_counter()
+                try:
+                    return super().executemany(query, vars_list)
+                finally:
+                    self._record(time.perf_counter() - started)
+            
+            def _record(self, elapsed: float) -> None:
+                metrics = _metrics()
+                if metrics is not None:
+                    metrics['queries'] += 1
+                    metrics['query'] += elapsed
+                    metrics['slowest_query'] = max(metrics['slowest_query'], elapsed)
+        
+        # Bound last: get_conn() skips the lock once psycopg2 is set
+        psycopg2 = driver
+
+def annotate(**fields: Any) -> None:
+    metrics = _metrics()
+    if metrics is not None:
+        metrics['fields'].update(fields)
+
+def record_error(error: Exception) -> None:
+    metrics = _metrics()
+    if metrics is not None:
+        import traceback
+        metrics['error'] = {'type': type(error).__name__, 'message': str(error), 'traceback': traceback.format_exc()}
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+def instrumented(fn):
+    @functools.wraps(fn)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        metrics = {
+            'connect': 0.0, 'query': 0.0, 'serialize': 0.0, 'slowest_query': 0.0,
+            'queries': 0, 'fields': {}, 'error': None
+        }
+        _request_metrics.current = metrics
+        started = time.perf_counter()
+        response = None
+        try:
+            response = fn(event, context)
+        finally:
+            total = time.perf_counter() - started
+            _request_metrics.current = None
+            if REQUEST_LOG:
+                record = {
+                    'ts': datetime.utcnow().isoformat(timespec='milliseconds') + 'Z',
+                    'function': FUNCTION_NAME,
+                    'request_id': getattr(context, 'request_id', None),
+                    'method': event.get('httpMethod'),
+                    'action': (event.get('queryStringParameters') or {}).get('action'),
+                    'status': response['statusCode'] if response else 500,
+                    'total_ms': _ms(total),
+                    'connect_ms': _ms(metrics['connect']),
+                    'query_ms': _ms(metrics['query']),
+                    'queries': metrics['queries'],
+                    'slowest_query_ms': _ms(metrics['slowest_query']),
+                    'serialize_ms': _ms(metrics['serialize'])
+                }
+                record.update(metrics['fields'])
+                if metrics['error']:
+                    record['error'] = metrics['error']
+                sys.stdout.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        
+        if SERVER_TIMING and response is not None:
+            response['headers'] = dict(response.get('headers') or {}, **{
+                'Server-Timing': (
+                    f"conn;dur={_ms(metrics['connect'])}, "
+                    f"db;dur={_ms(metrics['query'])};desc=\"{metrics['queries']} queries\", "
+                    f"ser;dur={_ms(metrics['serialize'])}, "
+                    f"total;dur={_ms(total)}"
+                ),
+                'Timing-Allow-Origin': '*'
+            })
+        return response
+    return wrapper
+
+GZIP_MIN_BYTES = int(os.environ.get('GZIP_MIN_BYTES', '1024'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '5'))
+
+# Shared by every response; never mutate these dicts in place
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+GZIP_JSON_HEADERS = dict(JSON_HEADERS, **{'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+OPTIONS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
+    'Access-Control-Max-Age': '86400'
+}
+
+def json_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime, date, dt_time)):
+        return obj.isoformat()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+# orjson encodes dates and times natively and only calls json_default for
+# Decimal; the stdlib fallback reuses one encoder instead of building a new
+# JSONEncoder on every json.dumps call
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=json_default)
+
+def to_json(obj: Any) -> str:
+    started = time.perf_counter()
+    try:
+        if orjson is not None:
+            return orjson.dumps(obj, default=json_default).decode()
+        return _json_encoder.encode(obj)
+    finally:
+        _add_timing('serialize', time.perf_counter() - started)
+
+def request_header(event: Dict[str, Any], name: str) -> Optional[str]:
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+def accepts_gzip(event: Optional[Dict[str, Any]]) -> bool:
+    accept = request_header(event, 'Accept-Encoding') if event else None
+    return bool(accept) and 'gzip' in accept.lower()
+
+def gzip_body(body: str) -> str:
+    import gzip
+    started = time.perf_counter()
+    try:
+        return base64.b64encode(gzip.compress(body.encode(), compresslevel=GZIP_LEVEL, mtime=0)).decode()
+    finally:
+        _add_timing('serialize', time.perf_counter() - started)
+
+def respond(status: int, payload: Any, event: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # A str payload is taken to be serialized JSON already and passed through
+    body = payload if isinstance(payload, str) else to_json(payload)
+    if len(body) >= GZIP_MIN_BYTES and accepts_gzip(event):
+        return {
+            'statusCode': status,
+            'headers': GZIP_JSON_HEADERS,
+            'body': gzip_body(body),
+            'isBase64Encoded': True
+        }
+    return {
+        'statusCode': status,
+        'headers': JSON_HEADERS,
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+def respond_options() -> Dict[str, Any]:
+    return {
+        'statusCode': 200,
+        'headers': OPTIONS_HEADERS,
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', '16384'))
+PASSWORD_SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', '8'))
+PASSWORD_SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', '1'))
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', str(os.cpu_count() or 1)))
+SCRYPT_COST = (PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+
+# hashlib.scrypt releases the GIL, so KDF work submitted here runs in
+# parallel for concurrent logins handled by one process. Made on the first
+# login or registration; token checks never need it
+_kdf_pool = None
+_kdf_pool_lock = threading.Lock()
+
+def kdf_pool():
+    global _kdf_pool
+    with _kdf_pool_lock:
+        if _kdf_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _kdf_pool = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix='kdf')
+        return _kdf_pool
+
+def _b64(raw: bytes) -> str:
+    return base64.b64encode(raw).decode().rstrip('=')
+
+def _unb64(text: str) -> bytes:
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p,
+        maxmem=max(64 * 1024 * 1024, 256 * n * r), dklen=32
+    )
+
+def hash_password(password: str, cost: Tuple[int, int, int] = SCRYPT_COST) -> str:
+    # Versioned format: scrypt$<n>$<r>$<p>$<salt>$<hash>
+    n, r, p = cost
+    salt = os.urandom(16)
+    return f"scrypt${n}${r}${p}${_b64(salt)}${_b64(_scrypt(password, salt, n, r, p))}"
+
+def verify_password(password: str, password_hash: str) -> Tuple[bool, bool]:
+    # Returns (matches, needs_rehash)
+    if password_hash.startswith('scrypt$'):
+        # A stored hash that does not parse can never match
+        try:
+            _, n, r, p, salt, expected = password_hash.split('$')
+            cost = (int(n), int(r), int(p))
+            salt_raw, expected_raw = _unb64(salt), _unb64(expected)
+            derived = _scrypt(password, salt_raw, *cost)
+        except ValueError:
+            return False, False
+        matches = hmac.compare_digest(derived, expected_raw)
+        return matches, matches and cost != SCRYPT_COST
     
+    # Legacy unsalted SHA-256 hex digest, upgraded on the next successful login
+    matches = hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), password_hash)
+    return matches, matches
+
+# Unknown emails are checked against this so they cost the same scrypt run
+# as a wrong password; the random digest never matches anything
+DECOY_PASSWORD_HASH = f"scrypt${PASSWORD_SCRYPT_N}${PASSWORD_SCRYPT_R}${PASSWORD_SCRYPT_P}${_b64(os.urandom(16))}${_b64(os.urandom(32))}"
+
+def run_kdf(fn, *args):
+    return kdf_pool().submit(fn, *args).result()
+
+JWT_CACHE_SIZE = int(os.environ.get('JWT_CACHE_SIZE', '1024'))
+
+# HMAC inner/outer pads are derived from the secret once; every signature
+# starts from a copy of this object
+_jwt_key = hmac.new(os.environ.get('JWT_SECRET', '').encode(), digestmod=hashlib.sha256)
+# Every token has the same header, encoded once here
+JWT_HEADER = base64.urlsafe_b64encode(json.dumps({'alg': 'HS256', 'typ': 'JWT'}).encode()).decode().rstrip('=')
+
+# sha256(token) -> verified payload, least recently used first
+_jwt_cache: 'OrderedDict[bytes, Dict[str, Any]]' = OrderedDict()
+_jwt_cache_lock = threading.Lock()
+jwt_cache_stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'expired': 0}
+
+def sign_jwt(signature_input: str) -> str:
+    mac = _jwt_key.copy()
+    mac.update(signature_input.encode())
+    return base64.urlsafe_b64encode(mac.digest()).decode().rstrip('=')
+
+def create_jwt(user_id: int, email: str, role: str) -> str:
     exp = int((datetime.utcnow() + timedelta(days=7)).timestamp())
     payload = {
         'user_id': user_id,
@@ -27,40 +400,196 @@ def create_jwt(user_id: int, email: str, role: str) -> str:
     }
     payload_encoded = base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
     
-    signature_input = f"{header}.{payload_encoded}"
-    signature = base64.urlsafe_b64encode(
-        hmac.new(secret.encode(), signature_input.encode(), hashlib.sha256).digest()
-    ).decode().rstrip('=')
+    signature = sign_jwt(f"{JWT_HEADER}.{payload_encoded}")
     
-    return f"{header}.{payload_encoded}.{signature}"
+    return f"{JWT_HEADER}.{payload_encoded}.{signature}"
+
+def _verify_jwt_uncached(token: str) -> Optional[Dict[str, Any]]:
+    parts = token.split('.')
+    if len(parts) != 3:
+        return None
+    
+    header_encoded, payload_encoded, signature_provided = parts
+    
+    signature_expected = sign_jwt(f"{header_encoded}.{payload_encoded}")
+    if not hmac.compare_digest(signature_provided, signature_expected):
+        return None
+    
+    padding = '=' * (-len(payload_encoded) % 4)
+    return json.loads(base64.urlsafe_b64decode(payload_encoded + padding).decode())
 
 def verify_jwt(token: str) -> Optional[Dict[str, Any]]:
     try:
-        secret = os.environ.get('JWT_SECRET', '')
-        parts = token.split('.')
-        if len(parts) != 3:
-            return None
-        
-        header_encoded, payload_encoded, signature_provided = parts
+        now = int(datetime.utcnow().timestamp())
+        key = hashlib.sha256(token.encode()).digest()
         
-        signature_input = f"{header_encoded}.{payload_encoded}"
-        signature_expected = base64.urlsafe_b64encode(
-            hmac.new(secret.encode(), signature_input.encode(), hashlib.sha256).digest()
-        ).decode().rstrip('=')
+        with _jwt_cache_lock:
+            payload = _jwt_cache.get(key)
+            if payload is not None:
+                if payload.get('exp', 0) < now:
+                    del _jwt_cache[key]
+                    jwt_cache_stats['expired'] += 1
+                    return None
+                _jwt_cache.move_to_end(key)
+                jwt_cache_stats['hits'] += 1
+                return payload
+            jwt_cache_stats['misses'] += 1
         
-        if signature_provided != signature_expected:
-            return None
-        
-        padding = '=' * (4 - len(payload_encoded) % 4)
-        payload = json.loads(base64.urlsafe_b64decode(payload_encoded + padding).decode())
-        
-        if payload.get('exp', 0) < int(datetime.utcnow().timestamp()):
+        payload = _verify_jwt_uncached(token)
+        if payload is None or payload.get('exp', 0) < now:
             return None
         
+        with _jwt_cache_lock:
+            _jwt_cache[key] = payload
+            _jwt_cache.move_to_end(key)
+            while len(_jwt_cache) > JWT_CACHE_SIZE:
+                _jwt_cache.popitem(last=False)
         return payload
     except Exception:
         return None
 
+def jwt_cache_metrics() -> Dict[str, Any]:
+    with _jwt_cache_lock:
+        lookups = jwt_cache_stats['hits'] + jwt_cache_stats['misses']
+        return dict(
+            jwt_cache_stats,
+            size=len(_jwt_cache),
+            max=JWT_CACHE_SIZE,
+            hit_rate=round(jwt_cache_stats['hits'] / lookups, 4) if lookups else 0.0
+        )
+
+LOGIN_THROTTLE = os.environ.get('LOGIN_THROTTLE', '1') != '0'
+LOGIN_WINDOW = int(os.environ.get('LOGIN_WINDOW', '300'))
+LOGIN_BUCKETS_MAX = int(os.environ.get('LOGIN_BUCKETS_MAX', '10000'))
+
+# (burst, refill per minute) of the token bucket for each kind of key; the
+# shared per-window limit allows the same long-run rate
+LOGIN_LIMITS = {
+    'email': (int(os.environ.get('LOGIN_EMAIL_BURST', '5')), float(os.environ.get('LOGIN_EMAIL_PER_MINUTE', '1'))),
+    'ip': (int(os.environ.get('LOGIN_IP_BURST', '30')), float(os.environ.get('LOGIN_IP_PER_MINUTE', '20')))
+}
+LOGIN_WINDOW_LIMITS = {
+    kind: int(burst + per_minute * LOGIN_WINDOW / 60) for kind, (burst, per_minute) in LOGIN_LIMITS.items()
+}
+# A bucket left alone this long is full again and can be forgotten
+LOGIN_BUCKET_TTL = max(burst * 60 / per_minute for burst, per_minute in LOGIN_LIMITS.values())
+
+# 'kind:value' -> (tokens, last update), least recently touched first
+_login_buckets: 'OrderedDict[str, Tuple[float, float]]' = OrderedDict()
+_login_buckets_lock = threading.Lock()
+_login_sweep_at = 0.0
+login_throttle_stats: Dict[str, int] = {'allowed': 0, 'rejected_local': 0, 'rejected_shared': 0}
+
+# Counts the attempt against every key, then either reads the user or, when
+# a shared counter is over its limit, returns a single throttled row: the
+# EXISTS checks become one-time filters, so users is not even scanned then
+LOGIN_LOOKUP_SQL = """
+    WITH counted AS (
+        INSERT INTO login_attempts (key, window_start)
+        SELECT unnest(%(keys)s::text[]), %(window_start)s
+        ON CONFLICT (key, window_start) DO UPDATE SET attempts = login_attempts.attempts + 1
+        RETURNING key, attempts
+    ),
+    exceeded AS (
+        SELECT c.key
+        FROM counted c
+        JOIN unnest(%(keys)s::text[], %(limits)s::int[]) AS l(key, max_attempts) ON l.key = c.key
+        WHERE c.attempts > l.max_attempts
+    )
+    SELECT id, email, password_hash, role, full_name, false AS throttled
+    FROM users
+    WHERE email = %(email)s AND NOT EXISTS (SELECT 1 FROM exceeded)
+    UNION ALL
+    SELECT NULL, NULL, NULL, NULL, NULL, true
+    WHERE EXISTS (SELECT 1 FROM exceeded)
+"""
+
+def source_ip(event: Dict[str, Any]) -> Optional[str]:
+    # Only the address the platform saw: X-Forwarded-For is set by the
+    # client and would let it pick a fresh IP bucket for every guess
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    return identity.get('sourceIp') or None
+
+def login_keys(event: Dict[str, Any], email: str) -> List[Tuple[str, str]]:
+    keys = [('email', email.strip().lower())]
+    ip = source_ip(event)
+    if ip:
+        keys.append(('ip', ip))
+    return keys
+
+def take_login_tokens(keys: List[Tuple[str, str]]) -> float:
+    # Takes a token from every key's bucket and returns 0, or takes nothing
+    # and returns the seconds until the emptiest bucket has a token again
+    now = time.monotonic()
+    with _login_buckets_lock:
+        while _login_buckets:
+            oldest = next(iter(_login_buckets))
+            if now - _login_buckets[oldest][1] < LOGIN_BUCKET_TTL and len(_login_buckets) < LOGIN_BUCKETS_MAX:
+                break
+            del _login_buckets[oldest]
+        
+        refilled = []
+        wait = 0.0
+        for kind, value in keys:
+            burst, per_minute = LOGIN_LIMITS[kind]
+            key = f'{kind}:{value}'
+            tokens, updated = _login_buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * per_minute / 60)
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) * 60 / per_minute)
+            refilled.append((key, tokens))
+        
+        for key, tokens in refilled:
+            _login_buckets[key] = (tokens if wait else tokens - 1, now)
+            _login_buckets.move_to_end(key)
+        login_throttle_stats['rejected_local' if wait else 'allowed'] += 1
+    return wait
+
+def find_login_user(cursor, email: str, keys: Optional[List[Tuple[str, str]]]) -> Tuple[Optional[Dict[str, Any]], float]:
+    # Returns (user, 0), or (None, seconds left in the window) when a shared
+    # counter is over its limit; the caller commits the counted attempt
+    global _login_sweep_at
+    if not keys:
+        cursor.execute(
+            "SELECT id, email, password_hash, role, full_name FROM users WHERE email = %s",
+            (email,)
+        )
+        return cursor.fetchone(), 0
+    
+    now = time.time()
+    window_start = int(now) // LOGIN_WINDOW * LOGIN_WINDOW
+    # Each instance drops finished windows at most once per window
+    if now >= _login_sweep_at:
+        _login_sweep_at = window_start + LOGIN_WINDOW
+        cursor.execute(
+            "DELETE FROM login_attempts WHERE window_start < %s",
+            (datetime.utcfromtimestamp(window_start),)
+        )
+    
+    cursor.execute(LOGIN_LOOKUP_SQL, {
+        'keys': [f'{kind}:{value}' for kind, value in keys],
+        'limits': [LOGIN_WINDOW_LIMITS[kind] for kind, _ in keys],
+        'window_start': datetime.utcfromtimestamp(window_start),
+        'email': email
+    })
+    row = cursor.fetchone()
+    if row and row['throttled']:
+        with _login_buckets_lock:
+            login_throttle_stats['rejected_shared'] += 1
+        return None, window_start + LOGIN_WINDOW - now
+    return row, 0
+
+def respond_throttled(retry_after: float, event: Dict[str, Any]) -> Dict[str, Any]:
+    seconds = max(1, int(retry_after + 0.999))
+    response = respond(429, {'error': 'Too many login attempts', 'retry_after': seconds}, event)
+    response['headers'] = dict(response['headers'], **{'Retry-After': str(seconds)})
+    return response
+
+def login_throttle_metrics() -> Dict[str, Any]:
+    with _login_buckets_lock:
+        return dict(login_throttle_stats, buckets=len(_login_buckets), max=LOGIN_BUCKETS_MAX)
+
+@instrumented
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: User authentication and registration API
@@ -71,33 +600,40 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return respond_options()
     
     if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+        return respond(405, {'error': 'Method not allowed'}, event)
     
+    conn = None
     try:
         body = json.loads(event.get('body', '{}'))
         action = body.get('action')
+        annotate(action=action)
         
-        db_url = os.environ.get('DATABASE_URL')
-        conn = psycopg2.connect(db_url)
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        # Token checks are pure CPU work and never take a database connection
+        if action == 'verify':
+            token = body.get('token')
+            if not token:
+                return respond(400, {'error': 'Token is required'}, event)
+            
+            payload = verify_jwt(token)
+            if not payload:
+                return respond(401, {'error': 'Invalid or expired token'}, event)
+            
+            return respond(200, {'valid': True, 'user': payload}, event)
+        
+        # Throttled logins are turned away before a connection is even taken
+        throttle_keys = None
+        if action == 'login' and LOGIN_THROTTLE and body.get('email') and body.get('password'):
+            throttle_keys = login_keys(event, body['email'])
+            retry_after = take_login_tokens(throttle_keys)
+            if retry_after:
+                annotate(throttled='local')
+                return respond_throttled(retry_after, event)
+        
+        conn = get_conn()
+        cursor = conn.cursor(cursor_factory=TimedCursor)
         
         if action == 'register':
             email = body.get('email')
@@ -107,28 +643,26 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             role = body.get('role', 'parent')
             
             if not all([email, password, full_name]):
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Email, password and full_name are required'}),
-                    'isBase64Encoded': False
-                }
+                return respond(400, {'error': 'Email, password and full_name are required'}, event)
+            
+            # Hashing starts on the KDF pool while the existence check runs
+            hash_future = kdf_pool().submit(hash_password, password)
             
             cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
             if cursor.fetchone():
-                conn.close()
-                return {
-                    'statusCode': 409,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'User already exists'}),
-                    'isBase64Encoded': False
-                }
+                hash_future.cancel()
+                return respond(409, {'error': 'User already exists'}, event)
             
-            password_hash = hash_password(password)
-            cursor.execute(
-                "INSERT INTO users (email, password_hash, role, full_name, phone) VALUES (%s, %s, %s, %s, %s) RETURNING id, email, role, full_name",
-                (email, password_hash, role, full_name, phone)
-            )
+            password_hash = hash_future.result()
+            try:
+                cursor.execute(
+                    "INSERT INTO users (email, password_hash, role, full_name, phone) VALUES (%s, %s, %s, %s, %s) RETURNING id, email, role, full_name",
+                    (email, password_hash, role, full_name, phone)
+                )
+            except UniqueViolation:
+                # Lost a race against a concurrent registration of the same email
+                conn.rollback()
+                return respond(409, {'error': 'User already exists'}, event)
             user = cursor.fetchone()
             conn.commit()
             
@@ -139,109 +673,69 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 )
                 conn.commit()
             
-            conn.close()
-            
             token = create_jwt(user['id'], user['email'], user['role'])
             
-            return {
-                'statusCode': 201,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'token': token,
-                    'user': {
-                        'id': user['id'],
-                        'email': user['email'],
-                        'role': user['role'],
-                        'full_name': user['full_name']
-                    }
-                }),
-                'isBase64Encoded': False
-            }
+            return respond(201, {
+                'token': token,
+                'user': {
+                    'id': user['id'],
+                    'email': user['email'],
+                    'role': user['role'],
+                    'full_name': user['full_name']
+                }
+            }, event)
         
         elif action == 'login':
             email = body.get('email')
             password = body.get('password')
             
             if not all([email, password]):
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Email and password are required'}),
-                    'isBase64Encoded': False
-                }
+                return respond(400, {'error': 'Email and password are required'}, event)
             
-            cursor.execute(
-                "SELECT id, email, password_hash, role, full_name FROM users WHERE email = %s",
-                (email,)
-            )
-            user = cursor.fetchone()
-            conn.close()
-            
-            if not user or not verify_password(password, user['password_hash']):
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Invalid credentials'}),
-                    'isBase64Encoded': False
-                }
+            user, retry_after = find_login_user(cursor, email, throttle_keys)
+            conn.commit()
             
-            token = create_jwt(user['id'], user['email'], user['role'])
+            # The connection goes back to the pool before the KDF runs
+            put_conn(conn)
+            conn = None
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'token': token,
-                    'user': {
-                        'id': user['id'],
-                        'email': user['email'],
-                        'role': user['role'],
-                        'full_name': user['full_name']
-                    }
-                }),
-                'isBase64Encoded': False
-            }
-        
-        elif action == 'verify':
-            token = body.get('token')
-            if not token:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Token is required'}),
-                    'isBase64Encoded': False
-                }
+            if retry_after:
+                annotate(throttled='shared')
+                return respond_throttled(retry_after, event)
             
-            payload = verify_jwt(token)
-            if not payload:
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Invalid or expired token'}),
-                    'isBase64Encoded': False
-                }
+            password_hash = user['password_hash'] if user else DECOY_PASSWORD_HASH
+            matches, needs_rehash = run_kdf(verify_password, password, password_hash)
+            if not user or not matches:
+                return respond(401, {'error': 'Invalid credentials'}, event)
+            
+            if needs_rehash:
+                password_hash = run_kdf(hash_password, password)
+                conn = get_conn()
+                with conn.cursor(cursor_factory=TimedCursor) as cur:
+                    cur.execute(
+                        "UPDATE users SET password_hash = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                        (password_hash, user['id'])
+                    )
+                conn.commit()
+            
+            token = create_jwt(user['id'], user['email'], user['role'])
             
-            conn.close()
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'valid': True, 'user': payload}),
-                'isBase64Encoded': False
-            }
+            return respond(200, {
+                'token': token,
+                'user': {
+                    'id': user['id'],
+                    'email': user['email'],
+                    'role': user['role'],
+                    'full_name': user['full_name']
+                }
+            }, event)
         
         else:
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid action'}),
-                'isBase64Encoded': False
-            }
+            return respond(400, {'error': 'Invalid action'}, event)
     
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        record_error(e)
+        return respond(500, {'error': 'Internal server error'}, event)
+    finally:
+        if conn is not None:
+            put_conn(conn)
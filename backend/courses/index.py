@@ -1,15 +1,835 @@
+import functools
+import gzip
+import io
 import json
+import base64
 import os
+import sys
+import threading
+import time
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from typing import Dict, Any
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.errors import ExclusionViolation, InvalidDatetimeFormat
+from typing import Dict, Any, List, Optional, Tuple
 from decimal import Decimal
+from datetime import date, datetime, time as dt_time
 
-def decimal_default(obj):
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+
+# Module-level state survives between warm invocations of the function. Each
+# target database has its own pool; the replica one stays empty unless
+# DATABASE_READ_URL is set
+DB_URLS = {'primary': os.environ.get('DATABASE_URL'), 'replica': os.environ.get('DATABASE_READ_URL')}
+_pools: Dict[str, List[Tuple[Any, float]]] = {target: [] for target in DB_URLS}
+_pool_lock = threading.Lock()
+_pool_slots = {target: threading.BoundedSemaphore(DB_POOL_MAX) for target in DB_URLS}
+pool_stats: Dict[str, Dict[str, int]] = {target: {'hits': 0, 'misses': 0, 'discarded': 0} for target in DB_URLS}
+
+def _conn_alive(conn, idle_for: float) -> bool:
+    if conn.closed:
+        return False
+    if idle_for < DB_POOL_PING_AFTER:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _discard_conn(conn) -> None:
+    with _pool_lock:
+        pool_stats[conn.pool_target]['discarded'] += 1
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+def get_conn(target: str = 'primary'):
+    started = time.perf_counter()
+    try:
+        return _checkout_conn(target)
+    finally:
+        _add_timing('connect', time.perf_counter() - started)
+
+def _checkout_conn(target: str):
+    if not _pool_slots[target].acquire(timeout=DB_POOL_TIMEOUT):
+        raise psycopg2.OperationalError('Database connection pool exhausted')
+    try:
+        while True:
+            with _pool_lock:
+                if not _pools[target]:
+                    pool_stats[target]['misses'] += 1
+                    break
+                conn, last_used = _pools[target].pop()
+            if _conn_alive(conn, time.monotonic() - last_used):
+                with _pool_lock:
+                    pool_stats[target]['hits'] += 1
+                return conn
+            _discard_conn(conn)
+        conn = psycopg2.connect(DB_URLS[target], connection_factory=TimedConnection)
+        conn.pool_target = target
+        return conn
+    except Exception:
+        _pool_slots[target].release()
+        raise
+
+def put_conn(conn) -> None:
+    try:
+        if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        pass
+    try:
+        if conn.closed:
+            _discard_conn(conn)
+        else:
+            with _pool_lock:
+                _pools[conn.pool_target].append((conn, time.monotonic()))
+    finally:
+        _pool_slots[conn.pool_target].release()
+
+def pool_metrics() -> Dict[str, Any]:
+    with _pool_lock:
+        metrics: Dict[str, Any] = dict(pool_stats['primary'], idle=len(_pools['primary']), max=DB_POOL_MAX)
+        if READ_REPLICA:
+            metrics['replica'] = dict(pool_stats['replica'], idle=len(_pools['replica']), max=DB_POOL_MAX)
+        return metrics
+
+READ_REPLICA = bool(DB_URLS['replica'])
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', '1'))
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('REPLICA_LAG_CHECK_INTERVAL', '1'))
+# Clients that wrote this recently read from the primary. The window always
+# outlasts the worst replica lag still accepted (plus the time until it is
+# next probed), so once it ends the replica has the write
+READ_YOUR_WRITES_WINDOW = max(float(os.environ.get('READ_YOUR_WRITES_WINDOW', '5')),
+                              REPLICA_MAX_LAG + REPLICA_LAG_CHECK_INTERVAL)
+LAST_WRITE_HEADER = 'X-Last-Write'
+
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+# Last verdict on the replica, shared by all requests of this instance
+_replica_state: Dict[str, Any] = {'checked_at': float('-inf'), 'usable': False, 'reason': None, 'lag': None}
+read_routing_stats: Dict[str, int] = {'replica': 0, 'recent_write': 0, 'lagging': 0, 'unavailable': 0}
+
+def recent_write(event: Dict[str, Any]) -> bool:
+    token = request_header(event, LAST_WRITE_HEADER)
+    try:
+        age = time.time() - int(token) / 1000
+    except (TypeError, ValueError):
+        return False
+    return abs(age) < READ_YOUR_WRITES_WINDOW
+
+def _read_from_primary(reason: str):
+    with _pool_lock:
+        read_routing_stats[reason] += 1
+    annotate(db='primary', db_reason=reason)
+    return get_conn()
+
+def get_read_conn(event: Dict[str, Any]):
+    # Read-only branches use the replica unless the client wrote within the
+    # window or the replica lags or is down; that verdict is re-checked at
+    # most every REPLICA_LAG_CHECK_INTERVAL
+    if not READ_REPLICA:
+        return get_conn()
+    if recent_write(event):
+        return _read_from_primary('recent_write')
+    
+    probe = time.monotonic() - _replica_state['checked_at'] >= REPLICA_LAG_CHECK_INTERVAL
+    if not probe and not _replica_state['usable']:
+        return _read_from_primary(_replica_state['reason'])
+    
+    conn = None
+    try:
+        conn = get_conn('replica')
+        if probe:
+            with conn.cursor() as cur:
+                cur.execute(REPLICA_LAG_SQL)
+                lag = cur.fetchone()[0]
+            conn.rollback()
+    except psycopg2.Error:
+        if conn is not None:
+            put_conn(conn)
+        _replica_state.update(checked_at=time.monotonic(), usable=False, reason='unavailable', lag=None)
+        return _read_from_primary('unavailable')
+    
+    if probe:
+        usable = lag is not None and lag <= REPLICA_MAX_LAG
+        _replica_state.update(checked_at=time.monotonic(), usable=usable, reason=None if usable else 'lagging',
+                              lag=None if lag is None else float(lag))
+        if not usable:
+            put_conn(conn)
+            return _read_from_primary('lagging')
+    
+    with _pool_lock:
+        read_routing_stats['replica'] += 1
+    annotate(db='replica')
+    return conn
+
+def read_your_writes(fn):
+    # Successful writes return the time they happened; a client that sends it
+    # back in X-Last-Write reads its own write even while the replica lags
+    @functools.wraps(fn)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        response = fn(event, context)
+        if READ_REPLICA and event.get('httpMethod') != 'GET' and response['statusCode'] < 400:
+            response['headers'] = dict(response['headers'], **{
+                LAST_WRITE_HEADER: str(int(time.time() * 1000)),
+                'Access-Control-Expose-Headers': LAST_WRITE_HEADER
+            })
+        return response
+    return wrapper
+
+def read_routing_metrics() -> Dict[str, Any]:
+    with _pool_lock:
+        return dict(read_routing_stats, replica_usable=_replica_state['usable'], replica_lag=_replica_state['lag'])
+
+FUNCTION_NAME = 'courses'
+REQUEST_LOG = os.environ.get('REQUEST_LOG', '1') != '0'
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+
+# Timings of the request being handled by the current thread
+_request_metrics = threading.local()
+
+def _metrics() -> Optional[Dict[str, Any]]:
+    return getattr(_request_metrics, 'current', None)
+
+def _add_timing(phase: str, elapsed: float) -> None:
+    metrics = _metrics()
+    if metrics is not None:
+        metrics[phase] += elapsed
+
+class TimedConnection(psycopg2.extensions.connection):
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            _add_timing('query', time.perf_counter() - started)
+    
+    def rollback(self):
+        started = time.perf_counter()
+        try:
+            return super().rollback()
+        finally:
+            _add_timing('query', time.perf_counter() - started)
+
+class TimedCursor(RealDictCursor):
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._record(time.perf_counter() - started)
+    
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._record(time.perf_counter() - started)
+    
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self._record(time.perf_counter() - started)
+    
+    def _record(self, elapsed: float) -> None:
+        metrics = _metrics()
+        if metrics is not None:
+            metrics['queries'] += 1
+            metrics['query'] += elapsed
+            metrics['slowest_query'] = max(metrics['slowest_query'], elapsed)
+
+def annotate(**fields: Any) -> None:
+    metrics = _metrics()
+    if metrics is not None:
+        metrics['fields'].update(fields)
+
+def record_error(error: Exception) -> None:
+    metrics = _metrics()
+    if metrics is not None:
+        import traceback
+        metrics['error'] = {'type': type(error).__name__, 'message': str(error), 'traceback': traceback.format_exc()}
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+def instrumented(fn):
+    @functools.wraps(fn)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        metrics = {
+            'connect': 0.0, 'query': 0.0, 'serialize': 0.0, 'slowest_query': 0.0,
+            'queries': 0, 'fields': {}, 'error': None
+        }
+        _request_metrics.current = metrics
+        started = time.perf_counter()
+        response = None
+        try:
+            response = fn(event, context)
+        finally:
+            total = time.perf_counter() - started
+            _request_metrics.current = None
+            if REQUEST_LOG:
+                record = {
+                    'ts': datetime.utcnow().isoformat(timespec='milliseconds') + 'Z',
+                    'function': FUNCTION_NAME,
+                    'request_id': getattr(context, 'request_id', None),
+                    'method': event.get('httpMethod'),
+                    'action': (event.get('queryStringParameters') or {}).get('action'),
+                    'status': response['statusCode'] if response else 500,
+                    'total_ms': _ms(total),
+                    'connect_ms': _ms(metrics['connect']),
+                    'query_ms': _ms(metrics['query']),
+                    'queries': metrics['queries'],
+                    'slowest_query_ms': _ms(metrics['slowest_query']),
+                    'serialize_ms': _ms(metrics['serialize'])
+                }
+                record.update(metrics['fields'])
+                if metrics['error']:
+                    record['error'] = metrics['error']
+                sys.stdout.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        
+        if SERVER_TIMING and response is not None:
+            response['headers'] = dict(response.get('headers') or {}, **{
+                'Server-Timing': (
+                    f"conn;dur={_ms(metrics['connect'])}, "
+                    f"db;dur={_ms(metrics['query'])};desc=\"{metrics['queries']} queries\", "
+                    f"ser;dur={_ms(metrics['serialize'])}, "
+                    f"total;dur={_ms(total)}"
+                ),
+                'Timing-Allow-Origin': '*'
+            })
+        return response
+    return wrapper
+
+GZIP_MIN_BYTES = int(os.environ.get('GZIP_MIN_BYTES', '1024'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '5'))
+
+# Shared by every response; never mutate these dicts in place
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+GZIP_JSON_HEADERS = dict(JSON_HEADERS, **{'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+CSV_HEADERS = {'Content-Type': 'text/csv; charset=utf-8', 'Access-Control-Allow-Origin': '*'}
+OPTIONS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, If-None-Match, X-Last-Write',
+    'Access-Control-Max-Age': '86400'
+}
+
+def json_default(obj):
     if isinstance(obj, Decimal):
         return float(obj)
-    raise TypeError
+    if isinstance(obj, (datetime, date, dt_time)):
+        return obj.isoformat()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+# orjson encodes dates and times natively and only calls json_default for
+# Decimal; the stdlib fallback reuses one encoder instead of building a new
+# JSONEncoder on every json.dumps call
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=json_default)
+
+def to_json(obj: Any) -> str:
+    started = time.perf_counter()
+    try:
+        if orjson is not None:
+            return orjson.dumps(obj, default=json_default).decode()
+        return _json_encoder.encode(obj)
+    finally:
+        _add_timing('serialize', time.perf_counter() - started)
+
+def request_header(event: Dict[str, Any], name: str) -> Optional[str]:
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+def accepts_gzip(event: Optional[Dict[str, Any]]) -> bool:
+    accept = request_header(event, 'Accept-Encoding') if event else None
+    return bool(accept) and 'gzip' in accept.lower()
+
+def gzip_body(body: str) -> str:
+    started = time.perf_counter()
+    try:
+        return base64.b64encode(gzip.compress(body.encode(), compresslevel=GZIP_LEVEL, mtime=0)).decode()
+    finally:
+        _add_timing('serialize', time.perf_counter() - started)
+
+def respond(status: int, payload: Any, event: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # A str payload is taken to be serialized JSON already and passed through
+    body = payload if isinstance(payload, str) else to_json(payload)
+    if len(body) >= GZIP_MIN_BYTES and accepts_gzip(event):
+        return {
+            'statusCode': status,
+            'headers': GZIP_JSON_HEADERS,
+            'body': gzip_body(body),
+            'isBase64Encoded': True
+        }
+    return {
+        'statusCode': status,
+        'headers': JSON_HEADERS,
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+def respond_csv(body: str, filename: str, event: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    headers = dict(CSV_HEADERS, **{'Content-Disposition': f'attachment; filename="{filename}"'})
+    if len(body) >= GZIP_MIN_BYTES and accepts_gzip(event):
+        headers.update({'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+        return {'statusCode': 200, 'headers': headers, 'body': gzip_body(body), 'isBase64Encoded': True}
+    return {'statusCode': 200, 'headers': headers, 'body': body, 'isBase64Encoded': False}
+
+def respond_options() -> Dict[str, Any]:
+    return {
+        'statusCode': 200,
+        'headers': OPTIONS_HEADERS,
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+CATALOG_CACHE_TTL = float(os.environ.get('CATALOG_CACHE_TTL', '60'))
+SEARCH_LIMIT_DEFAULT = 20
+SEARCH_LIMIT_MAX = 100
+PRICE_FACET_EDGES = (0, 2000, 3000, 4000, 5000)
+AGE_FACET_BUCKETS = ((3, 6), (7, 10), (11, 14), (15, 18))
+
+WEEKDAYS = ('ПН', 'ВТ', 'СР', 'ЧТ', 'ПТ', 'СБ', 'ВС')
+FREE_SLOTS_FROM = '09:00'
+FREE_SLOTS_TO = '21:00'
+FREE_SLOTS_DURATION = 60
+PAYROLL_MAX_DAYS = 366
+# Outbox channel for waitlist promotion notices; delivered by backend/notifications
+NOTIFY_CHANNEL = os.environ.get('NOTIFY_CHANNEL', 'email')
+
+# Pay is rate_per_student for every present visit of an active enrollment
+# in the period. Visits are hash-aggregated per lesson and then per course,
+# so attendance is read once (index-only for short periods through
+# idx_attendance_present_date) and teachers only join the per-course totals.
+PAYROLL_SQL = """
+    WITH lessons AS (
+        SELECT e.course_id, count(*) AS present_visits
+        FROM attendance a
+        JOIN enrollments e ON e.id = a.enrollment_id
+        WHERE a.status = 'present' AND e.status = 'active'
+          AND a.lesson_date BETWEEN %(date_from)s AND %(date_to)s
+        GROUP BY e.course_id, a.lesson_date, a.lesson_time
+    ),
+    visits AS (
+        SELECT course_id, count(*) AS lessons, sum(present_visits) AS present_visits
+        FROM lessons
+        GROUP BY course_id
+    ),
+    enrolled AS (
+        SELECT course_id, count(*) AS active_students
+        FROM enrollments
+        WHERE status = 'active'
+        GROUP BY course_id
+    )
+    SELECT t.id AS teacher_id, u.full_name AS teacher_name,
+           count(c.id) AS courses,
+           COALESCE(sum(en.active_students), 0)::int AS active_students,
+           COALESCE(sum(v.lessons), 0)::int AS lessons,
+           COALESCE(sum(v.present_visits), 0)::int AS present_visits,
+           t.rate_per_student,
+           (t.rate_per_student * COALESCE(sum(v.present_visits), 0))::numeric(12, 2) AS payable
+    FROM teachers t
+    LEFT JOIN users u ON u.id = t.user_id
+    LEFT JOIN courses c ON c.teacher_id = t.id
+    LEFT JOIN visits v ON v.course_id = c.id
+    LEFT JOIN enrolled en ON en.course_id = c.id
+    GROUP BY t.id, u.full_name, t.rate_per_student
+    ORDER BY u.full_name, t.id
+"""
+
+# Must stay identical to the expression of idx_courses_search (V0006) for
+# the GIN index to be used
+COURSE_SEARCH_VECTOR = (
+    "(setweight(to_tsvector('russian', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('russian', coalesce(description, '')), 'B'))"
+)
+
+# (etag, serialized body, gzipped body or None, expires_at) of the active course catalog
+_catalog_cache: Optional[Tuple[str, str, Optional[str], float]] = None
+
+# Version of the catalog as committed: a digest of the xmin of every row the
+# catalog query reads. Any committed update, insert or delete of an active
+# course, its teacher or the teacher's user changes some row version, whatever
+# its updated_at says and whenever that transaction began
+CATALOG_VERSION_SQL = """
+    SELECT md5(coalesce(string_agg(
+        c.id || ':' || c.xmin::text || ':' || coalesce(t.xmin::text, '-') || ':' || coalesce(u.xmin::text, '-'),
+        ',' ORDER BY c.id
+    ), '')) AS version
+    FROM courses c
+    LEFT JOIN teachers t ON c.teacher_id = t.id
+    LEFT JOIN users u ON t.user_id = u.id
+    WHERE c.is_active = true
+"""
+
+def catalog_etag(version: str) -> str:
+    return f'"{version}"'
+
+def invalidate_catalog() -> None:
+    global _catalog_cache
+    _catalog_cache = None
+
+def catalog_response(event: Dict[str, Any], etag: str, body: str, body_gz: Optional[str]) -> Dict[str, Any]:
+    # The gzip representation gets its own strong validator
+    use_gzip = body_gz is not None and accepts_gzip(event)
+    etag_gz = etag[:-1] + '-gzip"'
+    headers = dict(GZIP_JSON_HEADERS if use_gzip else JSON_HEADERS, **{
+        'Access-Control-Expose-Headers': 'ETag',
+        'Cache-Control': 'no-cache',
+        'ETag': etag_gz if use_gzip else etag
+    })
+    if_none_match = request_header(event, 'If-None-Match')
+    if if_none_match:
+        tags = [t.strip() for t in if_none_match.split(',')]
+        if '*' in tags or etag in tags or etag_gz in tags:
+            return {
+                'statusCode': 304,
+                'headers': headers,
+                'body': '',
+                'isBase64Encoded': False
+            }
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': body_gz if use_gzip else body,
+        'isBase64Encoded': use_gzip
+    }
+
+def _int_param(params: Dict[str, Any], name: str) -> Optional[int]:
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} must be an integer')
+
+def _decimal_param(params: Dict[str, Any], name: str) -> Optional[Decimal]:
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return Decimal(value)
+    except ArithmeticError:
+        raise ValueError(f'{name} must be a number')
+
+def check_age_range(cursor, body: Dict[str, Any], course_id: Any = None) -> None:
+    # idx_courses_age_range indexes int4range(age_min, age_max, '[]'), which
+    # cannot be built for an inverted range, so such a write would fail. An
+    # update of one bound is checked against the stored other one
+    bounds = {name: body.get(name) for name in ('age_min', 'age_max')}
+    if course_id is not None:
+        if 'age_min' not in body and 'age_max' not in body:
+            return
+        if 'age_min' not in body or 'age_max' not in body:
+            cursor.execute("SELECT age_min, age_max FROM courses WHERE id = %s FOR UPDATE", (course_id,))
+            stored = cursor.fetchone() or {}
+            bounds = {name: body[name] if name in body else stored.get(name) for name in bounds}
+    age_min, age_max = _int_param(bounds, 'age_min'), _int_param(bounds, 'age_max')
+    if age_min is not None and age_max is not None and age_min > age_max:
+        raise ValueError('age_min must not be greater than age_max')
+
+def search_courses(cursor, params: Dict[str, Any]) -> str:
+    conditions = ['c.is_active = true']
+    values: Dict[str, Any] = {
+        'price_lo': list(PRICE_FACET_EDGES),
+        'price_hi': list(PRICE_FACET_EDGES[1:]) + [None],
+        'age_lo': [b[0] for b in AGE_FACET_BUCKETS],
+        'age_hi': [b[1] for b in AGE_FACET_BUCKETS]
+    }
+    
+    q = (params.get('q') or '').strip()
+    if q:
+        conditions.append(f"{COURSE_SEARCH_VECTOR} @@ websearch_to_tsquery('russian', %(q)s)")
+        values['q'] = q
+        rank = f"ts_rank({COURSE_SEARCH_VECTOR}, websearch_to_tsquery('russian', %(q)s))"
+    else:
+        rank = '0'
+    
+    # age=8 is shorthand for age_from=8&age_to=8; a course matches when its
+    # [age_min, age_max] range overlaps the requested one
+    age = _int_param(params, 'age')
+    age_from = _int_param(params, 'age_from') if age is None else age
+    age_to = _int_param(params, 'age_to') if age is None else age
+    if age_from is not None and age_to is not None and age_from > age_to:
+        raise ValueError('age_from must not be greater than age_to')
+    if age_from is not None or age_to is not None:
+        conditions.append("int4range(c.age_min, c.age_max, '[]') && int4range(%(age_from)s, %(age_to)s, '[]')")
+        values.update(age_from=age_from, age_to=age_to)
+    
+    price_min = _decimal_param(params, 'price_min')
+    if price_min is not None:
+        conditions.append('c.price_per_month >= %(price_min)s')
+        values['price_min'] = price_min
+    price_max = _decimal_param(params, 'price_max')
+    if price_max is not None:
+        conditions.append('c.price_per_month <= %(price_max)s')
+        values['price_max'] = price_max
+    
+    if params.get('available') in ('1', 'true'):
+        conditions.append('c.available_spots > 0')
+    
+    teacher_id = _int_param(params, 'teacher_id')
+    if teacher_id is not None:
+        conditions.append('c.teacher_id = %(teacher_id)s')
+        values['teacher_id'] = teacher_id
+    
+    limit = _int_param(params, 'limit')
+    values['limit'] = max(1, min(limit or SEARCH_LIMIT_DEFAULT, SEARCH_LIMIT_MAX))
+    values['offset'] = max(0, _int_param(params, 'offset') or 0)
+    
+    # Results, total and facet counts come back as one JSON document
+    cursor.execute(f"""
+        WITH matched AS (
+            SELECT c.id, c.teacher_id, c.price_per_month, c.available_spots, c.age_min, c.age_max,
+                   {rank} AS rank
+            FROM courses c
+            WHERE {' AND '.join(conditions)}
+        ),
+        page AS (
+            SELECT m.rank, c.*, t.user_id, u.full_name AS teacher_name
+            FROM matched m
+            JOIN courses c ON c.id = m.id
+            LEFT JOIN teachers t ON c.teacher_id = t.id
+            LEFT JOIN users u ON t.user_id = u.id
+            ORDER BY m.rank DESC, c.created_at DESC, c.id
+            LIMIT %(limit)s OFFSET %(offset)s
+        )
+        SELECT json_build_object(
+            'total', (SELECT count(*) FROM matched),
+            'items', COALESCE(
+                (SELECT json_agg(p ORDER BY p.rank DESC, p.created_at DESC, p.id) FROM page p), '[]'::json
+            ),
+            'facets', json_build_object(
+                'teachers', COALESCE((
+                    SELECT json_agg(json_build_object(
+                        'teacher_id', f.teacher_id, 'teacher_name', f.teacher_name, 'count', f.n
+                    ) ORDER BY f.n DESC, f.teacher_id)
+                    FROM (
+                        SELECT m.teacher_id, u.full_name AS teacher_name, count(*) AS n
+                        FROM matched m
+                        LEFT JOIN teachers t ON m.teacher_id = t.id
+                        LEFT JOIN users u ON t.user_id = u.id
+                        GROUP BY m.teacher_id, u.full_name
+                    ) f
+                ), '[]'::json),
+                'price', (
+                    SELECT json_agg(json_build_object(
+                        'from', e.lo, 'to', e.hi,
+                        'count', (SELECT count(*) FROM matched m
+                                  WHERE m.price_per_month >= e.lo AND (e.hi IS NULL OR m.price_per_month < e.hi))
+                    ) ORDER BY e.lo)
+                    FROM unnest(%(price_lo)s::numeric[], %(price_hi)s::numeric[]) AS e(lo, hi)
+                ),
+                'age', (
+                    SELECT json_agg(json_build_object(
+                        'from', b.lo, 'to', b.hi,
+                        'count', (SELECT count(*) FROM matched m
+                                  WHERE int4range(m.age_min, m.age_max, '[]') && int4range(b.lo, b.hi, '[]'))
+                    ) ORDER BY b.lo)
+                    FROM unnest(%(age_lo)s::int[], %(age_hi)s::int[]) AS b(lo, hi)
+                ),
+                'availability', json_build_object(
+                    'available', (SELECT count(*) FROM matched WHERE available_spots > 0),
+                    'full', (SELECT count(*) FROM matched WHERE available_spots <= 0)
+                )
+            )
+        )::text AS result
+    """, values)
+    return cursor.fetchone()['result']
+
+def _time_param(params: Dict[str, Any], name: str, default: str) -> dt_time:
+    value = params.get(name) or default
+    try:
+        return datetime.strptime(value, '%H:%M').time()
+    except ValueError:
+        raise ValueError(f'{name} must be HH:MM')
 
+def _weekdays_param(params: Dict[str, Any]) -> List[int]:
+    value = params.get('day')
+    if not value:
+        return list(range(1, 8))
+    days = []
+    for part in value.split(','):
+        part = part.strip().upper()
+        if part in WEEKDAYS:
+            days.append(WEEKDAYS.index(part) + 1)
+        elif part.isdigit() and 1 <= int(part) <= 7:
+            days.append(int(part))
+        else:
+            raise ValueError('day must be 1-7 or ПН..ВС')
+    return sorted(set(days))
+
+def find_slot_conflicts(cursor, course: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # Slots of other courses that overlap the proposed schedule in the same
+    # room or with the same teacher; served by the course_slots GiST indexes
+    cursor.execute("""
+        SELECT s.course_id, c.title, s.weekday, s.starts_at, s.ends_at,
+               s.room_id IS NOT DISTINCT FROM r.id AND r.id IS NOT NULL AS room_conflict,
+               s.teacher_id IS NOT DISTINCT FROM %(teacher_id)s AND s.teacher_id IS NOT NULL AS teacher_conflict
+        FROM parse_course_schedule(%(schedule)s, %(duration_minutes)s) p
+        LEFT JOIN rooms r ON r.name = trim(%(room)s)
+        JOIN course_slots s ON s.week_minutes && p.week_minutes
+             AND (s.room_id = r.id OR s.teacher_id = %(teacher_id)s)
+        JOIN courses c ON c.id = s.course_id
+        WHERE s.course_id IS DISTINCT FROM %(id)s
+        ORDER BY s.weekday, s.starts_at, s.course_id
+    """, {
+        'id': course.get('id'),
+        'schedule': course.get('schedule'),
+        'duration_minutes': course.get('duration_minutes'),
+        'room': course.get('room'),
+        'teacher_id': course.get('teacher_id')
+    })
+    return cursor.fetchall()
+
+def free_slots(cursor, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    room = (params.get('room') or '').strip() or None
+    teacher_id = _int_param(params, 'teacher_id')
+    if room is None and teacher_id is None:
+        raise ValueError('room or teacher_id is required')
+    
+    window_from = _time_param(params, 'from', FREE_SLOTS_FROM)
+    window_to = _time_param(params, 'to', FREE_SLOTS_TO)
+    if window_to <= window_from:
+        raise ValueError('to must be later than from')
+    duration = _int_param(params, 'duration') or FREE_SLOTS_DURATION
+    if duration <= 0:
+        raise ValueError('duration must be positive')
+    
+    # Busy intervals come from the GiST indexes; each gap runs from the
+    # latest end seen so far to the next start, with a sentinel at the end
+    # of the window closing the last one
+    cursor.execute("""
+        WITH days AS (
+            SELECT unnest(%(days)s::smallint[]) AS weekday
+        ),
+        busy AS (
+            SELECT s.weekday, s.starts_at, s.ends_at
+            FROM course_slots s
+            WHERE ((s.room_id IS NOT NULL
+                    AND int4range(s.room_id, s.room_id, '[]') && (SELECT int4range(id, id, '[]') FROM rooms WHERE name = %(room)s))
+                   OR (s.teacher_id IS NOT NULL AND %(teacher_id)s IS NOT NULL
+                       AND int4range(s.teacher_id, s.teacher_id, '[]') && int4range(%(teacher_id)s, %(teacher_id)s, '[]')))
+              AND s.weekday = ANY(%(days)s::smallint[])
+              AND s.starts_at < %(to)s AND s.ends_at > %(from)s
+        ),
+        edges AS (
+            SELECT weekday, starts_at, ends_at FROM busy
+            UNION ALL
+            SELECT weekday, %(to)s::time, %(to)s::time FROM days
+        ),
+        gaps AS (
+            SELECT weekday,
+                   greatest(coalesce(max(ends_at) OVER w, %(from)s::time), %(from)s::time) AS starts_at,
+                   starts_at AS ends_at
+            FROM edges
+            WINDOW w AS (PARTITION BY weekday ORDER BY starts_at, ends_at
+                         ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING)
+        )
+        SELECT weekday, starts_at, ends_at
+        FROM gaps
+        WHERE ends_at - starts_at >= make_interval(mins => %(duration)s)
+        ORDER BY weekday, starts_at
+    """, {
+        'days': _weekdays_param(params),
+        'room': room,
+        'teacher_id': teacher_id,
+        'from': window_from,
+        'to': window_to,
+        'duration': duration
+    })
+    return cursor.fetchall()
+
+def schedule_error(cursor, e: Exception, course: Dict[str, Any], event: Dict[str, Any]) -> Dict[str, Any]:
+    if isinstance(e, InvalidDatetimeFormat):
+        return respond(400, {'error': e.diag.message_primary}, event)
+    return respond(409, {
+        'error': 'Schedule overlaps another course in the same room or with the same teacher',
+        'conflicts': find_slot_conflicts(cursor, course)
+    }, event)
+
+def parse_period(params: Dict[str, Any]) -> Tuple[date, date]:
+    try:
+        date_from = date.fromisoformat(params.get('from') or '')
+        date_to = date.fromisoformat(params.get('to') or '')
+    except ValueError:
+        raise ValueError('from and to must be YYYY-MM-DD')
+    if date_to < date_from:
+        raise ValueError('to must not be before from')
+    if (date_to - date_from).days >= PAYROLL_MAX_DAYS:
+        raise ValueError(f'Period is limited to {PAYROLL_MAX_DAYS} days')
+    return date_from, date_to
+
+def payroll_csv(cursor, date_from: date, date_to: date) -> str:
+    # Postgres renders the CSV itself; the rows never become Python objects
+    query = cursor.mogrify(PAYROLL_SQL, {'date_from': date_from, 'date_to': date_to}).decode()
+    out = io.StringIO()
+    cursor.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)', out)
+    # BOM so spreadsheet apps pick UTF-8 for the Cyrillic names
+    return '\ufeff' + out.getvalue()
+
+def payroll_rows(cursor, date_from: date, date_to: date) -> List[Dict[str, Any]]:
+    cursor.execute(PAYROLL_SQL, {'date_from': date_from, 'date_to': date_to})
+    return cursor.fetchall()
+
+def course_stats(cursor) -> List[Dict[str, Any]]:
+    # Attendance counts come from course_attendance_stats, which triggers on
+    # attendance keep current (V0005), so this is one pass over courses
+    cursor.execute("""
+        SELECT
+            c.id AS course_id, c.title, c.total_spots, c.available_spots,
+            round((c.total_spots - c.available_spots)::numeric / NULLIF(c.total_spots, 0), 4) AS fill_ratio,
+            COALESCE(s.present, 0) AS present,
+            COALESCE(s.absent, 0) AS absent,
+            COALESCE(s.excused, 0) AS excused,
+            round(s.present::numeric / NULLIF(s.present + s.absent + s.excused, 0), 4) AS attendance_rate
+        FROM courses c
+        LEFT JOIN course_attendance_stats s ON s.course_id = c.id
+        WHERE c.is_active = true
+        ORDER BY c.id
+    """)
+    return [dict(row) for row in cursor.fetchall()]
+
+def student_stats(cursor, student_id: int) -> Optional[Dict[str, Any]]:
+    cursor.execute("""
+        SELECT
+            st.id AS student_id, st.full_name,
+            COALESCE(s.present, 0) AS present,
+            COALESCE(s.absent, 0) AS absent,
+            COALESCE(s.excused, 0) AS excused,
+            round(s.present::numeric / NULLIF(s.present + s.absent + s.excused, 0), 4) AS attendance_rate
+        FROM students st
+        LEFT JOIN student_attendance_stats s ON s.student_id = st.id
+        WHERE st.id = %s
+    """, (student_id,))
+    row = cursor.fetchone()
+    return dict(row) if row else None
+
+@instrumented
+@read_your_writes
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Course management API
@@ -17,31 +837,74 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
           context - execution context
     Returns: Course data or operation result
     '''
+    global _catalog_cache
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return respond_options()
     
+    conn = None
     try:
-        db_url = os.environ.get('DATABASE_URL')
-        conn = psycopg2.connect(db_url)
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        params = event.get('queryStringParameters') or {}
+        
+        # A client reading right after its own write skips the cache too
+        if method == 'GET' and not params.get('id') and not params.get('action') and not recent_write(event):
+            cached = _catalog_cache
+            if cached is not None and cached[3] > time.monotonic():
+                return catalog_response(event, cached[0], cached[1], cached[2])
+        
+        conn = get_read_conn(event) if method == 'GET' else get_conn()
+        cursor = conn.cursor(cursor_factory=TimedCursor)
         
         if method == 'GET':
-            params = event.get('queryStringParameters') or {}
             course_id = params.get('id')
             
-            if course_id:
+            if params.get('action') == 'search':
+                try:
+                    result = search_courses(cursor, params)
+                except ValueError as e:
+                    return respond(400, {'error': str(e)}, event)
+                return respond(200, result, event)
+            
+            elif params.get('action') == 'free_slots':
+                try:
+                    slots = free_slots(cursor, params)
+                except ValueError as e:
+                    return respond(400, {'error': str(e)}, event)
+                return respond(200, {'free_slots': slots}, event)
+            
+            elif params.get('action') == 'payroll':
+                try:
+                    date_from, date_to = parse_period(params)
+                except ValueError as e:
+                    return respond(400, {'error': str(e)}, event)
+                
+                if params.get('format') == 'json':
+                    return respond(200, {
+                        'from': date_from,
+                        'to': date_to,
+                        'teachers': payroll_rows(cursor, date_from, date_to)
+                    }, event)
+                
+                return respond_csv(payroll_csv(cursor, date_from, date_to),
+                                   f'payroll-{date_from}-{date_to}.csv', event)
+            
+            elif params.get('action') == 'stats':
+                try:
+                    student_id = _int_param(params, 'student_id')
+                except ValueError as e:
+                    return respond(400, {'error': str(e)}, event)
+                
+                if student_id is not None:
+                    stats = student_stats(cursor, student_id)
+                    if not stats:
+                        return respond(404, {'error': 'Student not found'}, event)
+                else:
+                    stats = {'courses': course_stats(cursor)}
+                
+                return respond(200, stats, event)
+            
+            elif course_id:
                 cursor.execute("""
                     SELECT c.*, t.user_id, u.full_name as teacher_name
                     FROM courses c
@@ -50,40 +913,36 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     WHERE c.id = %s
                 """, (course_id,))
                 course = cursor.fetchone()
-                conn.close()
                 
                 if not course:
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Course not found'}),
-                        'isBase64Encoded': False
-                    }
+                    return respond(404, {'error': 'Course not found'}, event)
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(dict(course), default=decimal_default),
-                    'isBase64Encoded': False
-                }
+                return respond(200, course, event)
             else:
-                cursor.execute("""
-                    SELECT c.*, t.user_id, u.full_name as teacher_name
-                    FROM courses c
-                    LEFT JOIN teachers t ON c.teacher_id = t.id
-                    LEFT JOIN users u ON t.user_id = u.id
-                    WHERE c.is_active = true
-                    ORDER BY c.created_at DESC
-                """)
-                courses = cursor.fetchall()
-                conn.close()
+                # The catalog is only rebuilt and reserialized when its row
+                # versions changed. The body is read after the probe, so it is
+                # never older than the ETag it is cached under
+                cursor.execute(CATALOG_VERSION_SQL)
+                etag = catalog_etag(cursor.fetchone()['version'])
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps([dict(c) for c in courses], default=decimal_default),
-                    'isBase64Encoded': False
-                }
+                cached = _catalog_cache
+                if cached is not None and cached[0] == etag:
+                    body, body_gz = cached[1], cached[2]
+                else:
+                    cursor.execute("""
+                        SELECT c.*, t.user_id, u.full_name as teacher_name
+                        FROM courses c
+                        LEFT JOIN teachers t ON c.teacher_id = t.id
+                        LEFT JOIN users u ON t.user_id = u.id
+                        WHERE c.is_active = true
+                        ORDER BY c.created_at DESC
+                    """)
+                    courses = cursor.fetchall()
+                    body = to_json(courses)
+                    body_gz = gzip_body(body) if len(body) >= GZIP_MIN_BYTES else None
+                
+                _catalog_cache = (etag, body, body_gz, time.monotonic() + CATALOG_CACHE_TTL)
+                return catalog_response(event, etag, body, body_gz)
         
         elif method == 'POST':
             body = json.loads(event.get('body', '{}'))
@@ -101,46 +960,45 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             teacher_id = body.get('teacher_id')
             
             if not all([title, price_per_month, total_spots]):
-                conn.close()
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Title, price and total_spots are required'}),
-                    'isBase64Encoded': False
-                }
+                return respond(400, {'error': 'Title, price and total_spots are required'}, event)
             
-            cursor.execute("""
-                INSERT INTO courses 
-                (title, description, age_min, age_max, schedule, duration_minutes, 
-                 price_per_month, total_spots, available_spots, room, image_emoji, teacher_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id, title, description, price_per_month, total_spots, available_spots
-            """, (title, description, age_min, age_max, schedule, duration_minutes,
-                  price_per_month, total_spots, total_spots, room, image_emoji, teacher_id))
+            try:
+                check_age_range(cursor, body)
+            except ValueError as e:
+                return respond(400, {'error': str(e)}, event)
+            
+            # The courses trigger rebuilds course_slots; overlaps surface as
+            # exclusion violations and unparseable schedules as 22007
+            try:
+                cursor.execute("""
+                    INSERT INTO courses 
+                    (title, description, age_min, age_max, schedule, duration_minutes, 
+                     price_per_month, total_spots, available_spots, room, image_emoji, teacher_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id, title, description, price_per_month, total_spots, available_spots
+                """, (title, description, age_min, age_max, schedule, duration_minutes,
+                      price_per_month, total_spots, total_spots, room, image_emoji, teacher_id))
+            except (ExclusionViolation, InvalidDatetimeFormat) as e:
+                conn.rollback()
+                return schedule_error(cursor, e, body, event)
             
             course = cursor.fetchone()
             conn.commit()
-            conn.close()
+            invalidate_catalog()
             
-            return {
-                'statusCode': 201,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps(dict(course), default=decimal_default),
-                'isBase64Encoded': False
-            }
+            return respond(201, course, event)
         
         elif method == 'PUT':
             body = json.loads(event.get('body', '{}'))
             course_id = body.get('id')
             
             if not course_id:
-                conn.close()
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Course ID is required'}),
-                    'isBase64Encoded': False
-                }
+                return respond(400, {'error': 'Course ID is required'}, event)
+            
+            try:
+                check_age_range(cursor, body, course_id)
+            except ValueError as e:
+                return respond(400, {'error': str(e)}, event)
             
             updates = []
             values = []
@@ -152,52 +1010,48 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     updates.append(f"{field} = %s")
                     values.append(body[field])
             
+            # Changing capacity alone moves the free seats by the same amount
+            # (the right-hand total_spots is the value before this update)
+            if 'total_spots' in body and 'available_spots' not in body:
+                updates.append("available_spots = GREATEST(available_spots + %s - total_spots, 0)")
+                values.append(body['total_spots'])
+            
             if not updates:
-                conn.close()
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'No fields to update'}),
-                    'isBase64Encoded': False
-                }
+                return respond(400, {'error': 'No fields to update'}, event)
             
             updates.append("updated_at = CURRENT_TIMESTAMP")
             values.append(course_id)
             
             query = f"UPDATE courses SET {', '.join(updates)} WHERE id = %s RETURNING *"
-            cursor.execute(query, values)
+            try:
+                cursor.execute(query, values)
+            except (ExclusionViolation, InvalidDatetimeFormat) as e:
+                conn.rollback()
+                cursor.execute("SELECT * FROM courses WHERE id = %s", (course_id,))
+                return schedule_error(cursor, e, {**(cursor.fetchone() or {}), **body}, event)
             course = cursor.fetchone()
+            
+            # Freshly added seats go to the waitlist first
+            if course and ('total_spots' in body or 'available_spots' in body):
+                cursor.execute("SELECT * FROM promote_waitlist(%s, %s)", (course_id, NOTIFY_CHANNEL))
+                promoted = cursor.fetchall()
+                if promoted:
+                    course = dict(course, available_spots=course['available_spots'] - len(promoted),
+                                  promoted=promoted)
             conn.commit()
-            conn.close()
+            invalidate_catalog()
             
             if not course:
-                return {
-                    'statusCode': 404,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Course not found'}),
-                    'isBase64Encoded': False
-                }
+                return respond(404, {'error': 'Course not found'}, event)
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps(dict(course), default=decimal_default),
-                'isBase64Encoded': False
-            }
+            return respond(200, course, event)
         
         else:
-            conn.close()
-            return {
-                'statusCode': 405,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
+            return respond(405, {'error': 'Method not allowed'}, event)
     
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
\ No newline at end of file
+        record_error(e)
+        return respond(500, {'error': 'Internal server error'}, event)
+    finally:
+        if conn is not None:
+            put_conn(conn)
@@ -0,0 +1,603 @@
+import functools
+import json
+import os
+import random
+import smtplib
+import sys
+import base64
+import threading
+import time
+import urllib.error
+import urllib.request
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from typing import Dict, Any, List, Optional, Tuple
+from decimal import Decimal
+from datetime import date, datetime, time as dt_time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+DATABASE_URL = os.environ.get('DATABASE_URL')
+
+# Module-level state survives between warm invocations of the function
+_pool: List[Tuple[Any, float]] = []
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+pool_stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'discarded': 0}
+
+def _conn_alive(conn, idle_for: float) -> bool:
+    if conn.closed:
+        return False
+    if idle_for < DB_POOL_PING_AFTER:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _discard_conn(conn) -> None:
+    with _pool_lock:
+        pool_stats['discarded'] += 1
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+def get_conn():
+    started = time.perf_counter()
+    try:
+        return _checkout_conn()
+    finally:
+        _add_timing('connect', time.perf_counter() - started)
+
+def _checkout_conn():
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise psycopg2.OperationalError('Database connection pool exhausted')
+    try:
+        while True:
+            with _pool_lock:
+                if not _pool:
+                    pool_stats['misses'] += 1
+                    break
+                conn, last_used = _pool.pop()
+            if _conn_alive(conn, time.monotonic() - last_used):
+                with _pool_lock:
+                    pool_stats['hits'] += 1
+                return conn
+            _discard_conn(conn)
+        return psycopg2.connect(DATABASE_URL, connection_factory=TimedConnection)
+    except Exception:
+        _pool_slots.release()
+        raise
+
+def put_conn(conn) -> None:
+    try:
+        if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        pass
+    try:
+        if conn.closed:
+            _discard_conn(conn)
+        else:
+            with _pool_lock:
+                _pool.append((conn, time.monotonic()))
+    finally:
+        _pool_slots.release()
+
+def pool_metrics() -> Dict[str, int]:
+    with _pool_lock:
+        return dict(pool_stats, idle=len(_pool), max=DB_POOL_MAX)
+
+FUNCTION_NAME = 'notifications'
+REQUEST_LOG = os.environ.get('REQUEST_LOG', '1') != '0'
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+
+# Timings of the request being handled by the current thread
+_request_metrics = threading.local()
+
+def _metrics() -> Optional[Dict[str, Any]]:
+    return getattr(_request_metrics, 'current', None)
+
+def _add_timing(phase: str, elapsed: float) -> None:
+    metrics = _metrics()
+    if metrics is not None:
+        metrics[phase] += elapsed
+
+class TimedConnection(psycopg2.extensions.connection):
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            _add_timing('query', time.perf_counter() - started)
+    
+    def rollback(self):
+        started = time.perf_counter()
+        try:
+            return super().rollback()
+        finally:
+            _add_timing('query', time.perf_counter() - started)
+
+class TimedCursor(RealDictCursor):
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._record(time.perf_counter() - started)
+    
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._record(time.perf_counter() - started)
+    
+    def _record(self, elapsed: float) -> None:
+        metrics = _metrics()
+        if metrics is not None:
+            metrics['queries'] += 1
+            metrics['query'] += elapsed
+            metrics['slowest_query'] = max(metrics['slowest_query'], elapsed)
+
+def annotate(**fields: Any) -> None:
+    metrics = _metrics()
+    if metrics is not None:
+        metrics['fields'].update(fields)
+
+def record_error(error: Exception) -> None:
+    metrics = _metrics()
+    if metrics is not None:
+        import traceback
+        metrics['error'] = {'type': type(error).__name__, 'message': str(error), 'traceback': traceback.format_exc()}
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+def instrumented(fn):
+    @functools.wraps(fn)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        metrics = {
+            'connect': 0.0, 'query': 0.0, 'serialize': 0.0, 'slowest_query': 0.0,
+            'queries': 0, 'fields': {}, 'error': None
+        }
+        _request_metrics.current = metrics
+        started = time.perf_counter()
+        response = None
+        try:
+            response = fn(event, context)
+        finally:
+            total = time.perf_counter() - started
+            _request_metrics.current = None
+            if REQUEST_LOG:
+                record = {
+                    'ts': datetime.utcnow().isoformat(timespec='milliseconds') + 'Z',
+                    'function': FUNCTION_NAME,
+                    'request_id': getattr(context, 'request_id', None),
+                    'method': event.get('httpMethod'),
+                    'action': (event.get('queryStringParameters') or {}).get('action'),
+                    'status': response['statusCode'] if response else 500,
+                    'total_ms': _ms(total),
+                    'connect_ms': _ms(metrics['connect']),
+                    'query_ms': _ms(metrics['query']),
+                    'queries': metrics['queries'],
+                    'slowest_query_ms': _ms(metrics['slowest_query']),
+                    'serialize_ms': _ms(metrics['serialize'])
+                }
+                record.update(metrics['fields'])
+                if metrics['error']:
+                    record['error'] = metrics['error']
+                sys.stdout.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        
+        if SERVER_TIMING and response is not None:
+            response['headers'] = dict(response.get('headers') or {}, **{
+                'Server-Timing': (
+                    f"conn;dur={_ms(metrics['connect'])}, "
+                    f"db;dur={_ms(metrics['query'])};desc=\"{metrics['queries']} queries\", "
+                    f"ser;dur={_ms(metrics['serialize'])}, "
+                    f"total;dur={_ms(total)}"
+                ),
+                'Timing-Allow-Origin': '*'
+            })
+        return response
+    return wrapper
+
+GZIP_MIN_BYTES = int(os.environ.get('GZIP_MIN_BYTES', '1024'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '5'))
+
+# Shared by every response; never mutate these dicts in place
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+GZIP_JSON_HEADERS = dict(JSON_HEADERS, **{'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+OPTIONS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-Dispatch-Token',
+    'Access-Control-Max-Age': '86400'
+}
+
+def json_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime, date, dt_time)):
+        return obj.isoformat()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+# orjson encodes dates and times natively and only calls json_default for
+# Decimal; the stdlib fallback reuses one encoder instead of building a new
+# JSONEncoder on every json.dumps call
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=json_default)
+
+def to_json(obj: Any) -> str:
+    started = time.perf_counter()
+    try:
+        if orjson is not None:
+            return orjson.dumps(obj, default=json_default).decode()
+        return _json_encoder.encode(obj)
+    finally:
+        _add_timing('serialize', time.perf_counter() - started)
+
+def request_header(event: Dict[str, Any], name: str) -> Optional[str]:
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+def accepts_gzip(event: Optional[Dict[str, Any]]) -> bool:
+    accept = request_header(event, 'Accept-Encoding') if event else None
+    return bool(accept) and 'gzip' in accept.lower()
+
+def gzip_body(body: str) -> str:
+    import gzip
+    started = time.perf_counter()
+    try:
+        return base64.b64encode(gzip.compress(body.encode(), compresslevel=GZIP_LEVEL, mtime=0)).decode()
+    finally:
+        _add_timing('serialize', time.perf_counter() - started)
+
+def respond(status: int, payload: Any, event: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # A str payload is taken to be serialized JSON already and passed through
+    body = payload if isinstance(payload, str) else to_json(payload)
+    if len(body) >= GZIP_MIN_BYTES and accepts_gzip(event):
+        return {
+            'statusCode': status,
+            'headers': GZIP_JSON_HEADERS,
+            'body': gzip_body(body),
+            'isBase64Encoded': True
+        }
+    return {
+        'statusCode': status,
+        'headers': JSON_HEADERS,
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+def respond_options() -> Dict[str, Any]:
+    return {
+        'statusCode': 200,
+        'headers': OPTIONS_HEADERS,
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+NOTIFY_BACKEND = os.environ.get('NOTIFY_BACKEND', 'live')
+NOTIFY_DISPATCH_TOKEN = os.environ.get('NOTIFY_DISPATCH_TOKEN', '')
+NOTIFY_BATCH_SIZE = int(os.environ.get('NOTIFY_BATCH_SIZE', '100'))
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get('NOTIFY_MAX_ATTEMPTS', '5'))
+NOTIFY_BACKOFF_BASE = float(os.environ.get('NOTIFY_BACKOFF_BASE', '30'))
+NOTIFY_BACKOFF_MAX = float(os.environ.get('NOTIFY_BACKOFF_MAX', '3600'))
+NOTIFY_LEASE_SECONDS = int(os.environ.get('NOTIFY_LEASE_SECONDS', '300'))
+NOTIFY_RUN_SECONDS = float(os.environ.get('NOTIFY_RUN_SECONDS', '20'))
+SEND_TIMEOUT = float(os.environ.get('NOTIFY_SEND_TIMEOUT', '10'))
+
+class DeliveryError(Exception):
+    # permanent=True skips the remaining retries (no recipient, rejected address)
+    def __init__(self, message: str, permanent: bool = False):
+        super().__init__(message)
+        self.permanent = permanent
+
+class Channel(ABC):
+    name = ''
+    
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+    
+    # Delivers one notification or raises DeliveryError
+    @abstractmethod
+    def send(self, notification: Dict[str, Any]) -> None:
+        ...
+
+class EmailChannel(Channel):
+    name = 'email'
+    
+    def __init__(self, concurrency: int):
+        super().__init__(concurrency)
+        self.host = os.environ.get('SMTP_HOST', '')
+        self.port = int(os.environ.get('SMTP_PORT', '465'))
+        self.user = os.environ.get('SMTP_USER', '')
+        self.password = os.environ.get('SMTP_PASSWORD', '')
+        self.sender = os.environ.get('SMTP_FROM', self.user)
+        # One SMTP session per sender thread, reused across the batch
+        self._local = threading.local()
+    
+    def _session(self) -> smtplib.SMTP:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            if self.port == 465:
+                session = smtplib.SMTP_SSL(self.host, self.port, timeout=SEND_TIMEOUT)
+            else:
+                session = smtplib.SMTP(self.host, self.port, timeout=SEND_TIMEOUT)
+                session.starttls()
+            if self.user:
+                session.login(self.user, self.password)
+            self._local.session = session
+        return session
+    
+    def send(self, notification: Dict[str, Any]) -> None:
+        msg = EmailMessage()
+        msg['From'] = self.sender
+        msg['To'] = notification['recipient']
+        msg['Subject'] = notification['subject'] or ''
+        msg.set_content(notification['message'])
+        try:
+            self._session().send_message(msg)
+        except smtplib.SMTPRecipientsRefused as e:
+            raise DeliveryError(str(e), permanent=True)
+        except (smtplib.SMTPException, OSError) as e:
+            self._local.session = None
+            raise DeliveryError(str(e))
+
+class TelegramChannel(Channel):
+    name = 'telegram'
+    
+    def __init__(self, concurrency: int):
+        super().__init__(concurrency)
+        self.url = f"https://api.telegram.org/bot{os.environ.get('TELEGRAM_BOT_TOKEN', '')}/sendMessage"
+    
+    def send(self, notification: Dict[str, Any]) -> None:
+        text = notification['message']
+        if notification['subject']:
+            text = f"{notification['subject']}\n\n{text}"
+        post_json(self.url, {'chat_id': notification['recipient'], 'text': text}, {})
+
+class SmsChannel(Channel):
+    name = 'sms'
+    
+    def __init__(self, concurrency: int):
+        super().__init__(concurrency)
+        self.url = os.environ.get('SMS_API_URL', '')
+        self.headers = {'Authorization': f"Bearer {os.environ.get('SMS_API_KEY', '')}"}
+    
+    def send(self, notification: Dict[str, Any]) -> None:
+        post_json(self.url, {'to': notification['recipient'], 'text': notification['message']}, self.headers)
+
+class FakeChannel(Channel):
+    # Local stand-in: records deliveries in memory and fails a configurable
+    # share of them so retries and backoff can be exercised without a provider
+    def __init__(self, name: str, concurrency: int, fail_rate: float = 0.0, delay: float = 0.0):
+        super().__init__(concurrency)
+        self.name = name
+        self.fail_rate = fail_rate
+        self.delay = delay
+        self.sent: List[int] = []
+        self._lock = threading.Lock()
+    
+    def send(self, notification: Dict[str, Any]) -> None:
+        if self.delay:
+            time.sleep(self.delay)
+        if self.fail_rate and random.random() < self.fail_rate:
+            raise DeliveryError('fake transient failure')
+        with self._lock:
+            self.sent.append(notification['id'])
+
+def post_json(url: str, payload: Dict[str, Any], headers: Dict[str, str]) -> None:
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode(), method='POST',
+        headers=dict(headers, **{'Content-Type': 'application/json'})
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=SEND_TIMEOUT) as response:
+            response.read()
+    except urllib.error.HTTPError as e:
+        # 4xx other than rate limiting will not get better on retry
+        raise DeliveryError(f'HTTP {e.code}', permanent=400 <= e.code < 500 and e.code != 429)
+    except OSError as e:
+        raise DeliveryError(str(e))
+
+def build_channels() -> Dict[str, Channel]:
+    concurrency = {
+        name: int(os.environ.get(f'NOTIFY_CONCURRENCY_{name.upper()}', default))
+        for name, default in (('email', '8'), ('telegram', '4'), ('sms', '4'))
+    }
+    if NOTIFY_BACKEND == 'fake':
+        fail_rate = float(os.environ.get('NOTIFY_FAKE_FAIL_RATE', '0'))
+        delay = float(os.environ.get('NOTIFY_FAKE_DELAY_MS', '0')) / 1000
+        return {name: FakeChannel(name, n, fail_rate, delay) for name, n in concurrency.items()}
+    return {
+        'email': EmailChannel(concurrency['email']),
+        'telegram': TelegramChannel(concurrency['telegram']),
+        'sms': SmsChannel(concurrency['sms'])
+    }
+
+CHANNELS = build_channels()
+# Each channel gets its own bounded sender pool, which is its concurrency limit
+_senders: Dict[Channel, ThreadPoolExecutor] = {}
+_senders_lock = threading.Lock()
+
+def sender_pool(channel: Channel) -> ThreadPoolExecutor:
+    with _senders_lock:
+        pool = _senders.get(channel)
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=channel.concurrency, thread_name_prefix=f'notify-{channel.name}')
+            _senders[channel] = pool
+        return pool
+
+def claim_batch(conn, cursor, limit: int) -> List[Dict[str, Any]]:
+    # SKIP LOCKED lets parallel dispatchers take disjoint batches. Pushing
+    # next_attempt_at out by the lease hides the batch from the others once
+    # this short transaction commits, and hands it back if we die mid-send.
+    cursor.execute("""
+        WITH due AS (
+            SELECT id, user_id
+            FROM notifications
+            WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+            ORDER BY next_attempt_at, id
+            LIMIT %(limit)s
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE notifications n
+        SET attempts = n.attempts + 1,
+            next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %(lease)s)
+        FROM due
+        LEFT JOIN users u ON u.id = due.user_id
+        WHERE n.id = due.id
+        RETURNING n.id, n.type, n.subject, n.message, n.attempts,
+                  CASE n.type
+                      WHEN 'email' THEN u.email
+                      WHEN 'sms' THEN u.phone
+                      ELSE u.telegram_chat_id
+                  END AS recipient
+    """, {'limit': limit, 'lease': NOTIFY_LEASE_SECONDS})
+    rows = cursor.fetchall()
+    conn.commit()
+    return rows
+
+def deliver(rows: List[Dict[str, Any]]) -> List[Tuple[int, bool, bool, Optional[str]]]:
+    def attempt(channel: Channel, row: Dict[str, Any]) -> Tuple[int, bool, bool, Optional[str]]:
+        if not row['recipient']:
+            return row['id'], False, True, f'No {channel.name} recipient'
+        try:
+            channel.send(row)
+            return row['id'], True, False, None
+        except DeliveryError as e:
+            return row['id'], False, e.permanent, str(e)
+        except Exception as e:
+            return row['id'], False, False, f'{type(e).__name__}: {e}'
+    
+    futures = []
+    outcomes = []
+    for row in rows:
+        channel = CHANNELS.get(row['type'])
+        if channel is None:
+            outcomes.append((row['id'], False, True, f"Unknown channel {row['type']}"))
+            continue
+        futures.append(sender_pool(channel).submit(attempt, channel, row))
+    return outcomes + [f.result() for f in futures]
+
+def settle(conn, cursor, outcomes: List[Tuple[int, bool, bool, Optional[str]]]) -> Dict[str, int]:
+    # One statement settles the whole batch: sent rows are closed, permanent
+    # or exhausted failures are marked failed, the rest back off
+    # exponentially (with jitter) from their attempt count
+    cursor.execute("""
+        UPDATE notifications n
+        SET status = CASE
+                WHEN r.ok THEN 'sent'
+                WHEN r.permanent OR n.attempts >= %(max_attempts)s THEN 'failed'
+                ELSE 'pending'
+            END,
+            sent_at = CASE WHEN r.ok THEN CURRENT_TIMESTAMP ELSE n.sent_at END,
+            last_error = r.error,
+            next_attempt_at = CASE
+                WHEN r.ok OR r.permanent THEN n.next_attempt_at
+                ELSE CURRENT_TIMESTAMP + make_interval(secs =>
+                    least(%(base)s * power(2, n.attempts - 1), %(cap)s) * (0.8 + random() * 0.4))
+            END
+        FROM unnest(%(ids)s::int[], %(ok)s::bool[], %(permanent)s::bool[], %(errors)s::text[])
+            AS r(id, ok, permanent, error)
+        WHERE n.id = r.id
+        RETURNING n.status
+    """, {
+        'ids': [o[0] for o in outcomes],
+        'ok': [o[1] for o in outcomes],
+        'permanent': [o[2] for o in outcomes],
+        'errors': [o[3] for o in outcomes],
+        'max_attempts': NOTIFY_MAX_ATTEMPTS,
+        'base': NOTIFY_BACKOFF_BASE,
+        'cap': NOTIFY_BACKOFF_MAX
+    })
+    counts = {'sent': 0, 'retry': 0, 'failed': 0}
+    for row in cursor.fetchall():
+        counts['retry' if row['status'] == 'pending' else row['status']] += 1
+    conn.commit()
+    return counts
+
+def dispatch(conn, cursor, batch_size: int, budget: float) -> Dict[str, int]:
+    deadline = time.monotonic() + budget
+    summary = {'batches': 0, 'claimed': 0, 'sent': 0, 'retry': 0, 'failed': 0}
+    while time.monotonic() < deadline:
+        rows = claim_batch(conn, cursor, batch_size)
+        if not rows:
+            break
+        counts = settle(conn, cursor, deliver(rows))
+        summary['batches'] += 1
+        summary['claimed'] += len(rows)
+        for key, value in counts.items():
+            summary[key] += value
+        if len(rows) < batch_size:
+            break
+    return summary
+
+@instrumented
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Notification outbox dispatcher, run on a schedule or on demand
+    Args: event - HTTP request with method, headers (X-Dispatch-Token), body
+          context - execution context
+    Returns: Counts of claimed, sent, retried and failed notifications
+    '''
+    method: str = event.get('httpMethod', 'POST')
+    
+    if method == 'OPTIONS':
+        return respond_options()
+    
+    if method != 'POST':
+        return respond(405, {'error': 'Method not allowed'}, event)
+    
+    # A dispatch claims and sends the whole outbox. Without a configured
+    # token only the fake backend may be driven anonymously
+    if NOTIFY_DISPATCH_TOKEN:
+        if request_header(event, 'X-Dispatch-Token') != NOTIFY_DISPATCH_TOKEN:
+            return respond(403, {'error': 'Forbidden'}, event)
+    elif NOTIFY_BACKEND != 'fake':
+        return respond(403, {'error': 'Dispatcher is disabled: NOTIFY_DISPATCH_TOKEN is not set'}, event)
+    
+    # Only a malformed request is the caller's fault; anything that goes
+    # wrong while dispatching is a 500
+    try:
+        body = json.loads(event.get('body') or '{}')
+        if not isinstance(body, dict):
+            raise ValueError('Body must be a JSON object')
+        batch_size = max(1, min(int(body.get('batch_size', NOTIFY_BATCH_SIZE)), 1000))
+        budget = max(0.0, min(float(body.get('max_seconds', NOTIFY_RUN_SECONDS)), NOTIFY_RUN_SECONDS))
+    except (TypeError, ValueError) as e:
+        return respond(400, {'error': str(e)}, event)
+    
+    conn = None
+    try:
+        conn = get_conn()
+        cursor = conn.cursor(cursor_factory=TimedCursor)
+        summary = dispatch(conn, cursor, batch_size, budget)
+        annotate(**summary)
+        
+        return respond(200, summary, event)
+    
+    except Exception as e:
+        record_error(e)
+        return respond(500, {'error': 'Internal server error'}, event)
+    finally:
+        if conn is not None:
+            put_conn(conn)
@@ -1,18 +1,1333 @@
+import functools
+import io
 import json
 import os
+import sys
+import base64
+import csv
+import threading
+import time
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from typing import Dict, Any
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.errors import ForeignKeyViolation
+from typing import Dict, Any, List, Optional, Tuple
 from decimal import Decimal
-from datetime import datetime
+from datetime import date, datetime, time as dt_time
 
-def decimal_default(obj):
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+
+# Module-level state survives between warm invocations of the function. Each
+# target database has its own pool; the replica one stays empty unless
+# DATABASE_READ_URL is set
+DB_URLS = {'primary': os.environ.get('DATABASE_URL'), 'replica': os.environ.get('DATABASE_READ_URL')}
+_pools: Dict[str, List[Tuple[Any, float]]] = {target: [] for target in DB_URLS}
+_pool_lock = threading.Lock()
+_pool_slots = {target: threading.BoundedSemaphore(DB_POOL_MAX) for target in DB_URLS}
+pool_stats: Dict[str, Dict[str, int]] = {target: {'hits': 0, 'misses': 0, 'discarded': 0} for target in DB_URLS}
+
+def _conn_alive(conn, idle_for: float) -> bool:
+    if conn.closed:
+        return False
+    if idle_for < DB_POOL_PING_AFTER:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _discard_conn(conn) -> None:
+    with _pool_lock:
+        pool_stats[conn.pool_target]['discarded'] += 1
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+def get_conn(target: str = 'primary'):
+    started = time.perf_counter()
+    try:
+        return _checkout_conn(target)
+    finally:
+        _add_timing('connect', time.perf_counter() - started)
+
+def _checkout_conn(target: str):
+    if not _pool_slots[target].acquire(timeout=DB_POOL_TIMEOUT):
+        raise psycopg2.OperationalError('Database connection pool exhausted')
+    try:
+        while True:
+            with _pool_lock:
+                if not _pools[target]:
+                    pool_stats[target]['misses'] += 1
+                    break
+                conn, last_used = _pools[target].pop()
+            if _conn_alive(conn, time.monotonic() - last_used):
+                with _pool_lock:
+                    pool_stats[target]['hits'] += 1
+                return conn
+            _discard_conn(conn)
+        conn = psycopg2.connect(DB_URLS[target], connection_factory=TimedConnection)
+        conn.pool_target = target
+        return conn
+    except Exception:
+        _pool_slots[target].release()
+        raise
+
+def put_conn(conn) -> None:
+    try:
+        if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        pass
+    try:
+        if conn.closed:
+            _discard_conn(conn)
+        else:
+            with _pool_lock:
+                _pools[conn.pool_target].append((conn, time.monotonic()))
+    finally:
+        _pool_slots[conn.pool_target].release()
+
+def pool_metrics() -> Dict[str, Any]:
+    with _pool_lock:
+        metrics: Dict[str, Any] = dict(pool_stats['primary'], idle=len(_pools['primary']), max=DB_POOL_MAX)
+        if READ_REPLICA:
+            metrics['replica'] = dict(pool_stats['replica'], idle=len(_pools['replica']), max=DB_POOL_MAX)
+        return metrics
+
+READ_REPLICA = bool(DB_URLS['replica'])
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', '1'))
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('REPLICA_LAG_CHECK_INTERVAL', '1'))
+# Clients that wrote this recently read from the primary. The window always
+# outlasts the worst replica lag still accepted (plus the time until it is
+# next probed), so once it ends the replica has the write
+READ_YOUR_WRITES_WINDOW = max(float(os.environ.get('READ_YOUR_WRITES_WINDOW', '5')),
+                              REPLICA_MAX_LAG + REPLICA_LAG_CHECK_INTERVAL)
+LAST_WRITE_HEADER = 'X-Last-Write'
+
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+# Last verdict on the replica, shared by all requests of this instance
+_replica_state: Dict[str, Any] = {'checked_at': float('-inf'), 'usable': False, 'reason': None, 'lag': None}
+read_routing_stats: Dict[str, int] = {'replica': 0, 'recent_write': 0, 'lagging': 0, 'unavailable': 0}
+
+def recent_write(event: Dict[str, Any]) -> bool:
+    token = request_header(event, LAST_WRITE_HEADER)
+    try:
+        age = time.time() - int(token) / 1000
+    except (TypeError, ValueError):
+        return False
+    return abs(age) < READ_YOUR_WRITES_WINDOW
+
+def _read_from_primary(reason: str):
+    with _pool_lock:
+        read_routing_stats[reason] += 1
+    annotate(db='primary', db_reason=reason)
+    return get_conn()
+
+def get_read_conn(event: Dict[str, Any]):
+    # Read-only branches use the replica unless the client wrote within the
+    # window or the replica lags or is down; that verdict is re-checked at
+    # most every REPLICA_LAG_CHECK_INTERVAL
+    if not READ_REPLICA:
+        return get_conn()
+    if recent_write(event):
+        return _read_from_primary('recent_write')
+    
+    probe = time.monotonic() - _replica_state['checked_at'] >= REPLICA_LAG_CHECK_INTERVAL
+    if not probe and not _replica_state['usable']:
+        return _read_from_primary(_replica_state['reason'])
+    
+    conn = None
+    try:
+        conn = get_conn('replica')
+        if probe:
+            with conn.cursor() as cur:
+                cur.execute(REPLICA_LAG_SQL)
+                lag = cur.fetchone()[0]
+            conn.rollback()
+    except psycopg2.Error:
+        if conn is not None:
+            put_conn(conn)
+        _replica_state.update(checked_at=time.monotonic(), usable=False, reason='unavailable', lag=None)
+        return _read_from_primary('unavailable')
+    
+    if probe:
+        usable = lag is not None and lag <= REPLICA_MAX_LAG
+        _replica_state.update(checked_at=time.monotonic(), usable=usable, reason=None if usable else 'lagging',
+                              lag=None if lag is None else float(lag))
+        if not usable:
+            put_conn(conn)
+            return _read_from_primary('lagging')
+    
+    with _pool_lock:
+        read_routing_stats['replica'] += 1
+    annotate(db='replica')
+    return conn
+
+def read_your_writes(fn):
+    # Successful writes return the time they happened; a client that sends it
+    # back in X-Last-Write reads its own write even while the replica lags
+    @functools.wraps(fn)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        response = fn(event, context)
+        if READ_REPLICA and event.get('httpMethod') != 'GET' and response['statusCode'] < 400:
+            response['headers'] = dict(response['headers'], **{
+                LAST_WRITE_HEADER: str(int(time.time() * 1000)),
+                'Access-Control-Expose-Headers': LAST_WRITE_HEADER
+            })
+        return response
+    return wrapper
+
+def read_routing_metrics() -> Dict[str, Any]:
+    with _pool_lock:
+        return dict(read_routing_stats, replica_usable=_replica_state['usable'], replica_lag=_replica_state['lag'])
+
+FUNCTION_NAME = 'students'
+REQUEST_LOG = os.environ.get('REQUEST_LOG', '1') != '0'
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+
+# Timings of the request being handled by the current thread
+_request_metrics = threading.local()
+
+def _metrics() -> Optional[Dict[str, Any]]:
+    return getattr(_request_metrics, 'current', None)
+
+def _add_timing(phase: str, elapsed: float) -> None:
+    metrics = _metrics()
+    if metrics is not None:
+        metrics[phase] += elapsed
+
+class TimedConnection(psycopg2.extensions.connection):
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            _add_timing('query', time.perf_counter() - started)
+    
+    def rollback(self):
+        started = time.perf_counter()
+        try:
+            return super().rollback()
+        finally:
+            _add_timing('query', time.perf_counter() - started)
+
+class TimedCursor(RealDictCursor):
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._record(time.perf_counter() - started)
+    
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._record(time.perf_counter() - started)
+    
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self._record(time.perf_counter() - started)
+    
+    def _record(self, elapsed: float) -> None:
+        metrics = _metrics()
+        if metrics is not None:
+            metrics['queries'] += 1
+            metrics['query'] += elapsed
+            metrics['slowest_query'] = max(metrics['slowest_query'], elapsed)
+
+def annotate(**fields: Any) -> None:
+    metrics = _metrics()
+    if metrics is not None:
+        metrics['fields'].update(fields)
+
+def record_error(error: Exception) -> None:
+    metrics = _metrics()
+    if metrics is not None:
+        import traceback
+        metrics['error'] = {'type': type(error).__name__, 'message': str(error), 'traceback': traceback.format_exc()}
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+def instrumented(fn):
+    @functools.wraps(fn)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        metrics = {
+            'connect': 0.0, 'query': 0.0, 'serialize': 0.0, 'slowest_query': 0.0,
+            'queries': 0, 'fields': {}, 'error': None
+        }
+        _request_metrics.current = metrics
+        started = time.perf_counter()
+        response = None
+        try:
+            response = fn(event, context)
+        finally:
+            total = time.perf_counter() - started
+            _request_metrics.current = None
+            if REQUEST_LOG:
+                record = {
+                    'ts': datetime.utcnow().isoformat(timespec='milliseconds') + 'Z',
+                    'function': FUNCTION_NAME,
+                    'request_id': getattr(context, 'request_id', None),
+                    'method': event.get('httpMethod'),
+                    'action': (event.get('queryStringParameters') or {}).get('action'),
+                    'status': response['statusCode'] if response else 500,
+                    'total_ms': _ms(total),
+                    'connect_ms': _ms(metrics['connect']),
+                    'query_ms': _ms(metrics['query']),
+                    'queries': metrics['queries'],
+                    'slowest_query_ms': _ms(metrics['slowest_query']),
+                    'serialize_ms': _ms(metrics['serialize'])
+                }
+                record.update(metrics['fields'])
+                if metrics['error']:
+                    record['error'] = metrics['error']
+                sys.stdout.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        
+        if SERVER_TIMING and response is not None:
+            response['headers'] = dict(response.get('headers') or {}, **{
+                'Server-Timing': (
+                    f"conn;dur={_ms(metrics['connect'])}, "
+                    f"db;dur={_ms(metrics['query'])};desc=\"{metrics['queries']} queries\", "
+                    f"ser;dur={_ms(metrics['serialize'])}, "
+                    f"total;dur={_ms(total)}"
+                ),
+                'Timing-Allow-Origin': '*'
+            })
+        return response
+    return wrapper
+
+GZIP_MIN_BYTES = int(os.environ.get('GZIP_MIN_BYTES', '1024'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '5'))
+
+# Shared by every response; never mutate these dicts in place
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+GZIP_JSON_HEADERS = dict(JSON_HEADERS, **{'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+OPTIONS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, X-Last-Write',
+    'Access-Control-Max-Age': '86400'
+}
+
+def json_default(obj):
     if isinstance(obj, Decimal):
         return float(obj)
-    if isinstance(obj, datetime):
+    if isinstance(obj, (datetime, date, dt_time)):
         return obj.isoformat()
-    raise TypeError
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+# orjson encodes dates and times natively and only calls json_default for
+# Decimal; the stdlib fallback reuses one encoder instead of building a new
+# JSONEncoder on every json.dumps call
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=json_default)
+
+def to_json(obj: Any) -> str:
+    started = time.perf_counter()
+    try:
+        if orjson is not None:
+            return orjson.dumps(obj, default=json_default).decode()
+        return _json_encoder.encode(obj)
+    finally:
+        _add_timing('serialize', time.perf_counter() - started)
+
+def request_header(event: Dict[str, Any], name: str) -> Optional[str]:
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+def accepts_gzip(event: Optional[Dict[str, Any]]) -> bool:
+    accept = request_header(event, 'Accept-Encoding') if event else None
+    return bool(accept) and 'gzip' in accept.lower()
+
+def gzip_body(body: str) -> str:
+    import gzip
+    started = time.perf_counter()
+    try:
+        return base64.b64encode(gzip.compress(body.encode(), compresslevel=GZIP_LEVEL, mtime=0)).decode()
+    finally:
+        _add_timing('serialize', time.perf_counter() - started)
+
+def respond(status: int, payload: Any, event: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # A str payload is taken to be serialized JSON already and passed through
+    body = payload if isinstance(payload, str) else to_json(payload)
+    if len(body) >= GZIP_MIN_BYTES and accepts_gzip(event):
+        return {
+            'statusCode': status,
+            'headers': GZIP_JSON_HEADERS,
+            'body': gzip_body(body),
+            'isBase64Encoded': True
+        }
+    return {
+        'statusCode': status,
+        'headers': JSON_HEADERS,
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+def respond_options() -> Dict[str, Any]:
+    return {
+        'statusCode': 200,
+        'headers': OPTIONS_HEADERS,
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+STUDENT_FIELDS = ('id', 'parent_id', 'full_name', 'birth_date', 'age', 'balance', 'created_at', 'updated_at')
+PAGE_LIMIT_DEFAULT = 50
+PAGE_LIMIT_MAX = 200
+PROFILE_BATCH_MAX = 50
+BULK_ENROLL_MAX = int(os.environ.get('BULK_ENROLL_MAX', '5000'))
+ATTENDANCE_STATUSES = ('present', 'absent', 'excused', 'upcoming')
+# Outbox channel for parent notifications; delivered by backend/notifications
+NOTIFY_CHANNEL = os.environ.get('NOTIFY_CHANNEL', 'email')
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', '2000'))
+# The whole gzipped export is held in memory and returned as one body
+EXPORT_MAX_ROWS = int(os.environ.get('EXPORT_MAX_ROWS', '50000'))
+EXPORT_FORMATS = ('csv', 'ndjson')
+# Per table: the SELECT to export and the column its from/to dates filter on
+EXPORT_QUERIES = {
+    'students': (
+        """SELECT s.id, s.parent_id, s.full_name, s.birth_date, s.age, s.balance, s.created_at, s.updated_at
+           FROM students s {where} ORDER BY s.id""",
+        's.created_at'
+    ),
+    'enrollments': (
+        """SELECT e.id, e.student_id, s.full_name AS student_name, e.course_id, c.title AS course_title,
+                  e.status, e.enrolled_at
+           FROM enrollments e
+           JOIN students s ON s.id = e.student_id
+           JOIN courses c ON c.id = e.course_id
+           {where} ORDER BY e.id""",
+        'e.enrolled_at'
+    ),
+    'attendance': (
+        """SELECT a.id, a.enrollment_id, e.student_id, s.full_name AS student_name, e.course_id,
+                  c.title AS course_title, a.lesson_date, a.lesson_time, a.status, a.absence_reason
+           FROM attendance a
+           JOIN enrollments e ON e.id = a.enrollment_id
+           JOIN students s ON s.id = e.student_id
+           JOIN courses c ON c.id = e.course_id
+           {where} ORDER BY a.lesson_date, a.id""",
+        'a.lesson_date'
+    )
+}
+IMPORT_MAX_ROWS = int(os.environ.get('IMPORT_MAX_ROWS', '20000'))
+IMPORT_DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y')
+PAYMENT_STATUSES = ('pending', 'completed', 'failed', 'refunded')
+# Allowed payment_status moves; only entering or leaving 'completed' changes the balance
+PAYMENT_TRANSITIONS = {
+    'pending': ('completed', 'failed'),
+    'completed': ('refunded',),
+    'failed': (),
+    'refunded': ()
+}
+
+
+def encode_cursor(full_name: str, student_id: int) -> str:
+    raw = json.dumps([full_name, student_id], ensure_ascii=False).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    padding = '=' * (-len(cursor) % 4)
+    try:
+        full_name, student_id = json.loads(base64.urlsafe_b64decode(cursor + padding).decode())
+        return str(full_name), int(student_id)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+
+def parse_fields(raw: Optional[str]) -> List[str]:
+    if not raw:
+        return list(STUDENT_FIELDS)
+    fields = [f.strip() for f in raw.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in STUDENT_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+def parse_limit(raw: Optional[str]) -> int:
+    if not raw:
+        return PAGE_LIMIT_DEFAULT
+    try:
+        limit = int(raw)
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    return max(1, min(limit, PAGE_LIMIT_MAX))
+
+def list_students_page(cursor, params: Dict[str, Any], parent_id: Optional[str]) -> Dict[str, Any]:
+    fields = parse_fields(params.get('fields'))
+    limit = parse_limit(params.get('limit'))
+    after = decode_cursor(params['cursor']) if params.get('cursor') else None
+    
+    # full_name and id are always read so the next cursor can be built,
+    # then dropped from the page if the caller did not ask for them
+    columns = fields + [f for f in ('full_name', 'id') if f not in fields]
+    conditions = []
+    values: List[Any] = []
+    if parent_id:
+        conditions.append("parent_id = %s")
+        values.append(parent_id)
+    if after:
+        conditions.append("(full_name, id) > (%s, %s)")
+        values.extend(after)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    values.append(limit + 1)
+    
+    # Served by idx_students_full_name_id / idx_students_parent_full_name_id
+    cursor.execute(
+        f"SELECT {', '.join(columns)} FROM students {where} ORDER BY full_name, id LIMIT %s",
+        values
+    )
+    rows = cursor.fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['full_name'], rows[-1]['id'])
+    
+    return {
+        'students': [{f: row[f] for f in fields} for row in rows],
+        'next_cursor': next_cursor
+    }
+
+def enroll_student(conn, cursor, student_id: int, course_id: int) -> Tuple[int, Dict[str, Any]]:
+    # Insert first and take the seat second, both in one statement: the
+    # UNIQUE(student_id, course_id) index serializes duplicate sign-ups and the
+    # conditional decrement re-checks available_spots on the locked course row,
+    # so concurrent enrollments can never oversell a course.
+    try:
+        cursor.execute("""
+            WITH enrolled AS (
+                INSERT INTO enrollments (student_id, course_id, status)
+                SELECT %(student_id)s, c.id, 'active'
+                FROM courses c
+                WHERE c.id = %(course_id)s AND c.available_spots > 0
+                ON CONFLICT (student_id, course_id) DO UPDATE
+                SET status = 'active', enrolled_at = CURRENT_TIMESTAMP
+                WHERE enrollments.status <> 'active'
+                RETURNING id, course_id
+            ),
+            seat AS (
+                UPDATE courses
+                SET available_spots = available_spots - 1, updated_at = CURRENT_TIMESTAMP
+                WHERE id = (SELECT course_id FROM enrolled) AND available_spots > 0
+                RETURNING id
+            ),
+            notified AS (
+                INSERT INTO notifications (user_id, type, subject, message)
+                SELECT s.parent_id, %(channel)s, 'Запись на курс',
+                       s.full_name || ' записан(а) на курс «' || c.title || '»'
+                FROM enrolled en
+                JOIN students s ON s.id = %(student_id)s
+                JOIN courses c ON c.id = en.course_id
+                WHERE s.parent_id IS NOT NULL
+            )
+            SELECT
+                (SELECT id FROM enrolled) AS enrollment_id,
+                EXISTS (SELECT 1 FROM seat) AS seat_taken
+        """, {'student_id': student_id, 'course_id': course_id, 'channel': NOTIFY_CHANNEL})
+    except ForeignKeyViolation:
+        conn.rollback()
+        return 404, {'error': 'Student not found'}
+    
+    outcome = cursor.fetchone()
+    if outcome['enrollment_id'] and outcome['seat_taken']:
+        conn.commit()
+        return 201, {'enrollment_id': outcome['enrollment_id'], 'message': 'Enrolled successfully'}
+    
+    # Slow path only: a fresh snapshot tells apart why nothing was enrolled
+    conn.rollback()
+    cursor.execute("""
+        SELECT
+            EXISTS (
+                SELECT 1 FROM enrollments
+                WHERE student_id = %(student_id)s AND course_id = %(course_id)s AND status = 'active'
+            ) AS already_enrolled,
+            (SELECT available_spots FROM courses WHERE id = %(course_id)s) AS available_spots
+    """, {'student_id': student_id, 'course_id': course_id})
+    state = cursor.fetchone()
+    
+    if state['already_enrolled']:
+        return 409, {'error': 'Student is already enrolled in this course'}
+    if state['available_spots'] is None:
+        return 404, {'error': 'Course not found'}
+    return 409, {'error': 'No available spots', 'waitlist': True}
+
+def join_waitlist(conn, cursor, student_id: int, course_id: int) -> Tuple[int, Dict[str, Any]]:
+    # The entry is queued first and the course promoted right after, in the
+    # same transaction: if a seat is free (or frees up meanwhile) the head
+    # of the queue, possibly this student, is enrolled straight away
+    try:
+        cursor.execute("""
+            INSERT INTO waitlist (course_id, student_id)
+            SELECT c.id, %(student_id)s
+            FROM courses c
+            WHERE c.id = %(course_id)s AND NOT EXISTS (
+                SELECT 1 FROM enrollments e
+                WHERE e.student_id = %(student_id)s AND e.course_id = c.id AND e.status = 'active'
+            )
+            ON CONFLICT (course_id, student_id) WHERE status = 'waiting' DO NOTHING
+            RETURNING id
+        """, {'student_id': student_id, 'course_id': course_id})
+    except ForeignKeyViolation:
+        conn.rollback()
+        return 404, {'error': 'Student not found'}
+    queued = cursor.fetchone()
+    
+    cursor.execute("SELECT * FROM promote_waitlist(%s, %s)", (course_id, NOTIFY_CHANNEL))
+    promoted = {row['student_id']: row['enrollment_id'] for row in cursor.fetchall()}
+    cursor.execute("""
+        SELECT
+            (SELECT id FROM courses WHERE id = %(course_id)s) AS course_id,
+            (SELECT count(*) FROM waitlist w
+             WHERE w.course_id = %(course_id)s AND w.status = 'waiting'
+               AND w.id <= (SELECT id FROM waitlist
+                            WHERE course_id = %(course_id)s AND student_id = %(student_id)s
+                              AND status = 'waiting')) AS position
+    """, {'student_id': student_id, 'course_id': course_id})
+    state = cursor.fetchone()
+    conn.commit()
+    
+    if state['course_id'] is None:
+        return 404, {'error': 'Course not found'}
+    if student_id in promoted:
+        return 201, {'status': 'enrolled', 'enrollment_id': promoted[student_id]}
+    if state['position']:
+        return (201 if queued else 200), {'status': 'waiting', 'position': state['position']}
+    return 409, {'error': 'Student is already enrolled in this course'}
+
+def leave_waitlist(conn, cursor, student_id: int, course_id: int) -> Tuple[int, Dict[str, Any]]:
+    cursor.execute("""
+        UPDATE waitlist SET status = 'cancelled'
+        WHERE course_id = %s AND student_id = %s AND status = 'waiting'
+        RETURNING id
+    """, (course_id, student_id))
+    left = cursor.fetchone()
+    conn.commit()
+    if not left:
+        return 404, {'error': 'Student is not on the waitlist'}
+    return 200, {'message': 'Removed from waitlist'}
+
+def cancel_enrollment(conn, cursor, student_id: int, course_id: int) -> Tuple[int, Dict[str, Any]]:
+    # Cancel and give the seat back, then let the waitlist take it before
+    # anyone else can: both happen in one transaction
+    cursor.execute("""
+        WITH cancelled AS (
+            UPDATE enrollments
+            SET status = 'cancelled'
+            WHERE student_id = %s AND course_id = %s AND status = 'active'
+            RETURNING id, course_id
+        )
+        UPDATE courses c
+        SET available_spots = LEAST(c.available_spots + 1, c.total_spots), updated_at = CURRENT_TIMESTAMP
+        FROM cancelled
+        WHERE c.id = cancelled.course_id
+        RETURNING cancelled.id
+    """, (student_id, course_id))
+    cancelled = cursor.fetchone()
+    if not cancelled:
+        conn.rollback()
+        return 404, {'error': 'Active enrollment not found'}
+    
+    cursor.execute("SELECT * FROM promote_waitlist(%s, %s)", (course_id, NOTIFY_CHANNEL))
+    promoted = cursor.fetchall()
+    conn.commit()
+    return 200, {
+        'enrollment_id': cancelled['id'],
+        'message': 'Enrollment cancelled',
+        'promoted': [dict(row) for row in promoted]
+    }
+
+def parse_profile_ids(student_id: Optional[str], student_ids: Optional[str]) -> List[int]:
+    raw = [student_id] if student_id else student_ids.split(',')
+    try:
+        ids = [int(i) for i in raw if str(i).strip()]
+    except ValueError:
+        raise ValueError('student_id must be an integer')
+    if not ids or len(ids) > PROFILE_BATCH_MAX:
+        raise ValueError(f'Pass between 1 and {PROFILE_BATCH_MAX} student ids')
+    return ids
+
+def fetch_profiles(cursor, ids: List[int]) -> List[str]:
+    # Postgres assembles each profile document itself; the ::text cast keeps
+    # psycopg2 from decoding it so the handler can pass it through as-is
+    cursor.execute("""
+        SELECT json_build_object(
+            'student', json_build_object(
+                'id', s.id,
+                'full_name', s.full_name,
+                'birth_date', to_char(s.birth_date, 'YYYY-MM-DD'),
+                'age', s.age,
+                'balance', s.balance,
+                'parent_id', s.parent_id,
+                'parent_name', u.full_name,
+                'parent_email', u.email,
+                'parent_phone', u.phone
+            ),
+            'courses', COALESCE((
+                SELECT json_agg(json_build_object(
+                    'id', c.id, 'title', c.title, 'image_emoji', c.image_emoji, 'schedule', c.schedule
+                ))
+                FROM enrollments e
+                JOIN courses c ON e.course_id = c.id
+                WHERE e.student_id = s.id AND e.status = 'active'
+            ), '[]'::json),
+            'attendance', COALESCE((
+                SELECT json_agg(recent.doc ORDER BY recent.lesson_date DESC)
+                FROM (
+                    SELECT a.lesson_date, json_build_object(
+                        'lesson_date', to_char(a.lesson_date, 'YYYY-MM-DD'),
+                        'lesson_time', a.lesson_time,
+                        'status', a.status,
+                        'absence_reason', a.absence_reason,
+                        'course_name', c.title
+                    ) AS doc
+                    FROM attendance a
+                    JOIN enrollments e ON a.enrollment_id = e.id
+                    JOIN courses c ON e.course_id = c.id
+                    WHERE e.student_id = s.id
+                    ORDER BY a.lesson_date DESC
+                    LIMIT 10
+                ) recent
+            ), '[]'::json)
+        )::text AS profile
+        FROM students s
+        LEFT JOIN users u ON s.parent_id = u.id
+        WHERE s.id = ANY(%s)
+        ORDER BY array_position(%s, s.id)
+    """, (ids, ids))
+    return [row['profile'] for row in cursor.fetchall()]
+
+def parse_enroll_pair(body: Dict[str, Any]) -> Tuple[int, int]:
+    try:
+        return int(body['student_id']), int(body['course_id'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('student_id and course_id must be integers')
+
+def parse_enroll_pairs(items: Any) -> List[Tuple[int, int]]:
+    if not isinstance(items, list) or not items:
+        raise ValueError('enrollments must be a non-empty list')
+    if len(items) > BULK_ENROLL_MAX:
+        raise ValueError(f'At most {BULK_ENROLL_MAX} enrollments per request')
+    pairs = []
+    for item in items:
+        try:
+            if isinstance(item, dict):
+                pairs.append((int(item['student_id']), int(item['course_id'])))
+            else:
+                student_id, course_id = item
+                pairs.append((int(student_id), int(course_id)))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Each enrollment needs integer student_id and course_id')
+    return pairs
+
+def bulk_enroll_students(conn, cursor, pairs: List[Tuple[int, int]]) -> List[Dict[str, Any]]:
+    # One statement for the whole batch. The affected course rows are locked
+    # in id order (so concurrent batches cannot deadlock on each other), fresh
+    # pairs are ranked per course in request order and only the first
+    # available_spots of them are inserted; each course is then decremented
+    # once by the number of rows actually inserted.
+    cursor.execute("""
+        WITH req AS (
+            SELECT r.ord, r.student_id, r.course_id
+            FROM unnest(%(students)s::int[], %(courses)s::int[]) WITH ORDINALITY AS r(student_id, course_id, ord)
+        ),
+        first_req AS (
+            SELECT DISTINCT ON (student_id, course_id) ord, student_id, course_id
+            FROM req
+            ORDER BY student_id, course_id, ord
+        ),
+        locked AS (
+            SELECT id, available_spots
+            FROM courses
+            WHERE id IN (SELECT course_id FROM req)
+            ORDER BY id
+            FOR UPDATE
+        ),
+        ranked AS (
+            SELECT f.ord, f.student_id, f.course_id,
+                   row_number() OVER (PARTITION BY f.course_id ORDER BY f.ord) AS rn
+            FROM first_req f
+            JOIN students s ON s.id = f.student_id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM enrollments e
+                WHERE e.student_id = f.student_id AND e.course_id = f.course_id AND e.status = 'active'
+            )
+        ),
+        granted AS (
+            SELECT r.ord, r.student_id, r.course_id
+            FROM ranked r
+            JOIN locked l ON l.id = r.course_id
+            WHERE r.rn <= l.available_spots
+        ),
+        inserted AS (
+            INSERT INTO enrollments (student_id, course_id, status)
+            SELECT student_id, course_id, 'active' FROM granted ORDER BY ord
+            ON CONFLICT (student_id, course_id) DO UPDATE
+            SET status = 'active', enrolled_at = CURRENT_TIMESTAMP
+            WHERE enrollments.status <> 'active'
+            RETURNING id, student_id, course_id
+        ),
+        taken AS (
+            UPDATE courses c
+            SET available_spots = c.available_spots - t.n, updated_at = CURRENT_TIMESTAMP
+            FROM (SELECT course_id, count(*) AS n FROM inserted GROUP BY course_id) t
+            WHERE c.id = t.course_id
+            RETURNING c.id
+        ),
+        notified AS (
+            INSERT INTO notifications (user_id, type, subject, message)
+            SELECT s.parent_id, %(channel)s, 'Запись на курс',
+                   s.full_name || ' записан(а) на курс «' || c.title || '»'
+            FROM inserted i
+            JOIN students s ON s.id = i.student_id
+            JOIN courses c ON c.id = i.course_id
+            WHERE s.parent_id IS NOT NULL
+        )
+        SELECT
+            r.student_id, r.course_id, i.id AS enrollment_id,
+            CASE
+                WHEN i.id IS NOT NULL THEN 'enrolled'
+                WHEN f.ord IS NULL THEN 'duplicate'
+                WHEN NOT EXISTS (SELECT 1 FROM students s WHERE s.id = r.student_id) THEN 'student_not_found'
+                WHEN NOT EXISTS (SELECT 1 FROM locked l WHERE l.id = r.course_id) THEN 'course_not_found'
+                WHEN g.ord IS NOT NULL OR EXISTS (
+                    SELECT 1 FROM enrollments e
+                    WHERE e.student_id = r.student_id AND e.course_id = r.course_id AND e.status = 'active'
+                ) THEN 'already_enrolled'
+                ELSE 'full'
+            END AS status
+        FROM req r
+        LEFT JOIN first_req f ON f.ord = r.ord
+        LEFT JOIN granted g ON g.ord = r.ord
+        LEFT JOIN inserted i ON f.ord IS NOT NULL AND i.student_id = r.student_id AND i.course_id = r.course_id
+        ORDER BY r.ord
+    """, {'students': [p[0] for p in pairs], 'courses': [p[1] for p in pairs], 'channel': NOTIFY_CHANNEL})
+    results = [dict(row) for row in cursor.fetchall()]
+    conn.commit()
+    return results
+
+def parse_attendance(body: Dict[str, Any]) -> Dict[str, Any]:
+    course_id = body.get('course_id')
+    lesson_date = body.get('lesson_date')
+    lesson_time = body.get('lesson_time')
+    if not all([course_id, lesson_date, lesson_time]):
+        raise ValueError('course_id, lesson_date and lesson_time are required')
+    try:
+        course_id = int(course_id)
+    except (TypeError, ValueError):
+        raise ValueError('course_id must be an integer')
+    try:
+        lesson_date = date.fromisoformat(lesson_date)
+    except (TypeError, ValueError):
+        raise ValueError('lesson_date must be YYYY-MM-DD')
+    
+    default_status = body.get('default_status', 'present')
+    marks = body.get('marks') or []
+    if not isinstance(marks, list):
+        raise ValueError('marks must be a list')
+    
+    # Keyed by student so a repeated mark cannot hit the same row twice in the upsert
+    by_student: Dict[int, Tuple[str, Optional[str]]] = {}
+    for mark in marks:
+        try:
+            student_id = int(mark['student_id'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Each mark needs an integer student_id')
+        by_student[student_id] = (mark.get('status', default_status), mark.get('absence_reason'))
+    
+    for status in [m[0] for m in by_student.values()] + [default_status]:
+        if status not in ATTENDANCE_STATUSES:
+            raise ValueError(f"status must be one of: {', '.join(ATTENDANCE_STATUSES)}")
+    
+    return {
+        'course_id': course_id,
+        'lesson_date': lesson_date,
+        'lesson_time': lesson_time,
+        'default_status': default_status,
+        'students': list(by_student),
+        'statuses': [m[0] for m in by_student.values()],
+        'reasons': [m[1] for m in by_student.values()],
+        'channel': NOTIFY_CHANNEL
+    }
+
+def mark_attendance(conn, cursor, session: Dict[str, Any]) -> Dict[str, Any]:
+    # The whole class is written by one upsert: every active enrollment of the
+    # course gets a row, explicit marks override default_status, and a repeated
+    # submission for the same lesson updates the rows in place through the
+    # unique (enrollment_id, lesson_date, lesson_time) index.
+    cursor.execute("""
+        WITH marks AS (
+            SELECT * FROM unnest(%(students)s::int[], %(statuses)s::text[], %(reasons)s::text[])
+                AS m(student_id, status, absence_reason)
+        ),
+        roster AS (
+            SELECT e.id AS enrollment_id, e.student_id,
+                   COALESCE(m.status, %(default_status)s) AS status,
+                   m.absence_reason, a.status AS previous_status
+            FROM enrollments e
+            LEFT JOIN marks m ON m.student_id = e.student_id
+            LEFT JOIN attendance a ON a.enrollment_id = e.id
+                 AND a.lesson_date = %(lesson_date)s AND a.lesson_time = %(lesson_time)s
+            WHERE e.course_id = %(course_id)s AND e.status = 'active'
+        ),
+        written AS (
+            INSERT INTO attendance (enrollment_id, lesson_date, lesson_time, status, absence_reason)
+            SELECT enrollment_id, %(lesson_date)s, %(lesson_time)s, status,
+                   CASE WHEN status = 'present' THEN NULL ELSE absence_reason END
+            FROM roster
+            ON CONFLICT (enrollment_id, lesson_date, lesson_time) DO UPDATE
+            SET status = EXCLUDED.status,
+                absence_reason = EXCLUDED.absence_reason,
+                updated_at = CURRENT_TIMESTAMP
+            RETURNING enrollment_id
+        ),
+        notified AS (
+            -- Parents hear about an absence once, when the mark first turns absent
+            INSERT INTO notifications (user_id, type, subject, message)
+            SELECT s.parent_id, %(channel)s, 'Пропуск занятия',
+                   s.full_name || ' отсутствовал(а) на занятии «' || c.title || '» '
+                       || to_char(%(lesson_date)s::date, 'DD.MM.YYYY') || ' ' || %(lesson_time)s
+                       || COALESCE(' (' || r.absence_reason || ')', '')
+            FROM roster r
+            JOIN students s ON s.id = r.student_id
+            JOIN courses c ON c.id = %(course_id)s
+            WHERE r.status = 'absent' AND r.previous_status IS DISTINCT FROM 'absent'
+              AND s.parent_id IS NOT NULL
+        )
+        SELECT r.student_id, r.enrollment_id, r.status
+        FROM roster r
+        JOIN written w ON w.enrollment_id = r.enrollment_id
+        ORDER BY r.student_id
+    """, session)
+    results = [dict(row) for row in cursor.fetchall()]
+    conn.commit()
+    
+    marked = {r['student_id'] for r in results}
+    return {
+        'course_id': session['course_id'],
+        'lesson_date': session['lesson_date'].isoformat(),
+        'lesson_time': session['lesson_time'],
+        'marked': len(results),
+        'results': results,
+        'not_enrolled': sorted({s for s in session['students'] if s not in marked})
+    }
+
+def parse_payment(body: Dict[str, Any]) -> Dict[str, Any]:
+    transaction_id = body.get('transaction_id')
+    if not isinstance(transaction_id, str) or not transaction_id.strip() or len(transaction_id) > 255:
+        raise ValueError('transaction_id is required')
+    try:
+        student_id = int(body['student_id'])
+        amount = Decimal(str(body['amount']))
+        lessons = int(body['lessons_purchased'])
+    except (KeyError, TypeError, ValueError, ArithmeticError):
+        raise ValueError('student_id, amount and lessons_purchased are required numbers')
+    if amount <= 0 or lessons <= 0:
+        raise ValueError('amount and lessons_purchased must be positive')
+    status = body.get('payment_status', 'completed')
+    if status not in ('pending', 'completed'):
+        raise ValueError('payment_status must be pending or completed')
+    method = body.get('payment_method')
+    if method is not None and (not isinstance(method, str) or len(method) > 100):
+        raise ValueError('payment_method must be a string of at most 100 characters')
+    return {
+        'transaction_id': transaction_id.strip(),
+        'student_id': student_id,
+        'amount': amount,
+        'lessons_purchased': lessons,
+        'payment_method': method,
+        'payment_status': status
+    }
+
+def record_payment(conn, cursor, payment: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+    # The ledger row and the cached balance move in one statement. A replayed
+    # transaction_id hits the unique index and inserts nothing, so the
+    # balance is only ever adjusted once per payment.
+    try:
+        cursor.execute("""
+            WITH inserted AS (
+                INSERT INTO payments (student_id, amount, lessons_purchased, payment_method,
+                                      payment_status, transaction_id, paid_at)
+                VALUES (%(student_id)s, %(amount)s, %(lessons_purchased)s, %(payment_method)s,
+                        %(payment_status)s, %(transaction_id)s,
+                        CASE WHEN %(payment_status)s = 'completed' THEN CURRENT_TIMESTAMP END)
+                ON CONFLICT (transaction_id) WHERE transaction_id IS NOT NULL DO NOTHING
+                RETURNING *
+            ),
+            credited AS (
+                UPDATE students s
+                SET balance = s.balance + i.lessons_purchased, updated_at = CURRENT_TIMESTAMP
+                FROM inserted i
+                WHERE s.id = i.student_id AND i.payment_status = 'completed'
+                RETURNING s.balance
+            )
+            SELECT i.*, (SELECT balance FROM credited) AS balance
+            FROM inserted i
+        """, payment)
+    except ForeignKeyViolation:
+        conn.rollback()
+        return 404, {'error': 'Student not found'}
+    
+    created = cursor.fetchone()
+    conn.commit()
+    if created:
+        return 201, dict(created)
+    
+    cursor.execute("SELECT * FROM payments WHERE transaction_id = %s", (payment['transaction_id'],))
+    existing = cursor.fetchone()
+    if (existing['student_id'], existing['amount'], existing['lessons_purchased']) != \
+            (payment['student_id'], payment['amount'], payment['lessons_purchased']):
+        return 409, {'error': 'transaction_id already used for a different payment'}
+    return 200, dict(existing, replayed=True)
+
+def update_payment_status(conn, cursor, transaction_id: str, status: str) -> Tuple[int, Dict[str, Any]]:
+    if status not in PAYMENT_STATUSES:
+        raise ValueError(f"payment_status must be one of: {', '.join(PAYMENT_STATUSES)}")
+    allowed = [old for old, targets in PAYMENT_TRANSITIONS.items() if status in targets]
+    # The payment row lock orders concurrent status changes; the balance
+    # gains lessons_purchased when the payment becomes completed and loses
+    # them when it stops being completed
+    cursor.execute("""
+        WITH current AS (
+            SELECT id, payment_status FROM payments WHERE transaction_id = %(transaction_id)s FOR UPDATE
+        ),
+        changed AS (
+            UPDATE payments p
+            SET payment_status = %(status)s,
+                paid_at = CASE WHEN %(status)s = 'completed' THEN CURRENT_TIMESTAMP ELSE p.paid_at END
+            FROM current c
+            WHERE p.id = c.id AND c.payment_status = ANY(%(allowed)s)
+            RETURNING p.*, c.payment_status AS previous_status
+        ),
+        adjusted AS (
+            UPDATE students s
+            SET balance = s.balance + ch.lessons_purchased * (
+                    CASE WHEN ch.payment_status = 'completed' THEN 1 ELSE 0 END -
+                    CASE WHEN ch.previous_status = 'completed' THEN 1 ELSE 0 END
+                ),
+                updated_at = CURRENT_TIMESTAMP
+            FROM changed ch
+            WHERE s.id = ch.student_id
+            RETURNING s.balance
+        )
+        SELECT
+            (SELECT payment_status FROM current) AS current_status,
+            (SELECT row_to_json(ch) FROM changed ch) AS payment,
+            (SELECT balance FROM adjusted) AS balance
+    """, {'transaction_id': transaction_id, 'status': status, 'allowed': allowed})
+    outcome = cursor.fetchone()
+    conn.commit()
+    
+    if outcome['current_status'] is None:
+        return 404, {'error': 'Payment not found'}
+    if outcome['payment'] is None:
+        if outcome['current_status'] == status:
+            return 200, {'transaction_id': transaction_id, 'payment_status': status, 'unchanged': True}
+        return 409, {'error': f"Cannot change payment from {outcome['current_status']} to {status}"}
+    return 200, dict(outcome['payment'], balance=outcome['balance'])
+
+def reconcile_balances(conn, cursor, fix: bool) -> Dict[str, Any]:
+    # One pass over the ledger: completed payments are summed per student and
+    # compared with the cached balance. With fix the drifted rows are reset,
+    # but only if their balance is still the one that was compared, so a
+    # payment landing concurrently is never overwritten.
+    cursor.execute("""
+        WITH ledger AS (
+            SELECT student_id, sum(lessons_purchased) AS lessons
+            FROM payments
+            WHERE payment_status = 'completed'
+            GROUP BY student_id
+        ),
+        drift AS (
+            SELECT s.id AS student_id, s.balance, COALESCE(l.lessons, 0)::int AS expected
+            FROM students s
+            LEFT JOIN ledger l ON l.student_id = s.id
+            WHERE s.balance IS DISTINCT FROM COALESCE(l.lessons, 0)
+        ),
+        fixed AS (
+            UPDATE students s
+            SET balance = d.expected, updated_at = CURRENT_TIMESTAMP
+            FROM drift d
+            WHERE %(fix)s AND s.id = d.student_id AND s.balance IS NOT DISTINCT FROM d.balance
+            RETURNING s.id
+        )
+        SELECT d.student_id, d.balance, d.expected, d.expected - d.balance AS difference,
+               EXISTS (SELECT 1 FROM fixed f WHERE f.id = d.student_id) AS fixed
+        FROM drift d
+        ORDER BY d.student_id
+    """, {'fix': fix})
+    drift = [dict(row) for row in cursor.fetchall()]
+    conn.commit()
+    return {'drifted': len(drift), 'fixed': sum(1 for d in drift if d['fixed']), 'students': drift}
+
+class GzipSink:
+    # File-like target for COPY and the NDJSON writer: every chunk is
+    # compressed as it arrives, so only the compressed export is held
+    def __init__(self):
+        import gzip
+        self.buffer = io.BytesIO()
+        self.gzip = gzip.GzipFile(fileobj=self.buffer, mode='wb', compresslevel=GZIP_LEVEL, mtime=0)
+        self.raw_bytes = 0
+    
+    def write(self, data: Any) -> int:
+        if isinstance(data, str):
+            data = data.encode()
+        self.raw_bytes += len(data)
+        return self.gzip.write(data)
+    
+    def close(self) -> bytes:
+        self.gzip.close()
+        return self.buffer.getvalue()
+
+def parse_export(params: Dict[str, Any]) -> Dict[str, Any]:
+    table = params.get('table', 'students')
+    if table not in EXPORT_QUERIES:
+        raise ValueError(f"table must be one of: {', '.join(EXPORT_QUERIES)}")
+    export_format = params.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of: {', '.join(EXPORT_FORMATS)}")
+    try:
+        date_from = date.fromisoformat(params['from']) if params.get('from') else None
+        date_to = date.fromisoformat(params['to']) if params.get('to') else None
+    except ValueError:
+        raise ValueError('from and to must be YYYY-MM-DD')
+    return {'table': table, 'format': export_format, 'from': date_from, 'to': date_to}
+
+def export_rows(conn, cursor, export: Dict[str, Any], sink: GzipSink) -> int:
+    # Returns the number of rows written. One row past EXPORT_MAX_ROWS is
+    # fetched so the caller can tell a full export from a truncated one
+    query, date_column = EXPORT_QUERIES[export['table']]
+    conditions = []
+    if export['from']:
+        conditions.append(f"{date_column} >= %(from)s")
+    if export['to']:
+        conditions.append(f"{date_column} < %(to)s::date + 1")
+    query = query.format(where=f"WHERE {' AND '.join(conditions)}" if conditions else '') + ' LIMIT %(limit)s'
+    query = cursor.mogrify(query, {'from': export['from'], 'to': export['to'], 'limit': EXPORT_MAX_ROWS + 1}).decode()
+    
+    if export['format'] == 'csv':
+        # Postgres streams the CSV straight into the gzip sink
+        cursor.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)', sink)
+        return cursor.rowcount
+    
+    # NDJSON: a server-side cursor hands over EXPORT_CHUNK_ROWS rows at a
+    # time, each already rendered as JSON text by Postgres
+    named = conn.cursor(name='students_export', cursor_factory=TimedCursor)
+    named.itersize = EXPORT_CHUNK_ROWS
+    written = 0
+    try:
+        named.execute(f'SELECT row_to_json(t)::text AS line FROM ({query}) t')
+        while True:
+            rows = named.fetchmany(EXPORT_CHUNK_ROWS)
+            if not rows:
+                break
+            sink.write('\n'.join(row['line'] for row in rows) + '\n')
+            written += len(rows)
+    finally:
+        named.close()
+    return written
+
+def respond_export(export: Dict[str, Any], sink: GzipSink, event: Dict[str, Any]) -> Dict[str, Any]:
+    body = sink.close()
+    filename = f"{export['table']}.{export['format']}"
+    content_type = 'text/csv; charset=utf-8' if export['format'] == 'csv' else 'application/x-ndjson'
+    annotate(export_rows_bytes=sink.raw_bytes, export_gzip_bytes=len(body))
+    if accepts_gzip(event):
+        headers = {
+            'Content-Type': content_type,
+            'Content-Encoding': 'gzip',
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Vary': 'Accept-Encoding',
+            'Access-Control-Allow-Origin': '*'
+        }
+    else:
+        headers = {
+            'Content-Type': 'application/gzip',
+            'Content-Disposition': f'attachment; filename="{filename}.gz"',
+            'Access-Control-Allow-Origin': '*'
+        }
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': base64.b64encode(body).decode(),
+        'isBase64Encoded': True
+    }
+
+def import_records(body: Dict[str, Any]) -> Any:
+    # CSV rows are produced lazily by DictReader; JSON arrives as a list
+    if isinstance(body.get('csv'), str):
+        return csv.DictReader(io.StringIO(body['csv']))
+    if isinstance(body.get('students'), list):
+        return body['students']
+    raise ValueError('Pass students as a csv string or a students list')
+
+def parse_birth_date(value: Any) -> Optional[date]:
+    if value in (None, ''):
+        return None
+    for fmt in IMPORT_DATE_FORMATS:
+        try:
+            return datetime.strptime(str(value).strip(), fmt).date()
+        except ValueError:
+            continue
+    raise ValueError('birth_date must be YYYY-MM-DD or DD.MM.YYYY')
+
+def validate_import(records: Any) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    rows: List[Dict[str, Any]] = []
+    errors: List[Dict[str, Any]] = []
+    for row_no, record in enumerate(records, start=1):
+        if row_no > IMPORT_MAX_ROWS:
+            raise ValueError(f'At most {IMPORT_MAX_ROWS} students per import')
+        if not isinstance(record, dict):
+            errors.append({'row': row_no, 'errors': ['Row must be an object']})
+            continue
+        problems = []
+        full_name = str(record.get('full_name') or '').strip()
+        if not full_name:
+            problems.append('full_name is required')
+        elif len(full_name) > 255:
+            problems.append('full_name is longer than 255 characters')
+        try:
+            birth_date = parse_birth_date(record.get('birth_date'))
+        except ValueError as e:
+            problems.append(str(e))
+            birth_date = None
+        parent_id = None
+        parent_email = str(record.get('parent_email') or '').strip().lower() or None
+        if record.get('parent_id') not in (None, ''):
+            try:
+                parent_id = int(record['parent_id'])
+            except (TypeError, ValueError):
+                problems.append('parent_id must be an integer')
+        elif not parent_email:
+            problems.append('parent_id or parent_email is required')
+        if problems:
+            errors.append({'row': row_no, 'errors': problems})
+            continue
+        rows.append({
+            'row': row_no, 'parent_id': parent_id, 'parent_email': parent_email,
+            'full_name': full_name, 'birth_date': birth_date
+        })
+    return rows, errors
+
+def resolve_parents(cursor, rows: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    ids = sorted({r['parent_id'] for r in rows if r['parent_id'] is not None})
+    emails = sorted({r['parent_email'] for r in rows if r['parent_id'] is None})
+    cursor.execute(
+        "SELECT id, lower(email) AS email FROM users WHERE id = ANY(%s) OR lower(email) = ANY(%s)",
+        (ids, emails)
+    )
+    known_ids = set()
+    by_email = {}
+    for user in cursor.fetchall():
+        known_ids.add(user['id'])
+        by_email[user['email']] = user['id']
+    
+    resolved, errors = [], []
+    for r in rows:
+        parent_id = r['parent_id'] if r['parent_id'] in known_ids else by_email.get(r['parent_email'])
+        if parent_id is None:
+            errors.append({'row': r['row'], 'errors': ['Parent not found']})
+        else:
+            resolved.append(dict(r, parent_id=parent_id))
+    return resolved, errors
+
+def import_students(conn, cursor, rows: List[Dict[str, Any]], dry_run: bool) -> Dict[str, Any]:
+    # Valid rows go through COPY into a transaction-scoped staging table and
+    # are merged by one INSERT ... SELECT. Repeats inside the batch and
+    # students that already exist (same parent, name and birth date) are
+    # skipped, so re-running an import is harmless.
+    cursor.execute("""
+        CREATE TEMP TABLE students_import (
+            row_no INTEGER, parent_id INTEGER, full_name TEXT, birth_date DATE
+        ) ON COMMIT DROP
+    """)
+    staged = io.StringIO()
+    writer = csv.writer(staged)
+    for r in rows:
+        writer.writerow((r['row'], r['parent_id'], r['full_name'], r['birth_date'] or ''))
+    staged.seek(0)
+    cursor.copy_expert(
+        "COPY students_import (row_no, parent_id, full_name, birth_date) FROM STDIN WITH (FORMAT csv)",
+        staged
+    )
+    
+    cursor.execute("""
+        WITH first_rows AS (
+            SELECT DISTINCT ON (parent_id, full_name, birth_date) row_no, parent_id, full_name, birth_date
+            FROM students_import
+            ORDER BY parent_id, full_name, birth_date, row_no
+        ),
+        fresh AS (
+            SELECT f.*
+            FROM first_rows f
+            WHERE NOT EXISTS (
+                SELECT 1 FROM students s
+                WHERE s.parent_id = f.parent_id AND s.full_name = f.full_name
+                  AND s.birth_date IS NOT DISTINCT FROM f.birth_date
+            )
+        ),
+        inserted AS (
+            INSERT INTO students (parent_id, full_name, birth_date, age, balance)
+            SELECT parent_id, full_name, birth_date,
+                   date_part('year', age(CURRENT_DATE, birth_date))::int, 0
+            FROM fresh
+            ORDER BY row_no
+            RETURNING id, parent_id, full_name, birth_date
+        )
+        SELECT i.row_no,
+               n.id AS student_id,
+               CASE
+                   WHEN n.id IS NOT NULL THEN 'imported'
+                   WHEN f.row_no IS NULL THEN 'duplicate'
+                   ELSE 'exists'
+               END AS status
+        FROM students_import i
+        LEFT JOIN first_rows f ON f.row_no = i.row_no
+        LEFT JOIN inserted n ON f.row_no IS NOT NULL AND n.parent_id = i.parent_id
+             AND n.full_name = i.full_name AND n.birth_date IS NOT DISTINCT FROM i.birth_date
+        ORDER BY i.row_no
+    """)
+    results = cursor.fetchall()
+    if dry_run:
+        conn.rollback()
+    else:
+        conn.commit()
+    
+    imported = [{'row': r['row_no'], 'student_id': r['student_id']} for r in results if r['status'] == 'imported']
+    return {
+        'imported': len(imported),
+        'students': [] if dry_run else imported,
+        'skipped': [{'row': r['row_no'], 'reason': r['status']} for r in results if r['status'] != 'imported']
+    }
 
+@instrumented
+@read_your_writes
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Student management and enrollment API
@@ -23,22 +1338,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return respond_options()
     
+    conn = None
     try:
-        db_url = os.environ.get('DATABASE_URL')
-        conn = psycopg2.connect(db_url)
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        conn = get_read_conn(event) if method == 'GET' else get_conn()
+        cursor = conn.cursor(cursor_factory=TimedCursor)
         
         if method == 'GET':
             params = event.get('queryStringParameters') or {}
@@ -46,144 +1351,138 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             student_id = params.get('student_id')
             parent_id = params.get('parent_id')
             
-            if action == 'profile' and student_id:
-                cursor.execute("""
-                    SELECT 
-                        s.id, s.full_name, 
-                        to_char(s.birth_date, 'YYYY-MM-DD') as birth_date,
-                        s.age, s.balance, s.parent_id,
-                        u.full_name as parent_name, u.email as parent_email, u.phone as parent_phone
-                    FROM students s
-                    LEFT JOIN users u ON s.parent_id = u.id
-                    WHERE s.id = %s
-                """, (student_id,))
-                student = cursor.fetchone()
-                
-                if not student:
-                    conn.close()
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Student not found'}),
-                        'isBase64Encoded': False
-                    }
+            if action == 'export':
+                try:
+                    export = parse_export(params)
+                except ValueError as e:
+                    return respond(400, {'error': str(e)}, event)
                 
-                cursor.execute("""
-                    SELECT c.id, c.title, c.image_emoji, c.schedule
-                    FROM enrollments e
-                    JOIN courses c ON e.course_id = c.id
-                    WHERE e.student_id = %s AND e.status = 'active'
-                """, (student_id,))
-                courses = cursor.fetchall()
+                sink = GzipSink()
+                if export_rows(conn, cursor, export, sink) > EXPORT_MAX_ROWS:
+                    return respond(413, {
+                        'error': f'Export exceeds {EXPORT_MAX_ROWS} rows, narrow it with from and to'
+                    }, event)
                 
-                cursor.execute("""
-                    SELECT 
-                        to_char(a.lesson_date, 'YYYY-MM-DD') as lesson_date, 
-                        a.lesson_time, a.status, a.absence_reason,
-                        c.title as course_name
-                    FROM attendance a
-                    JOIN enrollments e ON a.enrollment_id = e.id
-                    JOIN courses c ON e.course_id = c.id
-                    WHERE e.student_id = %s
-                    ORDER BY a.lesson_date DESC
-                    LIMIT 10
-                """, (student_id,))
-                attendance = cursor.fetchall()
+                return respond_export(export, sink, event)
+            
+            elif action == 'profile' and (student_id or params.get('student_ids')):
+                try:
+                    ids = parse_profile_ids(student_id, params.get('student_ids'))
+                except ValueError as e:
+                    return respond(400, {'error': str(e)}, event)
                 
-                conn.close()
+                profiles = fetch_profiles(cursor, ids)
                 
-                result = {
-                    'student': dict(student),
-                    'courses': [dict(c) for c in courses],
-                    'attendance': [dict(a) for a in attendance]
-                }
+                if student_id:
+                    if not profiles:
+                        return respond(404, {'error': 'Student not found'}, event)
+                    body = profiles[0]
+                else:
+                    body = '{"profiles": [' + ','.join(profiles) + ']}'
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(result, default=decimal_default),
-                    'isBase64Encoded': False
-                }
-            
-            elif parent_id:
-                cursor.execute("""
-                    SELECT * FROM students WHERE parent_id = %s
-                """, (parent_id,))
-                students = cursor.fetchall()
-                conn.close()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps([dict(s) for s in students], default=decimal_default),
-                    'isBase64Encoded': False
-                }
+                return respond(200, body, event)
             
             else:
-                cursor.execute("SELECT * FROM students ORDER BY full_name")
-                students = cursor.fetchall()
-                conn.close()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps([dict(s) for s in students], default=decimal_default),
-                    'isBase64Encoded': False
-                }
+                try:
+                    page = list_students_page(cursor, params, parent_id)
+                except ValueError as e:
+                    return respond(400, {'error': str(e)}, event)
+                
+                return respond(200, page, event)
         
         elif method == 'POST':
             body = json.loads(event.get('body', '{}'))
             action = body.get('action', 'create')
+            annotate(action=action)
             
             if action == 'enroll':
-                student_id = body.get('student_id')
-                course_id = body.get('course_id')
-                
-                if not all([student_id, course_id]):
-                    conn.close()
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'student_id and course_id are required'}),
-                        'isBase64Encoded': False
-                    }
+                try:
+                    student_id, course_id = parse_enroll_pair(body)
+                except ValueError as e:
+                    return respond(400, {'error': str(e)}, event)
                 
-                cursor.execute("""
-                    SELECT available_spots FROM courses WHERE id = %s
-                """, (course_id,))
-                course = cursor.fetchone()
-                
-                if not course or course['available_spots'] <= 0:
-                    conn.close()
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'No available spots'}),
-                        'isBase64Encoded': False
-                    }
+                status, result = enroll_student(conn, cursor, student_id, course_id)
                 
-                cursor.execute("""
-                    INSERT INTO enrollments (student_id, course_id, status)
-                    VALUES (%s, %s, 'active')
-                    RETURNING id
-                """, (student_id, course_id))
+                return respond(status, result, event)
+            
+            elif action in ('join_waitlist', 'leave_waitlist', 'cancel_enrollment'):
+                try:
+                    student_id, course_id = parse_enroll_pair(body)
+                except ValueError as e:
+                    return respond(400, {'error': str(e)}, event)
                 
-                enrollment = cursor.fetchone()
+                operation = {
+                    'join_waitlist': join_waitlist,
+                    'leave_waitlist': leave_waitlist,
+                    'cancel_enrollment': cancel_enrollment
+                }[action]
+                status, result = operation(conn, cursor, student_id, course_id)
                 
-                cursor.execute("""
-                    UPDATE courses SET available_spots = available_spots - 1
-                    WHERE id = %s
-                """, (course_id,))
+                return respond(status, result, event)
+            
+            elif action == 'bulk_enroll':
+                try:
+                    pairs = parse_enroll_pairs(body.get('enrollments'))
+                except ValueError as e:
+                    return respond(400, {'error': str(e)}, event)
                 
-                conn.commit()
-                conn.close()
+                results = bulk_enroll_students(conn, cursor, pairs)
                 
-                return {
-                    'statusCode': 201,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'enrollment_id': enrollment['id'], 'message': 'Enrolled successfully'}),
-                    'isBase64Encoded': False
-                }
+                return respond(200, {
+                    'enrolled': sum(1 for r in results if r['status'] == 'enrolled'),
+                    'results': results
+                }, event)
+            
+            elif action == 'mark_attendance':
+                try:
+                    session = parse_attendance(body)
+                except ValueError as e:
+                    return respond(400, {'error': str(e)}, event)
+                
+                result = mark_attendance(conn, cursor, session)
+                
+                return respond(200, result, event)
+            
+            elif action == 'import':
+                try:
+                    rows, errors = validate_import(import_records(body))
+                except (ValueError, csv.Error) as e:
+                    return respond(400, {'error': str(e)}, event)
+                
+                rows, parent_errors = resolve_parents(cursor, rows)
+                errors = sorted(errors + parent_errors, key=lambda e: e['row'])
+                
+                report = import_students(conn, cursor, rows, bool(body.get('dry_run')))
+                report.update(received=len(rows) + len(errors), dry_run=bool(body.get('dry_run')), errors=errors)
+                annotate(import_rows=report['received'], imported=report['imported'])
+                
+                return respond(200, report, event)
+            
+            elif action == 'payment':
+                try:
+                    payment = parse_payment(body)
+                except ValueError as e:
+                    return respond(400, {'error': str(e)}, event)
+                
+                status, result = record_payment(conn, cursor, payment)
+                
+                return respond(status, result, event)
+            
+            elif action == 'payment_status':
+                if not body.get('transaction_id') or not body.get('payment_status'):
+                    return respond(400, {'error': 'transaction_id and payment_status are required'}, event)
+                
+                try:
+                    status, result = update_payment_status(conn, cursor, str(body['transaction_id']), body['payment_status'])
+                except ValueError as e:
+                    return respond(400, {'error': str(e)}, event)
+                
+                return respond(status, result, event)
+            
+            elif action == 'reconcile_balances':
+                result = reconcile_balances(conn, cursor, bool(body.get('fix')))
+                
+                return respond(200, result, event)
             
             else:
                 parent_id = body.get('parent_id')
@@ -192,13 +1491,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 age = body.get('age')
                 
                 if not all([parent_id, full_name]):
-                    conn.close()
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'parent_id and full_name are required'}),
-                        'isBase64Encoded': False
-                    }
+                    return respond(400, {'error': 'parent_id and full_name are required'}, event)
                 
                 cursor.execute("""
                     INSERT INTO students (parent_id, full_name, birth_date, age, balance)
@@ -208,28 +1501,15 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 student = cursor.fetchone()
                 conn.commit()
-                conn.close()
                 
-                return {
-                    'statusCode': 201,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(dict(student), default=decimal_default),
-                    'isBase64Encoded': False
-                }
+                return respond(201, student, event)
         
         else:
-            conn.close()
-            return {
-                'statusCode': 405,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
+            return respond(405, {'error': 'Method not allowed'}, event)
     
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
\ No newline at end of file
+        record_error(e)
+        return respond(500, {'error': 'Internal server error'}, event)
+    finally:
+        if conn is not None:
+            put_conn(conn)
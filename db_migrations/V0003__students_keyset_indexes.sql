@@ -0,0 +1,7 @@
+-- Keyset pagination indexes for the student list endpoints
+-- (ORDER BY full_name, id with a (full_name, id) > cursor predicate)
+CREATE INDEX idx_students_full_name_id ON students(full_name, id);
+CREATE INDEX idx_students_parent_full_name_id ON students(parent_id, full_name, id);
+
+-- Covered by idx_students_parent_full_name_id
+DROP INDEX idx_students_parent;
@@ -0,0 +1,6 @@
+-- One attendance row per enrollment and lesson; target of the bulk
+-- attendance upsert (ON CONFLICT (enrollment_id, lesson_date, lesson_time))
+CREATE UNIQUE INDEX idx_attendance_enrollment_lesson ON attendance(enrollment_id, lesson_date, lesson_time);
+
+-- Covered by idx_attendance_enrollment_lesson
+DROP INDEX idx_attendance_enrollment;
@@ -0,0 +1,101 @@
+-- Rolling attendance aggregates for the admin dashboards. Kept up to date
+-- incrementally by statement-level triggers on attendance, so reads cost
+-- O(courses) instead of a scan over the attendance history.
+CREATE TABLE course_attendance_stats (
+    course_id INTEGER PRIMARY KEY REFERENCES courses(id),
+    present INTEGER NOT NULL DEFAULT 0,
+    absent INTEGER NOT NULL DEFAULT 0,
+    excused INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE student_attendance_stats (
+    student_id INTEGER PRIMARY KEY REFERENCES students(id),
+    present INTEGER NOT NULL DEFAULT 0,
+    absent INTEGER NOT NULL DEFAULT 0,
+    excused INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Adds (direction = 1) or removes (direction = -1) a set of attendance rows
+-- from both summaries
+CREATE FUNCTION apply_attendance_deltas(enrollment_ids INTEGER[], statuses TEXT[], direction INTEGER)
+RETURNS void AS $$
+    WITH changes AS (
+        SELECT e.course_id, e.student_id, ch.status
+        FROM unnest(enrollment_ids, statuses) AS ch(enrollment_id, status)
+        JOIN enrollments e ON e.id = ch.enrollment_id
+    ),
+    by_course AS (
+        INSERT INTO course_attendance_stats AS s (course_id, present, absent, excused)
+        SELECT course_id,
+               direction * count(*) FILTER (WHERE status = 'present'),
+               direction * count(*) FILTER (WHERE status = 'absent'),
+               direction * count(*) FILTER (WHERE status = 'excused')
+        FROM changes
+        GROUP BY course_id
+        ON CONFLICT (course_id) DO UPDATE
+        SET present = s.present + EXCLUDED.present,
+            absent = s.absent + EXCLUDED.absent,
+            excused = s.excused + EXCLUDED.excused,
+            updated_at = CURRENT_TIMESTAMP
+    )
+    INSERT INTO student_attendance_stats AS s (student_id, present, absent, excused)
+    SELECT student_id,
+           direction * count(*) FILTER (WHERE status = 'present'),
+           direction * count(*) FILTER (WHERE status = 'absent'),
+           direction * count(*) FILTER (WHERE status = 'excused')
+    FROM changes
+    GROUP BY student_id
+    ON CONFLICT (student_id) DO UPDATE
+    SET present = s.present + EXCLUDED.present,
+        absent = s.absent + EXCLUDED.absent,
+        excused = s.excused + EXCLUDED.excused,
+        updated_at = CURRENT_TIMESTAMP
+$$ LANGUAGE sql;
+
+CREATE FUNCTION attendance_stats_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM apply_attendance_deltas(
+            ARRAY(SELECT enrollment_id FROM old_rows ORDER BY id),
+            ARRAY(SELECT status::text FROM old_rows ORDER BY id),
+            -1
+        );
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM apply_attendance_deltas(
+            ARRAY(SELECT enrollment_id FROM new_rows ORDER BY id),
+            ARRAY(SELECT status::text FROM new_rows ORDER BY id),
+            1
+        );
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER attendance_stats_insert AFTER INSERT ON attendance
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION attendance_stats_trigger();
+
+CREATE TRIGGER attendance_stats_update AFTER UPDATE ON attendance
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION attendance_stats_trigger();
+
+CREATE TRIGGER attendance_stats_delete AFTER DELETE ON attendance
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION attendance_stats_trigger();
+
+-- Full rebuild from the raw history: used for the initial backfill and
+-- to repair the summaries if they are ever suspected to drift
+CREATE FUNCTION rebuild_attendance_stats() RETURNS void AS $$
+    DELETE FROM course_attendance_stats;
+    DELETE FROM student_attendance_stats;
+    SELECT apply_attendance_deltas(
+        ARRAY(SELECT enrollment_id FROM attendance ORDER BY id),
+        ARRAY(SELECT status::text FROM attendance ORDER BY id),
+        1
+    );
+$$ LANGUAGE sql;
+
+SELECT rebuild_attendance_stats();
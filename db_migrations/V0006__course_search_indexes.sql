@@ -0,0 +1,15 @@
+-- Server-side course search (GET /courses?action=search). All indexes are
+-- partial on is_active because inactive courses are never searched.
+
+-- Russian-stemmed full text over title (weight A) and description (weight B);
+-- the expression must match COURSE_SEARCH_VECTOR in backend/courses/index.py
+CREATE INDEX idx_courses_search ON courses USING GIN (
+    (setweight(to_tsvector('russian', coalesce(title, '')), 'A') ||
+     setweight(to_tsvector('russian', coalesce(description, '')), 'B'))
+) WHERE is_active = true;
+
+-- Age range overlap: int4range(age_min, age_max, '[]') && requested range
+CREATE INDEX idx_courses_age_range ON courses USING GIST (int4range(age_min, age_max, '[]')) WHERE is_active = true;
+
+CREATE INDEX idx_courses_price ON courses(price_per_month) WHERE is_active = true;
+CREATE INDEX idx_courses_available ON courses(available_spots) WHERE is_active = true AND available_spots > 0;
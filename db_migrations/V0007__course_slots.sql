@@ -0,0 +1,133 @@
+-- Structured weekly slots parsed from courses.schedule ("ПН, СР 16:00-17:30").
+-- Each slot is stored as a half-open range of minutes since Monday 00:00 so
+-- GiST exclusion constraints can reject two courses sharing a room or a
+-- teacher at the same time. Integer keys are compared through degenerate
+-- int4ranges because btree_gist is not available on every host.
+CREATE TABLE rooms (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(100) NOT NULL UNIQUE
+);
+
+CREATE TABLE course_slots (
+    id SERIAL PRIMARY KEY,
+    course_id INTEGER NOT NULL REFERENCES courses(id) ON DELETE CASCADE,
+    weekday SMALLINT NOT NULL CHECK (weekday BETWEEN 1 AND 7),
+    starts_at TIME NOT NULL,
+    ends_at TIME NOT NULL,
+    week_minutes INT4RANGE NOT NULL,
+    room_id INTEGER REFERENCES rooms(id),
+    teacher_id INTEGER REFERENCES teachers(id),
+    CONSTRAINT course_slots_room_overlap EXCLUDE USING GIST (
+        (int4range(room_id, room_id, '[]')) WITH &&, week_minutes WITH &&
+    ) WHERE (room_id IS NOT NULL),
+    CONSTRAINT course_slots_teacher_overlap EXCLUDE USING GIST (
+        (int4range(teacher_id, teacher_id, '[]')) WITH &&, week_minutes WITH &&
+    ) WHERE (teacher_id IS NOT NULL)
+);
+
+CREATE INDEX idx_course_slots_course ON course_slots(course_id);
+
+-- Weekday list followed by a start time and an optional end time. The end
+-- comes from duration_minutes when it is set and from the string otherwise.
+-- Raises invalid_datetime_format (22007) for schedules that name days but
+-- have no usable time; a schedule without weekdays yields no slots.
+CREATE FUNCTION parse_course_schedule(schedule TEXT, duration_minutes INTEGER)
+RETURNS TABLE (weekday SMALLINT, starts_at TIME, ends_at TIME, week_minutes INT4RANGE) AS $$
+DECLARE
+    days SMALLINT[];
+    times TEXT[];
+    start_time TIME;
+    end_time TIME;
+BEGIN
+    SELECT array_agg(DISTINCT array_position(
+               ARRAY['ПН', 'ВТ', 'СР', 'ЧТ', 'ПТ', 'СБ', 'ВС'], upper(m[1]))::SMALLINT)
+    INTO days
+    FROM regexp_matches(coalesce(schedule, ''), '(ПН|ВТ|СР|ЧТ|ПТ|СБ|ВС)', 'gi') AS m;
+
+    IF days IS NULL THEN
+        RETURN;
+    END IF;
+
+    times := regexp_match(schedule, '(\d{1,2}:\d{2})(?:\s*[-–—]\s*(\d{1,2}:\d{2}))?');
+    IF times IS NULL THEN
+        RAISE EXCEPTION 'Schedule "%" has no start time', schedule USING ERRCODE = 'invalid_datetime_format';
+    END IF;
+
+    start_time := times[1]::TIME;
+    IF duration_minutes IS NOT NULL AND duration_minutes > 0 THEN
+        end_time := start_time + make_interval(mins => duration_minutes);
+        IF end_time <= start_time THEN
+            RAISE EXCEPTION 'Schedule "%" runs past midnight', schedule USING ERRCODE = 'invalid_datetime_format';
+        END IF;
+    ELSIF times[2] IS NOT NULL THEN
+        end_time := times[2]::TIME;
+    ELSE
+        RAISE EXCEPTION 'Schedule "%" needs an end time or duration_minutes', schedule USING ERRCODE = 'invalid_datetime_format';
+    END IF;
+
+    IF end_time <= start_time THEN
+        RAISE EXCEPTION 'Schedule "%" ends before it starts', schedule USING ERRCODE = 'invalid_datetime_format';
+    END IF;
+
+    RETURN QUERY
+    SELECT d, start_time, end_time,
+           int4range((d - 1) * 1440 + (extract(epoch FROM start_time) / 60)::INT,
+                     (d - 1) * 1440 + (extract(epoch FROM end_time) / 60)::INT)
+    FROM unnest(days) AS d;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- Replaces the slots of one course; only active courses occupy rooms
+CREATE FUNCTION sync_course_slots(target_id INTEGER) RETURNS void AS $$
+DECLARE
+    c courses%ROWTYPE;
+    target_room INTEGER;
+BEGIN
+    DELETE FROM course_slots WHERE course_id = target_id;
+
+    SELECT * INTO c FROM courses WHERE id = target_id;
+    IF NOT FOUND OR NOT coalesce(c.is_active, true) THEN
+        RETURN;
+    END IF;
+
+    IF nullif(trim(c.room), '') IS NOT NULL THEN
+        INSERT INTO rooms (name) VALUES (trim(c.room)) ON CONFLICT (name) DO NOTHING;
+        SELECT id INTO target_room FROM rooms WHERE name = trim(c.room);
+    END IF;
+
+    INSERT INTO course_slots (course_id, weekday, starts_at, ends_at, week_minutes, room_id, teacher_id)
+    SELECT target_id, p.weekday, p.starts_at, p.ends_at, p.week_minutes, target_room, c.teacher_id
+    FROM parse_course_schedule(c.schedule, c.duration_minutes) AS p;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION course_slots_trigger() RETURNS trigger AS $$
+BEGIN
+    PERFORM sync_course_slots(NEW.id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER courses_slots_insert
+AFTER INSERT ON courses
+FOR EACH ROW EXECUTE FUNCTION course_slots_trigger();
+
+CREATE TRIGGER courses_slots_update
+AFTER UPDATE OF schedule, duration_minutes, room, teacher_id, is_active ON courses
+FOR EACH ROW EXECUTE FUNCTION course_slots_trigger();
+
+-- Backfill. Existing free-form schedules that cannot be parsed are skipped
+-- rather than failing the migration; they get slots once they are edited.
+DO $$
+DECLARE
+    c RECORD;
+BEGIN
+    FOR c IN SELECT id FROM courses ORDER BY id LOOP
+        BEGIN
+            PERFORM sync_course_slots(c.id);
+        EXCEPTION WHEN invalid_datetime_format OR exclusion_violation THEN
+            RAISE NOTICE 'course %: schedule not slotted (%)', c.id, SQLERRM;
+        END;
+    END LOOP;
+END;
+$$;
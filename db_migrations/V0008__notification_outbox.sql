@@ -0,0 +1,15 @@
+-- notifications becomes a transactional outbox: handlers insert pending rows
+-- in the same transaction as the change they report, and the notifications
+-- dispatcher claims due rows with FOR UPDATE SKIP LOCKED, delivers them and
+-- settles them in bulk. next_attempt_at doubles as the claim lease: a
+-- claimed row is pushed into the future, so a crashed worker's batch simply
+-- becomes due again.
+ALTER TABLE notifications
+    ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    ADD COLUMN last_error TEXT;
+
+CREATE INDEX idx_notifications_due ON notifications(next_attempt_at) WHERE status = 'pending';
+
+-- Recipient for the telegram channel; email and sms use users.email/phone
+ALTER TABLE users ADD COLUMN telegram_chat_id VARCHAR(64);
@@ -0,0 +1,8 @@
+-- payments is the ledger behind students.balance (lessons left): completed
+-- payments add lessons_purchased, every other status contributes nothing.
+-- The balance column stays as a cache so profile reads remain a primary-key
+-- lookup; handlers adjust it in the same statement that writes the ledger
+-- and the reconcile_balances action recomputes it in one set-based pass.
+
+-- Idempotency key for payment providers and retried client requests
+CREATE UNIQUE INDEX idx_payments_transaction ON payments(transaction_id) WHERE transaction_id IS NOT NULL;
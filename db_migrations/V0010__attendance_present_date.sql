@@ -0,0 +1,4 @@
+-- Period reports (teacher payroll) only read present visits in a date range;
+-- the covering partial index lets them run as an index-only scan
+CREATE INDEX idx_attendance_present_date ON attendance(lesson_date)
+    INCLUDE (enrollment_id, lesson_time) WHERE status = 'present';
@@ -0,0 +1,88 @@
+-- FIFO waitlist per course. Entries are served in id order; a parent sees
+-- their position as the number of waiting entries at or ahead of theirs.
+CREATE TABLE waitlist (
+    id SERIAL PRIMARY KEY,
+    course_id INTEGER NOT NULL REFERENCES courses(id),
+    student_id INTEGER NOT NULL REFERENCES students(id),
+    status VARCHAR(50) NOT NULL DEFAULT 'waiting' CHECK (status IN ('waiting', 'promoted', 'cancelled')),
+    enrollment_id INTEGER REFERENCES enrollments(id),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    promoted_at TIMESTAMP
+);
+
+-- One live entry per student and course; also the FIFO scan for promotion
+CREATE UNIQUE INDEX idx_waitlist_waiting ON waitlist(course_id, student_id) WHERE status = 'waiting';
+CREATE INDEX idx_waitlist_queue ON waitlist(course_id, id) WHERE status = 'waiting';
+
+-- Hands the course's free spots to the head of its waitlist. The course row
+-- lock serializes promotions of one course (so seats are never oversold)
+-- while other courses promote in parallel; it is NO KEY UPDATE so it does not
+-- conflict with the KEY SHARE locks that waitlist and enrollment inserts take
+-- on the same row through their foreign keys. Entries locked by a concurrent
+-- join or withdrawal are skipped rather than waited on. Promoted students
+-- get an active enrollment (reactivating a cancelled one) and a parent
+-- notification in the outbox.
+CREATE FUNCTION promote_waitlist(target_course INTEGER, channel TEXT DEFAULT 'email')
+RETURNS TABLE (waitlist_id INTEGER, student_id INTEGER, enrollment_id INTEGER) AS $$
+#variable_conflict use_column
+DECLARE
+    free_spots INTEGER;
+BEGIN
+    SELECT available_spots INTO free_spots FROM courses WHERE id = target_course FOR NO KEY UPDATE;
+    IF free_spots IS NULL OR free_spots <= 0 THEN
+        RETURN;
+    END IF;
+
+    -- Students who got a seat some other way leave the queue
+    UPDATE waitlist w
+    SET status = 'cancelled'
+    WHERE w.course_id = target_course AND w.status = 'waiting'
+      AND EXISTS (
+          SELECT 1 FROM enrollments e
+          WHERE e.student_id = w.student_id AND e.course_id = target_course AND e.status = 'active'
+      );
+
+    RETURN QUERY
+    WITH claimed AS (
+        SELECT w.id, w.student_id
+        FROM waitlist w
+        WHERE w.course_id = target_course AND w.status = 'waiting'
+        ORDER BY w.id
+        LIMIT free_spots
+        FOR UPDATE SKIP LOCKED
+    ),
+    enrolled AS (
+        INSERT INTO enrollments (student_id, course_id, status)
+        SELECT c.student_id, target_course, 'active' FROM claimed c ORDER BY c.id
+        ON CONFLICT (student_id, course_id) DO UPDATE
+        SET status = 'active', enrolled_at = CURRENT_TIMESTAMP
+        RETURNING id, student_id
+    ),
+    seats AS (
+        UPDATE courses
+        SET available_spots = available_spots - (SELECT count(*) FROM enrolled),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = target_course
+    ),
+    promoted AS (
+        UPDATE waitlist w
+        SET status = 'promoted', promoted_at = CURRENT_TIMESTAMP, enrollment_id = en.id
+        FROM claimed c
+        JOIN enrolled en ON en.student_id = c.student_id
+        WHERE w.id = c.id
+    ),
+    notified AS (
+        INSERT INTO notifications (user_id, type, subject, message)
+        SELECT s.parent_id, channel, 'Место на курсе',
+               'Освободилось место: ' || s.full_name || ' записан(а) на курс «' || co.title || '»'
+        FROM enrolled en
+        JOIN students s ON s.id = en.student_id
+        JOIN courses co ON co.id = target_course
+        WHERE s.parent_id IS NOT NULL
+    )
+    SELECT c.id, c.student_id, en.id
+    FROM claimed c
+    JOIN enrolled en ON en.student_id = c.student_id
+    ORDER BY c.id;
+END;
+$$ LANGUAGE plpgsql;
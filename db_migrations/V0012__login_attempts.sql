@@ -0,0 +1,10 @@
+-- Login attempt counters shared by every auth instance: one row per
+-- throttling key ('email:<address>' or 'ip:<address>') and fixed window.
+-- UNLOGGED keeps the per-attempt upsert off the WAL; a crash only empties
+-- the table, which merely resets the limits.
+CREATE UNLOGGED TABLE login_attempts (
+    key VARCHAR(320) NOT NULL,
+    window_start TIMESTAMP NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (key, window_start)
+);
@@ -0,0 +1,9 @@
+-- Gives the demo payment from V0002 an idempotency key, so replaying a known
+-- payment (tests.json "Replay a recorded payment") behaves the same on every
+-- run instead of depending on an earlier test having recorded it.
+UPDATE payments
+SET transaction_id = 'demo-payment-1'
+WHERE transaction_id IS NULL
+  AND student_id = 1
+  AND paid_at = '2024-03-01 14:30:00'
+  AND NOT EXISTS (SELECT 1 FROM payments WHERE transaction_id = 'demo-payment-1');
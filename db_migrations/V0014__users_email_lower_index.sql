@@ -0,0 +1,3 @@
+-- Case-insensitive email lookups (parent_email in the students CSV import)
+-- match on lower(email), which the plain unique index on email cannot serve
+CREATE INDEX idx_users_email_lower ON users(lower(email));
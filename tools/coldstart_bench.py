@@ -0,0 +1,169 @@
+'''
+Cold start of each function: module import time and first-request latency.
+
+Every sample is a fresh interpreter, started with -X importtime, that
+executes one backend/<function>/index.py and calls its handler twice with
+the same event. Per scenario it reports medians over --runs samples of:
+
+  import_ms       executing index.py, including every module it imports
+  first_ms        the first call, which pays for deferred imports and the
+                  first database connection
+  second_ms       the same call again, warm
+  cold_ms         import_ms + first_ms
+
+and the heaviest modules index.py pulled in, as measured by -X importtime.
+With --baseline-rev the index.py files of that git revision are measured
+the same way, interleaved with the working tree ones, and the report
+carries the difference. The database given by --db-url / TEST_DATABASE_URL
+is reset once first.
+
+    python tools/coldstart_bench.py --db-url postgresql://localhost/cms_test \\
+        --runs 9 --baseline-rev HEAD~1
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from localdb import BACKEND_DIR, ROOT, make_event, require_db_url, reset_database
+
+MARKER = 'coldstart: loading index.py'
+TOP_IMPORTS = 6
+
+# Runs in the fresh interpreter. json is imported only after index.py so
+# its cost is counted against the handler, as it is on the platform
+CHILD = f'''
+import importlib.util, sys, time
+path, event_text = sys.argv[1], sys.argv[2]
+sys.stderr.write({MARKER!r} + '\\n')
+sys.stderr.flush()
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location('index', path)
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+imported = time.perf_counter()
+import json
+event = json.loads(event_text)
+status = module.handler(event, None)['statusCode']
+first = time.perf_counter()
+module.handler(event, None)
+second = time.perf_counter()
+print(json.dumps({{'status': status, 'import': imported - started, 'first': first - imported, 'second': second - first}}))
+'''
+
+def scenarios(sample: str) -> Dict[str, Tuple[str, Dict[str, Any], int]]:
+    # name -> (function, event, expected status). The login email is new for
+    # every sample so the login_attempts counter never throttles it
+    return {
+        'auth verify': ('auth', make_event('POST', {'action': 'verify', 'token': 'a.b.c'}), 401),
+        'auth login': ('auth', make_event('POST', {
+            'action': 'login', 'email': f'coldstart-{sample}@example.com', 'password': 'coldstart'
+        }), 401),
+        'courses catalog': ('courses', make_event('GET'), 200),
+        'students profile': ('students', make_event('GET', params={'action': 'profile', 'student_id': '1'}), 200)
+    }
+
+def parse_importtime(stderr: str) -> Dict[str, float]:
+    # Cumulative ms of each module imported directly by index.py
+    modules: Dict[str, float] = {}
+    lines = stderr.splitlines()
+    start = lines.index(MARKER) + 1 if MARKER in lines else len(lines)
+    for line in lines[start:]:
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        if cumulative.strip().isdigit() and not name[1:].startswith(' '):
+            modules[name.strip()] = int(cumulative) / 1000
+    return modules
+
+def run_sample(index_path: Path, event: Dict[str, Any], env: Dict[str, str]) -> Dict[str, Any]:
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD, str(index_path), json.dumps(event)],
+        cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise SystemExit(f'{index_path} failed:\n{proc.stderr[-2000:]}')
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result['modules'] = parse_importtime(proc.stderr)
+    return result
+
+def summarize(samples: List[Dict[str, Any]]) -> Dict[str, Any]:
+    def median_ms(values: List[float]) -> float:
+        return round(statistics.median(values) * 1000, 2)
+    modules: Dict[str, List[float]] = {}
+    for sample in samples:
+        for name, ms in sample['modules'].items():
+            modules.setdefault(name, []).append(ms)
+    heaviest = sorted(modules.items(), key=lambda item: -statistics.median(item[1]))[:TOP_IMPORTS]
+    return {
+        'import_ms': median_ms([s['import'] for s in samples]),
+        'first_ms': median_ms([s['first'] for s in samples]),
+        'second_ms': median_ms([s['second'] for s in samples]),
+        'cold_ms': median_ms([s['import'] + s['first'] for s in samples]),
+        'heaviest_imports_ms': {name: round(statistics.median(ms), 2) for name, ms in heaviest}
+    }
+
+def export_revision(rev: str, functions: List[str], target: Path) -> Dict[str, Path]:
+    paths = {}
+    for function in functions:
+        source = subprocess.check_output(['git', 'show', f'{rev}:backend/{function}/index.py'], cwd=ROOT)
+        path = target / function / 'index.py'
+        path.parent.mkdir(parents=True)
+        path.write_bytes(source)
+        paths[function] = path
+    return paths
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-url')
+    parser.add_argument('--runs', type=int, default=7, help='fresh interpreters per scenario and tree')
+    parser.add_argument('--baseline-rev', help='git revision to compare the working tree against')
+    args = parser.parse_args()
+    
+    db_url = require_db_url(args.db_url)
+    reset_database(db_url)
+    env = dict(os.environ, DATABASE_URL=db_url, REQUEST_LOG='0')
+    env.pop('DATABASE_READ_URL', None)
+    
+    functions = sorted({function for function, _, _ in scenarios('').values()})
+    with tempfile.TemporaryDirectory() as tmp:
+        trees: Dict[str, Dict[str, Path]] = {'current': {f: BACKEND_DIR / f / 'index.py' for f in functions}}
+        if args.baseline_rev:
+            trees['baseline'] = export_revision(args.baseline_rev, functions, Path(tmp))
+        
+        samples: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        failures = []
+        # Trees alternate sample by sample so drift in machine load hits both
+        for run in range(args.runs):
+            for tree, paths in trees.items():
+                for name, (function, event, expected) in scenarios(f'{tree}-{run}').items():
+                    sample = run_sample(paths[function], event, env)
+                    if sample['status'] != expected:
+                        failures.append(f"{tree} {name}: status {sample['status']}, expected {expected}")
+                    samples.setdefault((name, tree), []).append(sample)
+    
+    report: Dict[str, Any] = {}
+    for name in scenarios(''):
+        entry: Dict[str, Any] = {tree: summarize(samples[(name, tree)]) for tree in trees}
+        if 'baseline' in entry:
+            entry['change_ms'] = {
+                key: round(entry['current'][key] - entry['baseline'][key], 2)
+                for key in ('import_ms', 'first_ms', 'second_ms', 'cold_ms')
+            }
+        report[name] = entry
+    
+    print(json.dumps({
+        'runs': args.runs,
+        'baseline_rev': args.baseline_rev,
+        'scenarios': report,
+        'failures': failures
+    }, indent=2))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
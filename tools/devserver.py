@@ -0,0 +1,274 @@
+'''
+Local gateway serving every cloud function from one HTTP endpoint.
+
+Loads each handler listed in backend/func2url.json and serves it at
+http://<host>:<port>/<function>, translating requests into the event dict
+the platform sends (query string, headers, text or base64 body, source
+IP in requestContext) and handler results back into HTTP responses. GET /
+lists the local function URLs, in the shape of func2url.json.
+
+An asyncio server owns the sockets: HTTP/1.1 keep-alive, pipelined
+requests answered in order, idle connections closed after --keepalive
+seconds. Handlers run on a pool of --workers threads, as concurrent warm
+invocations of one instance would; once --backlog requests are waiting
+for a worker, new ones get 503 instead of queueing without bound. Each
+function's DB pool is sized to the worker count unless DB_POOL_MAX is
+set. The database is DATABASE_URL (or --db-url) and is left as is unless
+--reset is given, which recreates it from db_migrations/.
+
+    python tools/devserver.py --db-url postgresql://localhost/cms_dev --workers 16
+'''
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from types import ModuleType, SimpleNamespace
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from localdb import function_names, load_handler, reset_database
+
+MAX_HEADER_LINES = 100
+# Hop-by-hop headers are the gateway's business, never the handler's
+HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'content-length'}
+
+class BadRequest(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+class Gateway:
+    def __init__(self, handlers: Dict[str, ModuleType], workers: int, backlog: int,
+                 keepalive: float, max_body: int, access_log: bool):
+        self.handlers = handlers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='handler')
+        self.capacity = workers + backlog
+        self.in_flight = 0
+        self.keepalive = keepalive
+        self.max_body = max_body
+        self.access_log = access_log
+        self.base_url = ''
+        self.stats: Dict[str, int] = {'requests': 0, 'rejected': 0, 'connections': 0}
+    
+    async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.stats['connections'] += 1
+        peer = writer.get_extra_info('peername')
+        source_ip = peer[0] if peer else '127.0.0.1'
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader), timeout=self.keepalive)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except BadRequest as e:
+                    writer.write(self.render(e.status, {'Content-Type': 'application/json'},
+                                             json.dumps({'error': str(e)}).encode(), False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                
+                method, target, version, headers, body = request
+                keep_alive = self.wants_keep_alive(version, headers)
+                started = time.perf_counter()
+                status, response_headers, payload = await self.dispatch(method, target, headers, body, source_ip)
+                writer.write(self.render(status, response_headers, payload, keep_alive))
+                await writer.drain()
+                if self.access_log:
+                    sys.stderr.write(f'{method} {target} {status} {(time.perf_counter() - started) * 1000:.1f}ms\n')
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+    
+    async def read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, str, Dict[str, str], bytes]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode('latin-1').split()
+        except ValueError:
+            raise BadRequest(400, 'Malformed request line')
+        
+        headers: Dict[str, str] = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, sep, value = line.decode('latin-1').partition(':')
+            if not sep:
+                raise BadRequest(400, 'Malformed header')
+            # Repeated headers are folded the way the platform folds them
+            name = name.strip()
+            headers[name] = f'{headers[name]}, {value.strip()}' if name in headers else value.strip()
+        else:
+            raise BadRequest(431, 'Too many headers')
+        
+        lower = {k.lower(): v for k, v in headers.items()}
+        if 'chunked' in lower.get('transfer-encoding', '').lower():
+            body = await self.read_chunked(reader)
+        else:
+            try:
+                length = int(lower.get('content-length', '0'))
+            except ValueError:
+                raise BadRequest(400, 'Malformed Content-Length')
+            if length > self.max_body:
+                raise BadRequest(413, 'Request body too large')
+            body = await reader.readexactly(length) if length else b''
+        return method.upper(), target, version, headers, body
+    
+    async def read_chunked(self, reader: asyncio.StreamReader) -> bytes:
+        chunks = []
+        size = 0
+        while True:
+            try:
+                length = int((await reader.readline()).split(b';')[0], 16)
+            except ValueError:
+                raise BadRequest(400, 'Malformed chunk')
+            if length == 0:
+                # Trailers, up to the blank line
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            size += length
+            if size > self.max_body:
+                raise BadRequest(413, 'Request body too large')
+            chunks.append(await reader.readexactly(length))
+            await reader.readline()
+    
+    @staticmethod
+    def wants_keep_alive(version: str, headers: Dict[str, str]) -> bool:
+        connection = next((v for k, v in headers.items() if k.lower() == 'connection'), '').lower()
+        if version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+    
+    async def dispatch(self, method: str, target: str, headers: Dict[str, str], body: bytes,
+                       source_ip: str) -> Tuple[int, Dict[str, str], bytes]:
+        url = urlsplit(target)
+        name, _, rest = url.path.lstrip('/').partition('/')
+        if not name and method == 'GET':
+            listing = {n: f'{self.base_url}/{n}' for n in self.handlers}
+            return 200, {'Content-Type': 'application/json'}, json.dumps(listing, indent=2).encode()
+        if name not in self.handlers:
+            return 404, {'Content-Type': 'application/json'}, json.dumps({'error': f'No function {name!r}'}).encode()
+        
+        if self.in_flight >= self.capacity:
+            self.stats['rejected'] += 1
+            return 503, {'Content-Type': 'application/json', 'Retry-After': '1'}, b'{"error":"Gateway busy"}'
+        
+        event = self.make_event(method, url, rest, headers, body, source_ip)
+        context = SimpleNamespace(request_id=event['requestContext']['requestId'], function_name=name)
+        self.in_flight += 1
+        self.stats['requests'] += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.invoke, self.handlers[name], event, context
+            )
+        finally:
+            self.in_flight -= 1
+        return self.to_http(result)
+    
+    @staticmethod
+    def make_event(method: str, url: Any, rest: str, headers: Dict[str, str], body: bytes,
+                   source_ip: str) -> Dict[str, Any]:
+        try:
+            text, encoded = body.decode('utf-8'), False
+        except UnicodeDecodeError:
+            text, encoded = base64.b64encode(body).decode(), True
+        return {
+            'httpMethod': method,
+            'path': '/' + rest,
+            'url': url.geturl(),
+            'headers': headers,
+            'queryStringParameters': dict(parse_qsl(url.query, keep_blank_values=True)),
+            'body': text,
+            'isBase64Encoded': encoded,
+            'requestContext': {
+                'requestId': str(uuid.uuid4()),
+                'httpMethod': method,
+                'identity': {'sourceIp': source_ip, 'userAgent': headers.get('User-Agent', '')},
+                'requestTimeEpoch': int(time.time() * 1000)
+            }
+        }
+    
+    @staticmethod
+    def invoke(module: ModuleType, event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        # An exception escaping the handler is what the platform reports as 502
+        try:
+            return module.handler(event, context)
+        except Exception as e:
+            return {'statusCode': 502, 'headers': {'Content-Type': 'application/json'},
+                    'body': json.dumps({'error': f'{type(e).__name__}: {e}'}), 'isBase64Encoded': False}
+    
+    @staticmethod
+    def to_http(result: Dict[str, Any]) -> Tuple[int, Dict[str, str], bytes]:
+        body = result.get('body') or ''
+        payload = base64.b64decode(body) if result.get('isBase64Encoded') else body.encode('utf-8')
+        headers = {k: str(v) for k, v in (result.get('headers') or {}).items() if k.lower() not in HOP_HEADERS}
+        return int(result.get('statusCode', 200)), headers, payload
+    
+    def render(self, status: int, headers: Dict[str, str], payload: bytes, keep_alive: bool) -> bytes:
+        try:
+            reason = HTTPStatus(status).phrase
+        except ValueError:
+            reason = ''
+        lines = [f'HTTP/1.1 {status} {reason}']
+        lines += [f'{k}: {v}' for k, v in headers.items()]
+        lines.append(f'Content-Length: {len(payload)}')
+        if keep_alive:
+            lines += ['Connection: keep-alive', f'Keep-Alive: timeout={int(self.keepalive)}']
+        else:
+            lines.append('Connection: close')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload
+
+async def serve(gateway: Gateway, host: str, port: int) -> None:
+    server = await asyncio.start_server(gateway.serve_connection, host, port, backlog=1024)
+    bound = server.sockets[0].getsockname()
+    gateway.base_url = f'http://{bound[0]}:{bound[1]}'
+    sys.stderr.write(f"Serving {', '.join(gateway.handlers)} at {gateway.base_url}/<function>\n")
+    async with server:
+        await server.serve_forever()
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-url')
+    parser.add_argument('--reset', action='store_true', help='recreate the database from db_migrations/ first')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--functions', help='comma separated subset of func2url.json')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='handler threads')
+    parser.add_argument('--backlog', type=int, default=256, help='requests allowed to wait for a worker')
+    parser.add_argument('--keepalive', type=float, default=5.0, help='idle seconds before a connection is closed')
+    parser.add_argument('--max-body', type=int, default=10 * 1024 * 1024)
+    parser.add_argument('--quiet', action='store_true', help='no access log')
+    args = parser.parse_args()
+    
+    db_url = args.db_url or os.environ.get('DATABASE_URL')
+    if not db_url:
+        raise SystemExit('Pass --db-url or set DATABASE_URL')
+    if args.reset:
+        reset_database(db_url)
+    os.environ.setdefault('DB_POOL_MAX', str(args.workers))
+    
+    names = args.functions.split(',') if args.functions else function_names()
+    handlers = {name: load_handler(name, db_url) for name in names}
+    gateway = Gateway(handlers, args.workers, args.backlog, args.keepalive, args.max_body, not args.quiet)
+    try:
+        asyncio.run(serve(gateway, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
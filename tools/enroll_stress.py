@@ -0,0 +1,133 @@
+'''
+Concurrency stress test for the students `enroll` action.
+
+Resets the throwaway database given by --db-url / TEST_DATABASE_URL,
+creates one course with --spots seats and --students students, then
+fires every enrollment (plus --duplicates repeated sign-ups) in parallel
+through the real handler. Exits non-zero if the course is oversold,
+the spot counter drifts from the enrollment rows or any call fails.
+With --batch N the same attempts go through `bulk_enroll` in batches
+of N pairs instead.
+
+    python tools/enroll_stress.py --db-url postgresql://localhost/cms_test
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import psycopg2
+
+from localdb import load_handler, make_event, require_db_url, reset_database
+
+def prepare(db_url: str, students: int, spots: int) -> Tuple[int, List[int]]:
+    reset_database(db_url)
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO courses (title, price_per_month, total_spots, available_spots)
+                VALUES ('Stress course', 1000, %s, %s)
+                RETURNING id
+            """, (spots, spots))
+            course_id = cur.fetchone()[0]
+            cur.execute("""
+                INSERT INTO students (parent_id, full_name, balance)
+                SELECT 3, 'Stress student ' || n, 0 FROM generate_series(1, %s) AS n
+                RETURNING id
+            """, (students,))
+            student_ids = [row[0] for row in cur.fetchall()]
+        conn.commit()
+    finally:
+        conn.close()
+    return course_id, student_ids
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-url')
+    parser.add_argument('--students', type=int, default=300)
+    parser.add_argument('--spots', type=int, default=25)
+    parser.add_argument('--duplicates', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=64)
+    parser.add_argument('--batch', type=int, default=0, help='send bulk_enroll batches of this size')
+    args = parser.parse_args()
+    
+    db_url = require_db_url(args.db_url)
+    course_id, student_ids = prepare(db_url, args.students, args.spots)
+    
+    os.environ['DB_POOL_MAX'] = str(args.workers)
+    students = load_handler('students', db_url)
+    
+    attempts = student_ids + random.choices(student_ids, k=args.duplicates)
+    random.shuffle(attempts)
+    
+    def enroll(student_id: int) -> List[int]:
+        event = make_event('POST', {'action': 'enroll', 'student_id': student_id, 'course_id': course_id})
+        return [students.handler(event, None)['statusCode']]
+    
+    def enroll_batch(batch: List[int]) -> List[int]:
+        event = make_event('POST', {
+            'action': 'bulk_enroll',
+            'enrollments': [{'student_id': s, 'course_id': course_id} for s in batch]
+        })
+        response = students.handler(event, None)
+        if response['statusCode'] != 200:
+            return [response['statusCode']] * len(batch)
+        return [201 if r['status'] == 'enrolled' else 409 for r in json.loads(response['body'])['results']]
+    
+    if args.batch > 0:
+        calls = [attempts[i:i + args.batch] for i in range(0, len(attempts), args.batch)]
+        call = enroll_batch
+    else:
+        calls = attempts
+        call = enroll
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        statuses = Counter(status for result in pool.map(call, calls) for status in result)
+    elapsed = time.perf_counter() - started
+    
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT total_spots, available_spots FROM courses WHERE id = %s", (course_id,))
+            total_spots, available_spots = cur.fetchone()
+            cur.execute("SELECT count(*) FROM enrollments WHERE course_id = %s AND status = 'active'", (course_id,))
+            enrolled = cur.fetchone()[0]
+    finally:
+        conn.close()
+    
+    expected = min(args.spots, len(student_ids))
+    failures = []
+    if enrolled > total_spots:
+        failures.append(f'oversold: {enrolled} enrollments for {total_spots} spots')
+    if available_spots < 0:
+        failures.append(f'available_spots went negative: {available_spots}')
+    if total_spots - available_spots != enrolled:
+        failures.append(f'spot counter drift: {total_spots - available_spots} taken vs {enrolled} rows')
+    if enrolled != expected:
+        failures.append(f'expected {expected} enrollments, got {enrolled}')
+    if statuses[201] != enrolled:
+        failures.append(f'{statuses[201]} calls returned 201 for {enrolled} enrollments')
+    if set(statuses) - {201, 409}:
+        failures.append(f'unexpected statuses: {dict(statuses)}')
+    
+    print(json.dumps({
+        'attempts': len(attempts),
+        'requests': len(calls),
+        'enrollments_per_second': round(len(attempts) / elapsed, 1),
+        'statuses': {str(k): v for k, v in sorted(statuses.items())},
+        'enrolled': enrolled,
+        'available_spots': available_spots,
+        'pool': students.pool_metrics(),
+        'failures': failures
+    }, indent=2))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+'''
+Local benchmark and load-test harness for the cloud function handlers.
+
+Resets the throwaway database given by --db-url / TEST_DATABASE_URL from
+db_migrations/, imports every handler listed in backend/func2url.json and
+calls it directly with the same event dicts the platform sends. Two phases
+run at --concurrency parallel callers:
+
+  scenarios  every entry of backend/<function>/tests.json, --repeat times,
+             with {{unique}} in a body replaced by a fresh value per call
+  mix        --requests calls drawn from a weighted synthetic traffic mix
+             (built in, or a JSON list given with --mix)
+
+For every action it reports p50/p95/p99 latency, throughput, status codes
+and database round trips per request. Results go to --output as JSON;
+--baseline compares against an earlier run and exits non-zero when p95
+latency or round trips regress beyond --tolerance.
+
+With --gateway the calls go over HTTP (keep-alive, one connection per
+caller) to a running tools/devserver.py on the same database instead;
+round trips are then not visible and reported as 0. Start the gateway
+with LOGIN_THROTTLE=0 so the repeated logins of the mix are not throttled.
+
+    python tools/loadtest.py --db-url postgresql://localhost/cms_test \\
+        --concurrency 32 --output run.json --baseline previous.json
+'''
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from localdb import (
+    BACKEND_DIR, ROOT, function_names, install_round_trip_counter, load_handler,
+    make_event, require_db_url, reset_database, reset_round_trips, round_trips
+)
+
+LOADTEST_EMAIL = 'loadtest@example.com'
+LOADTEST_PASSWORD = 'loadtest-password'
+
+def default_mix(token: str) -> List[Dict[str, Any]]:
+    return [
+        {'name': 'courses catalog', 'function': 'courses', 'method': 'GET', 'weight': 35},
+        {'name': 'courses by id', 'function': 'courses', 'method': 'GET', 'params': {'id': '1'}, 'weight': 10},
+        {'name': 'students profile', 'function': 'students', 'method': 'GET',
+         'params': {'action': 'profile', 'student_id': '1'}, 'weight': 20},
+        {'name': 'students list', 'function': 'students', 'method': 'GET', 'params': {'limit': '50'}, 'weight': 10},
+        {'name': 'students by parent', 'function': 'students', 'method': 'GET', 'params': {'parent_id': '3'}, 'weight': 5},
+        {'name': 'auth verify', 'function': 'auth', 'method': 'POST',
+         'body': {'action': 'verify', 'token': token}, 'weight': 15},
+        {'name': 'auth login', 'function': 'auth', 'method': 'POST',
+         'body': {'action': 'login', 'email': LOADTEST_EMAIL, 'password': LOADTEST_PASSWORD}, 'weight': 5}
+    ]
+
+def scenario_calls(functions: List[str]) -> List[Dict[str, Any]]:
+    calls = []
+    for function in functions:
+        path = BACKEND_DIR / function / 'tests.json'
+        if not path.exists():
+            continue
+        with open(path, encoding='utf-8') as f:
+            tests = json.load(f).get('tests', [])
+        for test in tests:
+            url = urlsplit(test.get('path', '/'))
+            calls.append({
+                'name': f"{function}: {test['name']}",
+                'function': function,
+                'method': test.get('method', 'GET'),
+                'params': dict(parse_qsl(url.query)),
+                'body': test.get('body'),
+                'expected_status': test.get('expectedStatus')
+            })
+    return calls
+
+# Base URL of tools/devserver.py when calls go over HTTP, and each caller
+# thread's keep-alive connection to it
+GATEWAY: Optional[str] = None
+_gateway_conn = threading.local()
+
+def gateway_request(call: Dict[str, Any]) -> int:
+    path = f"/{call['function']}"
+    if call.get('params'):
+        path += '?' + urlencode(call['params'])
+    body = json.dumps(call['body']) if call.get('body') is not None else None
+    headers = dict(call.get('headers') or {}, **{'Content-Type': 'application/json'})
+    for attempt in range(2):
+        conn = getattr(_gateway_conn, 'value', None)
+        if conn is None:
+            url = urlsplit(GATEWAY)
+            conn = _gateway_conn.value = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+        try:
+            conn.request(call['method'], path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        except (http.client.HTTPException, ConnectionError):
+            # The gateway closed an idle keep-alive connection: reconnect once
+            conn.close()
+            _gateway_conn.value = None
+            if attempt:
+                raise
+    return 599
+
+UNIQUE_PLACEHOLDER = '{{unique}}'
+
+def with_unique_values(call: Dict[str, Any]) -> Dict[str, Any]:
+    # {{unique}} in a tests.json body becomes a fresh value on every call, so
+    # scenarios that create something (idempotency keys) can be repeated
+    if call.get('body') is None:
+        return call
+    text = json.dumps(call['body'], ensure_ascii=False)
+    if UNIQUE_PLACEHOLDER not in text:
+        return call
+    return dict(call, body=json.loads(text.replace(UNIQUE_PLACEHOLDER, uuid.uuid4().hex)))
+
+def run_call(call: Dict[str, Any]) -> Tuple[str, int, float, int, bool]:
+    call = with_unique_values(call)
+    reset_round_trips()
+    started = time.perf_counter()
+    try:
+        if GATEWAY:
+            status = gateway_request(call)
+        else:
+            handler = load_handler(call['function']).handler
+            event = make_event(call['method'], call.get('body'), call.get('params'), call.get('headers'))
+            status = handler(event, None)['statusCode']
+    except Exception:
+        status = 599
+    elapsed = time.perf_counter() - started
+    expected = call.get('expected_status')
+    return call['name'], status, elapsed, round_trips(), expected is not None and status != expected
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def run_phase(calls: List[Dict[str, Any]], concurrency: int) -> Dict[str, Any]:
+    samples: Dict[str, List[Tuple[int, float, int, bool]]] = defaultdict(list)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for name, status, elapsed, trips, mismatch in pool.map(run_call, calls):
+            samples[name].append((status, elapsed, trips, mismatch))
+    wall = time.perf_counter() - started
+    
+    actions = {}
+    for name, rows in sorted(samples.items()):
+        latencies = sorted(r[1] for r in rows)
+        actions[name] = {
+            'requests': len(rows),
+            'statuses': {str(k): v for k, v in sorted(Counter(r[0] for r in rows).items())},
+            'errors': sum(1 for r in rows if r[0] >= 500),
+            'status_mismatches': sum(1 for r in rows if r[3]),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+            'throughput_rps': round(len(rows) / wall, 1),
+            'db_round_trips_per_request': round(sum(r[2] for r in rows) / len(rows), 2)
+        }
+    return {
+        'requests': len(calls),
+        'wall_seconds': round(wall, 3),
+        'throughput_rps': round(len(calls) / wall, 1) if wall else 0.0,
+        'actions': actions
+    }
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    regressions = []
+    for phase, data in results['phases'].items():
+        previous = baseline.get('phases', {}).get(phase, {}).get('actions', {})
+        for name, current in data['actions'].items():
+            before = previous.get(name)
+            if not before:
+                continue
+            if before['p95_ms'] and current['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+                regressions.append(f"{phase} / {name}: p95 {before['p95_ms']}ms -> {current['p95_ms']}ms")
+            if current['db_round_trips_per_request'] > before['db_round_trips_per_request']:
+                regressions.append(
+                    f"{phase} / {name}: round trips {before['db_round_trips_per_request']} -> "
+                    f"{current['db_round_trips_per_request']}"
+                )
+    return regressions
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-url')
+    parser.add_argument('--functions', help='comma separated subset of func2url.json')
+    parser.add_argument('--phases', default='scenarios,mix')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=50, help='scenario phase: runs of each tests.json entry')
+    parser.add_argument('--requests', type=int, default=5000, help='mix phase: total calls')
+    parser.add_argument('--mix', help='JSON file with a list of weighted calls replacing the built-in mix')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='earlier --output file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative p95 increase')
+    parser.add_argument('--gateway', help='send calls to this tools/devserver.py URL instead of in-process')
+    args = parser.parse_args()
+    
+    global GATEWAY
+    GATEWAY = args.gateway
+    
+    db_url = require_db_url(args.db_url)
+    reset_database(db_url)
+    os.environ.setdefault('DB_POOL_MAX', str(args.concurrency))
+    # The mix logs one user in over and over: time the login path, not the
+    # brute-force throttle (tools/login_throttle_bench.py covers that)
+    os.environ.setdefault('LOGIN_THROTTLE', '0')
+    install_round_trip_counter()
+    
+    functions = args.functions.split(',') if args.functions else function_names()
+    for function in functions:
+        load_handler(function, db_url)
+    
+    token = ''
+    if 'auth' in functions:
+        response = load_handler('auth').handler(make_event('POST', {
+            'action': 'register', 'email': LOADTEST_EMAIL, 'password': LOADTEST_PASSWORD,
+            'full_name': 'Load Test', 'role': 'parent'
+        }), None)
+        token = json.loads(response['body']).get('token', '')
+    
+    random.seed(args.seed)
+    results: Dict[str, Any] = {
+        'started_at': datetime.utcnow().isoformat() + 'Z',
+        'revision': git_revision(),
+        'concurrency': args.concurrency,
+        'gateway': args.gateway,
+        'functions': functions,
+        'phases': {}
+    }
+    
+    phases = args.phases.split(',')
+    if 'scenarios' in phases:
+        calls = scenario_calls(functions) * args.repeat
+        random.shuffle(calls)
+        results['phases']['scenarios'] = run_phase(calls, args.concurrency)
+    
+    if 'mix' in phases:
+        if args.mix:
+            with open(args.mix, encoding='utf-8') as f:
+                mix = json.load(f)
+        else:
+            mix = default_mix(token)
+        mix = [m for m in mix if m['function'] in functions]
+        calls = random.choices(mix, weights=[m.get('weight', 1) for m in mix], k=args.requests)
+        results['phases']['mix'] = run_phase(calls, args.concurrency)
+    
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results['regressions'] = regressions
+    
+    text = json.dumps(results, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+'''
+Shared helpers for the local tooling: throwaway Postgres setup from
+db_migrations/ and direct loading of the cloud function handlers.
+'''
+import functools
+import importlib.util
+import json
+import os
+import re
+import threading
+from pathlib import Path
+from types import ModuleType
+from typing import Dict, Any, List, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+ROOT = Path(__file__).resolve().parent.parent
+BACKEND_DIR = ROOT / 'backend'
+MIGRATIONS_DIR = ROOT / 'db_migrations'
+
+_handlers: Dict[str, ModuleType] = {}
+_round_trips = threading.local()
+_cursor_classes: Dict[type, type] = {}
+
+def migration_files() -> List[Path]:
+    def version(path: Path) -> int:
+        match = re.match(r'V(\d+)__', path.name)
+        return int(match.group(1)) if match else 0
+    return sorted(MIGRATIONS_DIR.glob('V*__*.sql'), key=version)
+
+def reset_database(db_url: str) -> None:
+    # Drops everything in the public schema: only ever point this at a
+    # throwaway database
+    conn = psycopg2.connect(db_url)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('DROP SCHEMA public CASCADE')
+            cur.execute('CREATE SCHEMA public')
+            for path in migration_files():
+                cur.execute(path.read_text(encoding='utf-8'))
+    finally:
+        conn.close()
+
+def load_handler(name: str, db_url: Optional[str] = None) -> ModuleType:
+    # Per-request JSON log lines would drown the tool output
+    os.environ.setdefault('REQUEST_LOG', '0')
+    if db_url:
+        os.environ['DATABASE_URL'] = db_url
+    if name not in _handlers:
+        path = BACKEND_DIR / name / 'index.py'
+        spec = importlib.util.spec_from_file_location(f'{name}_index', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _handlers[name] = module
+    return _handlers[name]
+
+def function_names() -> List[str]:
+    with open(BACKEND_DIR / 'func2url.json', encoding='utf-8') as f:
+        return list(json.load(f))
+
+def make_event(method: str, body: Any = None, params: Optional[Dict[str, str]] = None,
+               headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    return {
+        'httpMethod': method,
+        'headers': headers or {},
+        'queryStringParameters': params or {},
+        'body': json.dumps(body) if body is not None and not isinstance(body, str) else (body or ''),
+        'isBase64Encoded': False
+    }
+
+def require_db_url(db_url: Optional[str]) -> str:
+    db_url = db_url or os.environ.get('TEST_DATABASE_URL')
+    if not db_url:
+        raise SystemExit('Pass --db-url or set TEST_DATABASE_URL to a throwaway database')
+    return db_url
+
+def _bump_round_trips() -> None:
+    _round_trips.value = getattr(_round_trips, 'value', 0) + 1
+
+def reset_round_trips() -> None:
+    _round_trips.value = 0
+
+def round_trips() -> int:
+    return getattr(_round_trips, 'value', 0)
+
+def _counting_cursor(base: type) -> type:
+    if base not in _cursor_classes:
+        class CountingCursor(base):
+            def execute(self, *args, **kwargs):
+                _bump_round_trips()
+                return super().execute(*args, **kwargs)
+            
+            def executemany(self, *args, **kwargs):
+                _bump_round_trips()
+                return super().executemany(*args, **kwargs)
+            
+            def copy_expert(self, *args, **kwargs):
+                _bump_round_trips()
+                return super().copy_expert(*args, **kwargs)
+        _cursor_classes[base] = CountingCursor
+    return _cursor_classes[base]
+
+_connection_classes: Dict[type, type] = {}
+
+def _counting_connection(base: type) -> type:
+    if base not in _connection_classes:
+        class CountingConnection(base):
+            def cursor(self, *args, **kwargs):
+                kwargs['cursor_factory'] = _counting_cursor(kwargs.get('cursor_factory') or psycopg2.extensions.cursor)
+                return super().cursor(*args, **kwargs)
+            
+            def commit(self):
+                _bump_round_trips()
+                return super().commit()
+            
+            def rollback(self):
+                _bump_round_trips()
+                return super().rollback()
+        _connection_classes[base] = CountingConnection
+    return _connection_classes[base]
+
+def install_round_trip_counter() -> None:
+    # Every connection the handlers open from now on counts statements,
+    # commits and rollbacks issued by the calling thread, on top of the
+    # connection class the handler asked for
+    if getattr(psycopg2.connect, 'counts_round_trips', False):
+        return
+    original = psycopg2.connect
+    
+    @functools.wraps(original)
+    def connect(*args, connection_factory=None, **kwargs):
+        base = connection_factory or psycopg2.extensions.connection
+        return original(*args, connection_factory=_counting_connection(base), **kwargs)
+    
+    connect.counts_round_trips = True
+    psycopg2.connect = connect
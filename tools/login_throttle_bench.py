@@ -0,0 +1,136 @@
+'''
+Cost of a throttled login against an accepted one.
+
+Resets the throwaway database given by --db-url / TEST_DATABASE_URL,
+registers one user and times --samples login calls in each state:
+
+  accepted        valid credentials with fresh buckets and counters
+  rejected_local  the email's in-process token bucket is empty
+  rejected_shared the shared login_attempts counter is over its limit
+                  while this instance's buckets are fresh (as on another
+                  instance of the function)
+
+For each it reports latency, DB round trips and KDF runs per call, and
+fails if a rejection ran the KDF, took more round trips than the counter
+upsert, or was not clearly cheaper than an accepted login.
+
+    python tools/login_throttle_bench.py --db-url postgresql://localhost/cms_test
+'''
+import argparse
+import json
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+import psycopg2
+
+from localdb import (
+    install_round_trip_counter, load_handler, make_event, require_db_url,
+    reset_database, reset_round_trips, round_trips
+)
+
+EMAIL = 'throttle@example.com'
+PASSWORD = 'throttle-password'
+SOURCE_IP = '203.0.113.7'
+
+def login_event(password: str) -> Dict[str, Any]:
+    event = make_event('POST', {'action': 'login', 'email': EMAIL, 'password': password})
+    event['requestContext'] = {'identity': {'sourceIp': SOURCE_IP}}
+    return event
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-url')
+    parser.add_argument('--samples', type=int, default=20)
+    args = parser.parse_args()
+    
+    db_url = require_db_url(args.db_url)
+    reset_database(db_url)
+    install_round_trip_counter()
+    auth = load_handler('auth', db_url)
+    response = auth.handler(make_event('POST', {
+        'action': 'register', 'email': EMAIL, 'password': PASSWORD, 'full_name': 'Throttle Test'
+    }), None)
+    assert response['statusCode'] == 201, response['body']
+    
+    kdf_runs = [0]
+    verify_password = auth.verify_password
+    
+    def counting_verify(*a: Any) -> Any:
+        kdf_runs[0] += 1
+        return verify_password(*a)
+    auth.verify_password = counting_verify
+    
+    admin = psycopg2.connect(db_url)
+    admin.autocommit = True
+    
+    def forget_attempts(shared: bool) -> None:
+        with auth._login_buckets_lock:
+            auth._login_buckets.clear()
+        if shared:
+            with admin.cursor() as cur:
+                cur.execute('DELETE FROM login_attempts')
+    
+    def measure(setup: Callable[[], None], password: str, expected: int) -> Dict[str, Any]:
+        samples: List[float] = []
+        trips = runs = 0
+        for _ in range(args.samples):
+            setup()
+            kdf_runs[0] = 0
+            reset_round_trips()
+            started = time.perf_counter()
+            response = auth.handler(login_event(password), None)
+            samples.append(time.perf_counter() - started)
+            assert response['statusCode'] == expected, (expected, response['statusCode'], response['body'])
+            trips += round_trips()
+            runs += kdf_runs[0]
+        samples.sort()
+        return {
+            'p50_ms': round(statistics.median(samples) * 1000, 3),
+            'max_ms': round(samples[-1] * 1000, 3),
+            'round_trips': round(trips / args.samples, 2),
+            'kdf_runs': round(runs / args.samples, 2)
+        }
+    
+    report: Dict[str, Any] = {}
+    report['accepted'] = measure(lambda: forget_attempts(True), PASSWORD, 200)
+    
+    # Drain the email bucket with failed guesses, then keep guessing
+    forget_attempts(True)
+    for _ in range(auth.LOGIN_LIMITS['email'][0]):
+        auth.handler(login_event('wrong'), None)
+    report['rejected_local'] = measure(lambda: None, 'wrong', 429)
+    
+    # Push the shared counter over the limit, then guess from "new" instances
+    forget_attempts(True)
+    with admin.cursor() as cur:
+        cur.execute(
+            "INSERT INTO login_attempts (key, window_start) VALUES (%s, %s)",
+            (f'email:{EMAIL}', auth.datetime.utcfromtimestamp(int(time.time()) // auth.LOGIN_WINDOW * auth.LOGIN_WINDOW))
+        )
+        cur.execute("UPDATE login_attempts SET attempts = %s", (auth.LOGIN_WINDOW_LIMITS['email'],))
+    report['rejected_shared'] = measure(lambda: forget_attempts(False), 'wrong', 429)
+    admin.close()
+    
+    accepted = report['accepted']['p50_ms']
+    failures = []
+    for name in ('rejected_local', 'rejected_shared'):
+        result = report[name]
+        result['cost_vs_accepted'] = round(result['p50_ms'] / accepted, 4) if accepted else None
+        if result['kdf_runs']:
+            failures.append(f'{name}: ran the password KDF')
+        if result['p50_ms'] * 5 > accepted:
+            failures.append(f"{name}: p50 {result['p50_ms']}ms is not well below accepted {accepted}ms")
+    if report['rejected_local']['round_trips']:
+        failures.append('rejected_local: touched the database')
+    if report['rejected_shared']['round_trips'] > 2:
+        failures.append('rejected_shared: more than the counter upsert and its commit')
+    
+    report['throttle'] = auth.login_throttle_metrics()
+    report['failures'] = failures
+    print(json.dumps(report, indent=2))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
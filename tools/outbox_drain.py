@@ -0,0 +1,128 @@
+'''
+Drain test for the notification outbox and its dispatcher.
+
+Resets the throwaway database given by --db-url / TEST_DATABASE_URL,
+enqueues --notifications pending rows spread over the three channels,
+then runs --workers dispatcher invocations in parallel against the fake
+channel backends (NOTIFY_BACKEND=fake) until the queue is empty. A share
+of sends (--fail-rate) fails transiently so retries are exercised; the
+backoff is scaled down to milliseconds to keep the run short. Exits
+non-zero if a notification is delivered twice, a row is left pending or
+the sent counters disagree with what the fake channels received.
+
+    python tools/outbox_drain.py --db-url postgresql://localhost/cms_test
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict
+
+import psycopg2
+
+from localdb import load_handler, make_event, require_db_url, reset_database
+
+def prepare(db_url: str, notifications: int) -> None:
+    reset_database(db_url)
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE users SET telegram_chat_id = '10' || id")
+            cur.execute("""
+                INSERT INTO notifications (user_id, type, subject, message)
+                SELECT u.id, (ARRAY['email', 'email', 'telegram', 'sms'])[1 + n %% 4],
+                       'Drain test', 'Notification ' || n
+                FROM generate_series(1, %s) AS n
+                JOIN users u ON u.id = 1 + n %% (SELECT count(*) FROM users)
+            """, (notifications,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-url')
+    parser.add_argument('--notifications', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--fail-rate', type=float, default=0.05)
+    parser.add_argument('--send-delay-ms', type=float, default=1.0, help='simulated provider latency per send')
+    args = parser.parse_args()
+    
+    db_url = require_db_url(args.db_url)
+    prepare(db_url, args.notifications)
+    
+    os.environ.update({
+        'NOTIFY_BACKEND': 'fake',
+        'NOTIFY_FAKE_FAIL_RATE': str(args.fail_rate),
+        'NOTIFY_FAKE_DELAY_MS': str(args.send_delay_ms),
+        'NOTIFY_BACKOFF_BASE': '0.01',
+        'NOTIFY_BACKOFF_MAX': '0.05',
+        'NOTIFY_MAX_ATTEMPTS': '10',
+        'DB_POOL_MAX': str(args.workers)
+    })
+    notifications = load_handler('notifications', db_url)
+    
+    def worker(_: int) -> Dict[str, int]:
+        totals: Counter = Counter()
+        idle_rounds = 0
+        # Keep invoking until a few consecutive runs find nothing due: rows
+        # that are backing off become due again a few milliseconds later
+        while idle_rounds < 5:
+            response = notifications.handler(make_event('POST', {'batch_size': args.batch_size}), None)
+            if response['statusCode'] != 200:
+                totals['http_errors'] += 1
+                break
+            summary = json.loads(response['body'])
+            totals.update(summary)
+            idle_rounds = idle_rounds + 1 if summary['claimed'] == 0 else 0
+            if summary['claimed'] == 0:
+                time.sleep(0.02)
+        return totals
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        totals: Counter = sum(pool.map(worker, range(args.workers)), Counter())
+    elapsed = time.perf_counter() - started
+    
+    delivered = Counter(i for channel in notifications.CHANNELS.values() for i in channel.sent)
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT status, count(*) FROM notifications GROUP BY status")
+            by_status: Dict[str, Any] = dict(cur.fetchall())
+            cur.execute("SELECT max(attempts) FROM notifications")
+            max_attempts = cur.fetchone()[0]
+    finally:
+        conn.close()
+    
+    failures = []
+    duplicates = [i for i, n in delivered.items() if n > 1]
+    if duplicates:
+        failures.append(f'{len(duplicates)} notifications delivered more than once')
+    if by_status.get('pending'):
+        failures.append(f"{by_status['pending']} notifications left pending")
+    if by_status.get('sent', 0) != len(delivered) or totals['sent'] != len(delivered):
+        failures.append(f"sent rows {by_status.get('sent', 0)}, dispatcher sent {totals['sent']}, "
+                        f"fake channels received {len(delivered)}")
+    if totals['http_errors']:
+        failures.append(f"{totals['http_errors']} dispatcher calls failed")
+    
+    print(json.dumps({
+        'notifications': args.notifications,
+        'workers': args.workers,
+        'seconds': round(elapsed, 2),
+        'sent_per_second': round(len(delivered) / elapsed, 1),
+        'batches': totals['batches'],
+        'retries': totals['retry'],
+        'statuses': by_status,
+        'max_attempts': max_attempts,
+        'failures': failures
+    }, indent=2))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+'''
+Password KDF benchmark for the auth function.
+
+For every scrypt cost setting, measures how many login verifications per
+second one core sustains and what the auth KDF thread pool achieves with
+all cores busy, so PASSWORD_SCRYPT_N/R/P can be sized against the login
+latency SLA. Needs no database.
+
+    python tools/password_bench.py --costs 14:8:1,15:8:1,16:8:1 --seconds 3
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Tuple
+
+from localdb import load_handler
+
+def parse_cost(text: str) -> Tuple[int, int, int]:
+    log_n, r, p = (int(part) for part in text.split(':'))
+    return 2 ** log_n, r, p
+
+def measure(auth, cost: Tuple[int, int, int], seconds: float, threads: int) -> Dict[str, Any]:
+    stored = auth.hash_password('correct horse battery staple', cost)
+    
+    started = time.perf_counter()
+    samples = []
+    while time.perf_counter() - started < seconds:
+        t0 = time.perf_counter()
+        auth.verify_password('correct horse battery staple', stored)
+        samples.append(time.perf_counter() - t0)
+    single = len(samples) / (time.perf_counter() - started)
+    samples.sort()
+    
+    done = 0
+    deadline = time.perf_counter() + seconds
+    def worker(_: int) -> int:
+        count = 0
+        while time.perf_counter() < deadline:
+            auth.verify_password('correct horse battery staple', stored)
+            count += 1
+        return count
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        done = sum(pool.map(worker, range(threads)))
+    parallel = done / (time.perf_counter() - started)
+    
+    return {
+        'n': cost[0],
+        'r': cost[1],
+        'p': cost[2],
+        'memory_mib': round(128 * cost[0] * cost[1] / 2 ** 20, 1),
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 2),
+        'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 2),
+        'logins_per_second_one_core': round(single, 1),
+        'logins_per_second_all_cores': round(parallel, 1),
+        'logins_per_second_per_core': round(parallel / threads, 1)
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--costs', default='14:8:1,15:8:1,16:8:1', help='comma separated log2(N):r:p settings')
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args()
+    
+    auth = load_handler('auth')
+    results = {
+        'cores': args.threads,
+        'costs': [measure(auth, parse_cost(c), args.seconds, args.threads) for c in args.costs.split(',')]
+    }
+    
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+'''
+Concurrency stress test for the students payment ledger.
+
+Resets the throwaway database given by --db-url / TEST_DATABASE_URL,
+creates --students students, then fires --payments payment calls in
+parallel through the real handler. Every transaction_id is sent
+--replays extra times, a share of payments starts pending and is
+confirmed concurrently, and a share of completed ones is refunded.
+Exits non-zero if reconcile_balances finds any drift between the
+cached students.balance and the payments ledger, or a transaction
+ended up recorded twice.
+
+    python tools/payments_stress.py --db-url postgresql://localhost/cms_test
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import psycopg2
+
+from localdb import load_handler, make_event, require_db_url, reset_database
+
+def prepare(db_url: str, students: int) -> List[int]:
+    reset_database(db_url)
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO students (parent_id, full_name, balance)
+                SELECT 3, 'Ledger student ' || n, 0 FROM generate_series(1, %s) AS n
+                RETURNING id
+            """, (students,))
+            student_ids = [row[0] for row in cur.fetchall()]
+        conn.commit()
+    finally:
+        conn.close()
+    return student_ids
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-url')
+    parser.add_argument('--students', type=int, default=20)
+    parser.add_argument('--payments', type=int, default=1000)
+    parser.add_argument('--replays', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=32)
+    args = parser.parse_args()
+    
+    db_url = require_db_url(args.db_url)
+    student_ids = prepare(db_url, args.students)
+    
+    os.environ['DB_POOL_MAX'] = str(args.workers)
+    students = load_handler('students', db_url)
+    
+    calls: List[Dict[str, Any]] = []
+    for n in range(args.payments):
+        payment = {
+            'action': 'payment',
+            'transaction_id': f'stress-{n}',
+            'student_id': random.choice(student_ids),
+            'amount': 500,
+            'lessons_purchased': random.randint(1, 8),
+            'payment_status': random.choice(('completed', 'completed', 'pending'))
+        }
+        calls.extend([payment] * (1 + args.replays))
+        if payment['payment_status'] == 'pending':
+            calls.append({'action': 'payment_status', 'transaction_id': payment['transaction_id'],
+                          'payment_status': 'completed'})
+        elif random.random() < 0.2:
+            calls.append({'action': 'payment_status', 'transaction_id': payment['transaction_id'],
+                          'payment_status': 'refunded'})
+    random.shuffle(calls)
+    
+    def call(body: Dict[str, Any]) -> str:
+        response = students.handler(make_event('POST', body), None)
+        return f"{body['action']} {response['statusCode']}"
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        statuses = Counter(pool.map(call, calls))
+    elapsed = time.perf_counter() - started
+    
+    reconcile = json.loads(students.handler(make_event('POST', {'action': 'reconcile_balances'}), None)['body'])
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*), count(DISTINCT transaction_id) FROM payments WHERE transaction_id LIKE 'stress-%%'")
+            rows, distinct = cur.fetchone()
+    finally:
+        conn.close()
+    
+    failures = []
+    if reconcile['drifted']:
+        failures.append(f"{reconcile['drifted']} balances drifted from the ledger")
+    if rows != args.payments or distinct != args.payments:
+        failures.append(f'{rows} payment rows for {args.payments} transactions')
+    unexpected = [s for s in statuses if s.endswith(' 500')]
+    if unexpected:
+        failures.append(f'server errors: {unexpected}')
+    
+    print(json.dumps({
+        'calls': len(calls),
+        'calls_per_second': round(len(calls) / elapsed, 1),
+        'statuses': dict(sorted(statuses.items())),
+        'payments': rows,
+        'drift': reconcile['students'][:10],
+        'failures': failures
+    }, indent=2))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
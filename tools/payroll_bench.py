@@ -0,0 +1,170 @@
+'''
+Teacher payroll benchmark over a synthetic year of attendance.
+
+Resets the throwaway database given by --db-url / TEST_DATABASE_URL and
+generates --teachers teachers with --courses courses each, --students
+active students per course and two lessons a week for a whole year
+(~85% of visits present). Then times, for a one-month and a full-year
+period:
+
+  loop   the per-teacher approach: fetch each teacher's courses, then each
+         course's present visits, and add them up in Python
+  sql    GET /courses?action=payroll&format=json (one grouped SQL pass)
+  csv    GET /courses?action=payroll (the same pass rendered by COPY)
+
+and fails if the loop and the SQL pass disagree on any teacher's amount.
+
+    python tools/payroll_bench.py --db-url postgresql://localhost/cms_test
+'''
+import argparse
+import json
+import statistics
+import sys
+import time
+from decimal import Decimal
+from typing import Any, Callable, Dict, List
+
+import psycopg2
+import psycopg2.extras
+
+from localdb import load_handler, make_event, require_db_url, reset_database
+
+YEAR_START = '2024-01-01'
+
+def prepare(db_url: str, teachers: int, courses: int, students: int) -> int:
+    reset_database(db_url)
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                WITH new_users AS (
+                    INSERT INTO users (email, password_hash, role, full_name)
+                    SELECT 'payroll' || n || '@example.com', '-', 'teacher', 'Педагог ' || n
+                    FROM generate_series(1, %(teachers)s) AS n
+                    RETURNING id
+                )
+                INSERT INTO teachers (user_id, rate_per_student)
+                SELECT id, 150 + (id %% 7) * 25 FROM new_users
+            """, {'teachers': teachers})
+            cur.execute("""
+                INSERT INTO courses (title, price_per_month, total_spots, available_spots, teacher_id)
+                SELECT 'Курс ' || t.id || '-' || n, 3000, %(students)s, 0, t.id
+                FROM teachers t, generate_series(1, %(courses)s) AS n
+            """, {'courses': courses, 'students': students})
+            cur.execute("""
+                WITH new_students AS (
+                    INSERT INTO students (parent_id, full_name)
+                    SELECT 3, 'Ученик ' || n
+                    FROM generate_series(1, (SELECT count(*) FROM courses) * %(students)s) AS n
+                    RETURNING id
+                ),
+                numbered AS (
+                    SELECT id, row_number() OVER (ORDER BY id) - 1 AS n FROM new_students
+                ),
+                course_list AS (
+                    SELECT id, row_number() OVER (ORDER BY id) - 1 AS n FROM courses
+                )
+                INSERT INTO enrollments (student_id, course_id, status)
+                SELECT s.id, c.id, 'active'
+                FROM numbered s
+                JOIN course_list c ON c.n = s.n / %(students)s
+                ON CONFLICT DO NOTHING
+            """, {'students': students})
+            # Two lessons a week per course, on days picked from the course id
+            cur.execute("""
+                INSERT INTO attendance (enrollment_id, lesson_date, lesson_time, status)
+                SELECT e.id, d::date, '16:00-17:30',
+                       CASE WHEN random() < 0.85 THEN 'present' ELSE 'absent' END
+                FROM enrollments e
+                JOIN generate_series(%(start)s::date, %(start)s::date + 364, '1 day') AS d
+                  ON extract(isodow FROM d) IN (1 + e.course_id %% 3, 4 + e.course_id %% 3)
+            """, {'start': YEAR_START})
+            cur.execute("SELECT count(*) FROM attendance")
+            rows = cur.fetchone()[0]
+        conn.commit()
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute('VACUUM ANALYZE')
+    finally:
+        conn.close()
+    return rows
+
+def loop_payroll(db_url: str, date_from: str, date_to: str) -> Dict[int, Decimal]:
+    conn = psycopg2.connect(db_url)
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute("SELECT id, rate_per_student FROM teachers")
+        result = {}
+        for teacher in cur.fetchall():
+            cur.execute("SELECT id FROM courses WHERE teacher_id = %s", (teacher['id'],))
+            visits = 0
+            for course in cur.fetchall():
+                cur.execute("""
+                    SELECT a.status, e.status AS enrollment_status
+                    FROM attendance a
+                    JOIN enrollments e ON e.id = a.enrollment_id
+                    WHERE e.course_id = %s AND a.lesson_date BETWEEN %s AND %s
+                """, (course['id'], date_from, date_to))
+                for row in cur.fetchall():
+                    if row['status'] == 'present' and row['enrollment_status'] == 'active':
+                        visits += 1
+            result[teacher['id']] = (teacher['rate_per_student'] * visits).quantize(Decimal('0.01'))
+        return result
+    finally:
+        conn.close()
+
+def timed(fn: Callable[[], Any], repeat: int) -> Dict[str, Any]:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - started)
+    return {'median_ms': round(statistics.median(samples) * 1000, 1), 'result': result}
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-url')
+    parser.add_argument('--teachers', type=int, default=40)
+    parser.add_argument('--courses', type=int, default=4, help='courses per teacher')
+    parser.add_argument('--students', type=int, default=12, help='students per course')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    
+    db_url = require_db_url(args.db_url)
+    rows = prepare(db_url, args.teachers, args.courses, args.students)
+    courses = load_handler('courses', db_url)
+    
+    def call(params: Dict[str, str]) -> Dict[str, Any]:
+        response = courses.handler(make_event('GET', params=params), None)
+        assert response['statusCode'] == 200, response['body']
+        return response
+    
+    report: Dict[str, Any] = {'attendance_rows': rows, 'periods': {}}
+    failures: List[str] = []
+    for label, date_from, date_to in (('month', '2024-03-01', '2024-03-31'), ('year', '2024-01-01', '2024-12-30')):
+        params = {'action': 'payroll', 'from': date_from, 'to': date_to}
+        loop = timed(lambda: loop_payroll(db_url, date_from, date_to), args.repeat)
+        sql = timed(lambda: call(dict(params, format='json')), args.repeat)
+        csv = timed(lambda: call(params), args.repeat)
+        
+        amounts = {t['teacher_id']: Decimal(str(t['payable'])).quantize(Decimal('0.01'))
+                   for t in json.loads(sql['result']['body'])['teachers']}
+        mismatched = [t for t, amount in loop['result'].items() if amounts.get(t) != amount]
+        if mismatched:
+            failures.append(f'{label}: {len(mismatched)} teachers differ between loop and SQL')
+        
+        report['periods'][label] = {
+            'loop_ms': loop['median_ms'],
+            'sql_ms': sql['median_ms'],
+            'csv_ms': csv['median_ms'],
+            'speedup': round(loop['median_ms'] / max(sql['median_ms'], 0.01), 1),
+            'csv_bytes': len(csv['result']['body']),
+            'total_payable': str(sum(amounts.values()))
+        }
+    
+    report['failures'] = failures
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
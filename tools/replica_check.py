@@ -0,0 +1,156 @@
+'''
+Read/write routing check against a primary and a streaming replica.
+
+Needs two local Postgres instances: the throwaway primary given by
+--db-url / TEST_DATABASE_URL and a hot standby replicating from it, given
+by --read-url / TEST_DATABASE_READ_URL (pg_basebackup -R gives one in a
+minute). The primary is reset from db_migrations/ and the handlers run
+with DATABASE_READ_URL pointing at the standby. Checks that:
+
+  - plain GETs are served by the replica
+  - a write returns X-Last-Write, and a GET echoing it reads the write
+    from the primary
+  - with replay paused on the standby, GETs fall back to the primary once
+    the lag exceeds REPLICA_MAX_LAG, and go back after replay resumes
+  - an unreachable replica sends reads to the primary
+
+    python tools/replica_check.py --db-url postgresql://localhost/cms_test \\
+        --read-url postgresql://localhost:5433/cms_test
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import psycopg2
+
+from localdb import load_handler, make_event, require_db_url, reset_database
+
+MAX_LAG = 0.5
+CHECK_INTERVAL = 0.2
+
+def wait_for_replay(db_url: str, read_url: str, timeout: float = 30) -> None:
+    with psycopg2.connect(db_url) as primary, primary.cursor() as cur:
+        cur.execute('SELECT pg_current_wal_lsn()')
+        target = cur.fetchone()[0]
+    primary.close()
+    deadline = time.monotonic() + timeout
+    replica = psycopg2.connect(read_url)
+    replica.autocommit = True
+    try:
+        with replica.cursor() as cur:
+            while True:
+                cur.execute('SELECT pg_last_wal_replay_lsn() >= %s::pg_lsn', (target,))
+                if cur.fetchone()[0]:
+                    return
+                if time.monotonic() > deadline:
+                    raise SystemExit('The replica did not catch up; is it streaming from --db-url?')
+                time.sleep(0.05)
+    finally:
+        replica.close()
+
+def replica_admin(read_url: str, statement: str) -> None:
+    conn = psycopg2.connect(read_url)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(statement)
+    finally:
+        conn.close()
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-url')
+    parser.add_argument('--read-url')
+    args = parser.parse_args()
+    
+    db_url = require_db_url(args.db_url)
+    read_url = args.read_url or os.environ.get('TEST_DATABASE_READ_URL')
+    if not read_url:
+        raise SystemExit('Pass --read-url or set TEST_DATABASE_READ_URL to a standby of --db-url')
+    
+    reset_database(db_url)
+    wait_for_replay(db_url, read_url)
+    os.environ.update({
+        'DATABASE_READ_URL': read_url,
+        'REPLICA_MAX_LAG': str(MAX_LAG),
+        'REPLICA_LAG_CHECK_INTERVAL': str(CHECK_INTERVAL),
+        'READ_YOUR_WRITES_WINDOW': '2'
+    })
+    students = load_handler('students', db_url)
+    
+    checks: List[Dict[str, Any]] = []
+    
+    def get(params: Dict[str, str], token: Optional[str] = None) -> Dict[str, Any]:
+        before = dict(students.read_routing_stats)
+        response = students.handler(make_event('GET', params=params, headers={'X-Last-Write': token} if token else None), None)
+        routed = [k for k, v in students.read_routing_stats.items() if v != before[k]]
+        assert response['statusCode'] == 200, response['body']
+        return {'routed': routed[0] if routed else None, 'body': json.loads(response['body'])}
+    
+    def create_student(name: str) -> Dict[str, Any]:
+        response = students.handler(make_event('POST', {'parent_id': 3, 'full_name': name}), None)
+        assert response['statusCode'] == 201, response['body']
+        return response
+    
+    def names(result: Dict[str, Any]) -> List[str]:
+        return [s['full_name'] for s in result['body']['students']]
+    
+    def check(name: str, ok: bool, **details: Any) -> None:
+        checks.append(dict(name=name, ok=bool(ok), **details))
+    
+    result = get({'parent_id': '3'})
+    check('plain read goes to the replica', result['routed'] == 'replica', routed=result['routed'])
+    
+    response = create_student('Replica Check A')
+    token = response['headers'].get('X-Last-Write')
+    result = get({'parent_id': '3'}, token)
+    check('write returns X-Last-Write', bool(token), token=token)
+    check('read echoing the token goes to the primary and sees the write',
+          result['routed'] == 'recent_write' and 'Replica Check A' in names(result), routed=result['routed'])
+    
+    replica_admin(read_url, 'SELECT pg_wal_replay_pause()')
+    try:
+        create_student('Replica Check B')
+        time.sleep(MAX_LAG + CHECK_INTERVAL * 2)
+        result = get({'parent_id': '3'})
+        check('lagging replica falls back to the primary',
+              result['routed'] == 'lagging' and 'Replica Check B' in names(result),
+              routed=result['routed'], lag=students.read_routing_metrics()['replica_lag'])
+    finally:
+        replica_admin(read_url, 'SELECT pg_wal_replay_resume()')
+    
+    wait_for_replay(db_url, read_url)
+    time.sleep(CHECK_INTERVAL * 2)
+    result = get({'parent_id': '3'})
+    check('caught-up replica serves reads again',
+          result['routed'] == 'replica' and 'Replica Check B' in names(result), routed=result['routed'])
+    
+    stale = str(int((time.time() - 60) * 1000))
+    result = get({'parent_id': '3'}, stale)
+    check('expired token reads from the replica', result['routed'] == 'replica', routed=result['routed'])
+    
+    # Point new replica connections nowhere and drop the pooled ones
+    students.DB_URLS['replica'] = 'postgresql://postgres@/cms_test?host=/nonexistent'
+    with students._pool_lock:
+        idle, students._pools['replica'][:] = list(students._pools['replica']), []
+    for conn, _ in idle:
+        conn.close()
+    time.sleep(CHECK_INTERVAL * 2)
+    result = get({'parent_id': '3'})
+    check('unreachable replica falls back to the primary', result['routed'] == 'unavailable', routed=result['routed'])
+    students.DB_URLS['replica'] = read_url
+    
+    failures = [c['name'] for c in checks if not c['ok']]
+    print(json.dumps({
+        'checks': checks,
+        'routing': students.read_routing_metrics(),
+        'pool': students.pool_metrics(),
+        'failures': failures
+    }, indent=2, default=str))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
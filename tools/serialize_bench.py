@@ -0,0 +1,100 @@
+'''
+Response serialization benchmark: the previous hand-built response path
+(json.dumps with a decimal_default hook, ASCII-escaped) against the shared
+respond() core of the handlers, with and without gzip.
+
+Uses synthetic payloads shaped like the course catalog and a page of the
+student list, so it needs no database.
+
+    python tools/serialize_bench.py --courses 200 --students 200
+'''
+import argparse
+import json
+import sys
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Any, Callable, List
+
+from localdb import load_handler
+
+def legacy_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, date):
+        return obj.isoformat()
+    raise TypeError
+
+def legacy_response(payload: Any) -> Dict[str, Any]:
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(payload, default=legacy_default),
+        'isBase64Encoded': False
+    }
+
+def catalog_payload(count: int) -> List[Dict[str, Any]]:
+    now = datetime(2024, 3, 1, 12, 0, 0)
+    return [{
+        'id': i,
+        'title': f'Робототехника для начинающих {i}',
+        'description': 'Изучаем основы робототехники и программирования на реальных конструкторах',
+        'age_min': 7, 'age_max': 10,
+        'schedule': 'ПН, СР 16:00-17:30', 'duration_minutes': 90,
+        'price_per_month': Decimal('3500.00'), 'total_spots': 12, 'available_spots': 8,
+        'room': 'Кабинет 201', 'image_emoji': '🤖', 'teacher_id': 1, 'is_active': True,
+        'created_at': now - timedelta(days=i), 'updated_at': now,
+        'user_id': 1, 'teacher_name': 'Иванов Петр'
+    } for i in range(count)]
+
+def students_payload(count: int) -> Dict[str, Any]:
+    now = datetime(2024, 3, 1, 12, 0, 0)
+    return {
+        'students': [{
+            'id': i, 'parent_id': 3, 'full_name': f'Иван Петров {i}',
+            'birth_date': date(2015, 3, 15), 'age': 9, 'balance': 8,
+            'created_at': now, 'updated_at': now
+        } for i in range(count)],
+        'next_cursor': 'WyLQmNCy0LDQvSDQn9C10YLRgNC+0LIiLDIwMF0'
+    }
+
+def measure(fn: Callable[[], Dict[str, Any]], seconds: float) -> Dict[str, Any]:
+    response = fn()
+    runs = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        fn()
+        runs += 1
+    elapsed = time.perf_counter() - started
+    return {
+        'us_per_response': round(elapsed / runs * 1e6, 1),
+        'body_bytes': len(response['body'].encode()),
+        'base64': response['isBase64Encoded']
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--courses', type=int, default=200)
+    parser.add_argument('--students', type=int, default=200)
+    parser.add_argument('--seconds', type=float, default=1.0)
+    args = parser.parse_args()
+    
+    core = load_handler('courses')
+    plain = {'headers': {}}
+    gzipped = {'headers': {'Accept-Encoding': 'gzip, deflate, br'}}
+    
+    results: Dict[str, Any] = {'encoder': 'orjson' if core.orjson is not None else 'json'}
+    for name, payload in [('catalog', catalog_payload(args.courses)), ('student_list', students_payload(args.students))]:
+        results[name] = {
+            'legacy': measure(lambda: legacy_response(payload), args.seconds),
+            'respond': measure(lambda: core.respond(200, payload, plain), args.seconds),
+            'respond_gzip': measure(lambda: core.respond(200, payload, gzipped), args.seconds)
+        }
+    
+    print(json.dumps(results, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())